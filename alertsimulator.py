@@ -1,6 +1,33 @@
-import requests
+'''
+Module: alertsimulator.py
+
+Send generated Kapacitor alerts to a running KAP.
+
+Without --load a single alert built from the command line options is
+sent. With --load a realistic mix of alerts from many hosts and tasks
+(state changes, flapping, recoveries and multi-series tag sets) is
+replayed at a target rate or from a number of concurrent clients, and
+throughput, latency percentiles and error rates are printed as JSON.
+
+With --stubs, stub Slack, PagerDuty, JIRA and InfluxDB servers are
+started on localhost, so KAP can be pointed at them instead of the real
+targets, and the number of requests each of them received is included
+in the report.
+'''
+import sys
+import json
+import time
+import random
 import argparse
+import threading
 from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import requests
+
+TASKS = ['cpu', 'mem', 'disk', 'load', 'swap', 'ping', 'http_response',
+         'net_response', 'procstat', 'diskio']
+ENVIRONMENTS = ['production', 'production', 'staging', 'test']
+LEVELS = ['INFO', 'WARNING', 'CRITICAL', 'CRITICAL']
 
 
 def run(args):
@@ -16,7 +43,324 @@ def run(args):
                  "data": {"series": [{"tags": {'Environment': args.environ,
                                                "host": args.hostname}}]}}
 
-    requests.post(url="http://localhost:9095/kap/alert", json=json_body)
+    requests.post(url=args.url, json=json_body)
+
+
+def rfc3339_now():
+    now = time.time()
+    return time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(now)) + \
+        ".%09dZ" % int((now % 1) * 10**9)
+
+
+class AlertMix():
+    """Generates a stream of alerts for hosts x tasks, keeping the current
+    level of every alert so the state transitions make sense"""
+
+    def __init__(self, hosts, flap_rate=0.1, ok_rate=0.3, series=3,
+                 seed=None):
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._flap_rate = flap_rate
+        self._ok_rate = ok_rate
+        self._alerts = []
+        for h in range(hosts):
+            host = "host%04d.example.com" % h
+            env = self._random.choice(ENVIRONMENTS)
+            for task in TASKS:
+                self._alerts.append({'host': host, 'task': task,
+                                     'env': env, 'level': 'OK',
+                                     'since': time.time(),
+                                     'series': self._random.randint(
+                                         1, series)})
+        self._flapping = set(self._random.sample(
+            range(len(self._alerts)),
+            int(len(self._alerts) * flap_rate)))
+
+    def next(self):
+        with self._lock:
+            i = self._random.randrange(len(self._alerts))
+            a = self._alerts[i]
+            previous = a['level']
+            if previous == 'OK':
+                level = self._random.choice(LEVELS)
+            elif i in self._flapping or self._random.random() < self._ok_rate:
+                level = 'OK'
+            else:
+                # Still alerting, maybe at another level
+                level = self._random.choice(LEVELS + [previous] * 4)
+            if level != previous:
+                a['since'] = time.time()
+            a['level'] = level
+            return self._payload(a, previous)
+
+    @staticmethod
+    def _payload(a, previous):
+        alertid = "%s %s" % (a['host'], a['task'])
+        series = []
+        for n in range(a['series']):
+            tags = {'Environment': a['env'], 'host': a['host'],
+                    'MonGroup': 'web|%s' % a['task']}
+            if a['series'] > 1:
+                tags['instance'] = str(n)
+            series.append({'name': a['task'], 'tags': tags,
+                           'columns': ['time', 'value'],
+                           'values': [[rfc3339_now(), random.random()]]})
+        return {'id': alertid,
+                'message': "%s is %s" % (alertid, a['level']),
+                'details': '',
+                'time': rfc3339_now(),
+                'duration': int((time.time() - a['since']) * 10**9),
+                'level': a['level'],
+                'previousLevel': previous,
+                'data': {'series': series}}
+
+
+class StormMix(AlertMix):
+    """Every alert goes from OK to CRITICAL, then recovers"""
+
+    def next(self):
+        with self._lock:
+            i = self._random.randrange(len(self._alerts))
+            a = self._alerts[i]
+            previous = a['level']
+            a['level'] = 'CRITICAL' if previous == 'OK' else 'OK'
+            return self._payload(a, previous)
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Headers and body are written separately, with Nagle enabled every
+    # keep-alive response waits for a delayed ACK
+    disable_nagle_algorithm = True
+    counter = None
+    name = None
+
+    def _reply(self, status, body=b'', ctype='application/json'):
+        self.send_response(status)
+        self.send_header('Content-Type', ctype)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _handle(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        if length:
+            self.rfile.read(length)
+        self.counter.add(self.name)
+        status, body = self.respond()
+        self._reply(status, body)
+
+    def respond(self):
+        return 200, b'ok'
+
+    do_GET = do_POST = do_PUT = do_DELETE = _handle
+
+    def log_message(self, *args):  # pylint: disable=W0221
+        pass
+
+
+class PagerdutyStub(StubHandler):
+    def respond(self):
+        return 200, json.dumps({'status': 'success',
+                                'incident_key': '%032x' % random.getrandbits(
+                                    128)}).encode()
+
+
+class JiraStub(StubHandler):
+    issue = 0
+
+    def respond(self):
+        path = self.path.split('?')[0]
+        if path.endswith('/serverInfo'):
+            return 200, json.dumps({'version': '8.0.0',
+                                    'versionNumbers': [8, 0, 0],
+                                    'deploymentType': 'Server'}).encode()
+        if path.endswith('/transitions') and self.command == 'GET':
+            return 200, json.dumps({'transitions': [
+                {'id': '5', 'name': 'Resolve Issue'},
+                {'id': '2', 'name': 'Close Issue'}]}).encode()
+        if path.endswith('/transitions'):
+            return 204, b''
+        if path.endswith('/issue') and self.command == 'POST':
+            JiraStub.issue += 1
+            key = 'KAP-%d' % JiraStub.issue
+            return 201, json.dumps({'id': str(JiraStub.issue), 'key': key,
+                                    'self': self.path + '/' + key}).encode()
+        if '/issue/' in path:
+            key = path.rsplit('/', 1)[-1]
+            return 200, json.dumps({'id': '1', 'key': key, 'self': path,
+                                    'fields': {'comment': {
+                                        'comments': []}}}).encode()
+        return 200, b'{}'
+
+
+class InfluxDBStub(StubHandler):
+    def respond(self):
+        if self.path.startswith('/write') or self.path.startswith('/ping'):
+            return 204, b''
+        return 200, b'{"results": [{"statement_id": 0}]}'
+
+
+class Counter():
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counts = {}
+
+    def add(self, name):
+        with self._lock:
+            self.counts[name] = self.counts.get(name, 0) + 1
+
+
+def start_stubs(port):
+    counter = Counter()
+    servers = {}
+    for i, (name, handler) in enumerate([('slack', StubHandler),
+                                         ('pagerduty', PagerdutyStub),
+                                         ('jira', JiraStub),
+                                         ('influxdb', InfluxDBStub)]):
+        handler = type(handler.__name__, (handler,),
+                       {'counter': counter, 'name': name})
+        srv = ThreadingHTTPServer(('127.0.0.1', port + i), handler)
+        srv.daemon_threads = True
+        threading.Thread(target=srv.serve_forever, daemon=True).start()
+        servers[name] = srv
+    sys.stderr.write(
+        "Stub targets running, point config.py at them:\n"
+        "  SLACK_URL = \"http://127.0.0.1:%d/\"\n"
+        "  PAGERDUTY_URL = \"http://127.0.0.1:%d/\"\n"
+        "  JIRA_SERVER = \"http://127.0.0.1:%d\"\n"
+        "  INFLUXDB_HOST = \"127.0.0.1\"\n"
+        "  INFLUXDB_PORT = %d\n" % (port, port + 1, port + 2, port + 3))
+    return servers, counter
+
+
+def percentile(values, pct):
+    if not values:
+        return None
+    k = min(len(values) - 1, int(round(pct / 100.0 * (len(values) - 1))))
+    return values[k]
+
+
+class LoadRunner():
+    def __init__(self, url, mix, clients, rate=None, count=None,
+                 seconds=None, timeout=10):
+        self._url = url
+        self._mix = mix
+        self._clients = clients
+        self._rate = rate
+        self._count = count
+        self._seconds = seconds
+        self._timeout = timeout
+        self._lock = threading.Lock()
+        self._sent = 0
+        self.latencies = []
+        self.statuses = {}
+        self.errors = 0
+
+    def _take(self):
+        with self._lock:
+            if self._count is not None and self._sent >= self._count:
+                return False
+            self._sent += 1
+            return True
+
+    def _client(self, n, start):
+        session = requests.Session()
+        interval = self._clients / float(self._rate) if self._rate else 0
+        nextsend = start + n * interval / self._clients
+        latencies = []
+        statuses = {}
+        errors = 0
+        while True:
+            now = time.time()
+            if self._seconds is not None and now - start >= self._seconds:
+                break
+            if interval:
+                if nextsend > now:
+                    time.sleep(nextsend - now)
+                nextsend += interval
+            if not self._take():
+                break
+            payload = self._mix.next()
+            t = time.perf_counter()
+            try:
+                res = session.post(self._url, json=payload,
+                                   timeout=self._timeout)
+                status = res.status_code
+            except requests.exceptions.RequestException:
+                status = 'error'
+            latencies.append(time.perf_counter() - t)
+            statuses[status] = statuses.get(status, 0) + 1
+            if status not in (200, 202):
+                errors += 1
+        with self._lock:
+            self.latencies.extend(latencies)
+            self.errors += errors
+            for k, v in statuses.items():
+                self.statuses[str(k)] = self.statuses.get(str(k), 0) + v
+
+    def run(self):
+        start = time.time()
+        threads = [threading.Thread(target=self._client, args=(n, start))
+                   for n in range(self._clients)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        elapsed = time.time() - start
+        lat = sorted(self.latencies)
+        sent = len(lat)
+        return {'sent': sent,
+                'clients': self._clients,
+                'target_rate': self._rate,
+                'elapsed': round(elapsed, 3),
+                'throughput': round(sent / elapsed, 1) if elapsed else None,
+                'latency_ms': {
+                    'p50': _ms(percentile(lat, 50)),
+                    'p95': _ms(percentile(lat, 95)),
+                    'p99': _ms(percentile(lat, 99)),
+                    'max': _ms(lat[-1] if lat else None)},
+                'errors': self.errors,
+                'error_rate': round(self.errors / float(sent), 4)
+                              if sent else None,
+                'status_codes': self.statuses}
+
+
+def _ms(value):
+    if value is None:
+        return None
+    return round(value * 1000, 2)
+
+
+def load(args):
+    servers = None
+    if args.stubs:
+        servers, counter = start_stubs(args.stub_port)
+        if args.stubs_only:
+            sys.stderr.write("Press Ctrl-C to stop\n")
+            try:
+                while True:
+                    time.sleep(60)
+            except KeyboardInterrupt:
+                pass
+            print(json.dumps({'stubs': counter.counts}, indent=2))
+            return
+    mixcls = StormMix if args.scenario == 'storm' else AlertMix
+    mix = mixcls(hosts=args.hosts, flap_rate=args.flap_rate,
+                 ok_rate=args.ok_rate, series=args.series, seed=args.seed)
+    if args.count is None and args.seconds is None:
+        args.seconds = 10
+    runner = LoadRunner(args.url, mix, clients=args.clients, rate=args.rate,
+                        count=args.count, seconds=args.seconds)
+    report = runner.run()
+    report['scenario'] = args.scenario
+    if servers:
+        # Give KAP time to finish dispatching before counting
+        time.sleep(args.settle)
+        report['stubs'] = counter.counts
+        for srv in servers.values():
+            srv.shutdown()
+    print(json.dumps(report, indent=2))
 
 
 if __name__ == '__main__':
@@ -27,5 +371,40 @@ if __name__ == '__main__':
     parser.add_argument("-p", default="ok", dest="plevel")
     parser.add_argument("-e", default="test", dest="environ")
     parser.add_argument("-d", default=0, dest="duration", type=int)
+    parser.add_argument("-u", default="http://localhost:9095/kap/alert",
+                        dest="url")
+    group = parser.add_argument_group("load test")
+    group.add_argument("--load", action="store_true",
+                       help="Replay a mix of generated alerts")
+    group.add_argument("--scenario", default="mixed",
+                       choices=["mixed", "storm"])
+    group.add_argument("--clients", default=4, type=int,
+                       help="Number of concurrent clients")
+    group.add_argument("--rate", default=None, type=float,
+                       help="Target alerts per second over all clients")
+    group.add_argument("--count", default=None, type=int,
+                       help="Total number of alerts to send")
+    group.add_argument("--seconds", default=None, type=float,
+                       help="Run for this many seconds (default 10)")
+    group.add_argument("--hosts", default=100, type=int)
+    group.add_argument("--series", default=3, type=int,
+                       help="Max number of series per alert")
+    group.add_argument("--flap-rate", default=0.1, type=float,
+                       help="Share of alerts that flap")
+    group.add_argument("--ok-rate", default=0.3, type=float,
+                       help="Chance that an alerting alert recovers")
+    group.add_argument("--seed", default=None, type=int)
+    group.add_argument("--stubs", action="store_true",
+                       help="Start stub Slack, PagerDuty, JIRA and InfluxDB")
+    group.add_argument("--stubs-only", action="store_true",
+                       help="Only run the stub targets until Ctrl-C")
+    group.add_argument("--stub-port", default=9100, type=int,
+                       help="First of four ports used by the stubs")
+    group.add_argument("--settle", default=2.0, type=float,
+                       help="Seconds to wait for KAP before counting stubs")
     options = parser.parse_args()
-    run(options)
+    if options.load or options.stubs_only:
+        options.stubs = options.stubs or options.stubs_only
+        load(options)
+    else:
+        run(options)
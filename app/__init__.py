@@ -11,6 +11,8 @@ from config import Config
 
 app = Flask(__name__)
 app.config.from_object(Config)
+# Settings overriding config.py, e.g. to run several nodes on one host
+app.config.from_envvar('KAP_SETTINGS', silent=True)
 app.secret_key = app.config['SECRET_KEY']
 
 INSTALLDIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
@@ -28,4 +30,4 @@ _file_handler.setFormatter(_formatter)
 LOGGER.addHandler(_file_handler)
 LOGGER.setLevel(logging.DEBUG)
 
-from app import routes  # noqa
+from app import routes, api  # noqa
@@ -5,26 +5,137 @@ Module: alert.py
 Created: 17.Apr.2018
 Created by: Morten Hersson, <mhersson@gmail.com>
 '''
+import sys
 import hashlib
 
 
+def alert_hash(alertid):
+    return hashlib.sha256(alertid.encode()).hexdigest()
+
+
+def _intern(value):
+    # Tag keys and values repeat across alerts, keep one copy of each
+    return sys.intern(value) if value.__class__ is str else value
+
+
+class Tags():
+    """Immutable tags of an alert, built from key and value pairs. Keeps
+    every pair once, also keys repeated by multiple series, and looks up
+    the first value of a key in constant time"""
+    __slots__ = ('_pairs', '_index')
+
+    def __init__(self, pairs=()):
+        self._pairs = tuple((_intern(k), _intern(v))
+                            for k, v in dict.fromkeys(pairs))
+        # Built on first lookup
+        self._index = None
+
+    @classmethod
+    def from_list(cls, tags):
+        """Return Tags from a list of {'key': .., 'value': ..} dicts"""
+        return cls((t['key'], t['value']) for t in tags)
+
+    def _lookup(self):
+        if self._index is None:
+            # Reversed, so the first value of a key wins
+            self._index = dict(reversed(self._pairs))
+        return self._index
+
+    def get(self, key, default=None):
+        return self._lookup().get(key, default)
+
+    def __getitem__(self, key):
+        return self._lookup()[key]
+
+    def __contains__(self, key):
+        return key in self._lookup()
+
+    def __len__(self):
+        return len(self._pairs)
+
+    def __iter__(self):
+        return iter(dict.fromkeys(k for k, _ in self._pairs))
+
+    def items(self):
+        """Return all key and value pairs"""
+        return self._pairs
+
+    def to_list(self):
+        return [{'key': k, 'value': v} for k, v in self._pairs]
+
+    def __eq__(self, other):
+        return isinstance(other, Tags) and self._pairs == other._pairs
+
+    def __hash__(self):
+        return hash(self._pairs)
+
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        return self
+
+    def __repr__(self):
+        return "Tags({})".format(list(self._pairs))
+
+
 class Alert():
+    __slots__ = ('id', '_alhash', 'duration', 'message', 'level',
+                 'previouslevel', 'time', 'tags', 'pd_incident_key',
+                 'jira_issue', 'grafana_url', 'state_duration', 'sent')
+
     def __init__(self, alertid, duration, message,
                  level, previouslevel, alerttime, tags):
         self.id = alertid
-        self.alhash = hashlib.sha256(alertid.encode()).hexdigest()
+        self._alhash = None
         self.duration = duration
         self.message = message
-        self.level = level
-        self.previouslevel = previouslevel
+        self.level = _intern(level)
+        self.previouslevel = _intern(previouslevel)
         self.time = alerttime
-        self.tags = tags
+        self.tags = tags if isinstance(tags, Tags) else Tags.from_list(tags)
         self.pd_incident_key = None
         self.jira_issue = None
         self.grafana_url = None
         self.state_duration = False
         self.sent = False
 
+    @property
+    def alhash(self):
+        # Hashed on first use, many alerts are never looked up
+        if self._alhash is None:
+            self._alhash = alert_hash(self.id)
+        return self._alhash
+
+    def fields(self):
+        """Return the attributes by name, with the tags as a list"""
+        return {'id': self.id,
+                'alhash': self.alhash,
+                'duration': self.duration,
+                'message': self.message,
+                'level': self.level,
+                'previouslevel': self.previouslevel,
+                'time': self.time,
+                'tags': self.tags.to_list(),
+                'pd_incident_key': self.pd_incident_key,
+                'jira_issue': self.jira_issue,
+                'grafana_url': self.grafana_url,
+                'state_duration': self.state_duration,
+                'sent': self.sent}
+
+    def to_dict(self):
+        return {'id': self.id,
+                'hash': self.alhash,
+                'duration': self.duration,
+                'message': self.message,
+                'level': self.level,
+                'previouslevel': self.previouslevel,
+                'time': self.time,
+                'tags': self.tags.to_list(),
+                'pd_incident_key': self.pd_incident_key,
+                'jira_issue': self.jira_issue,
+                'grafana_url': self.grafana_url}
+
     def __repr__(self):
         return ("Alert(id={}, duration={}, message={}, level={}, "
                 "previouslevel={}, time={}, tags={}, "
@@ -0,0 +1,136 @@
+# vim:set shiftwidth=4 softtabstop=4 expandtab:
+'''
+Module: alertcache.py
+
+In-memory state of all active alerts. The cache is loaded from the
+active_alerts and active_alert_tags tables on first use, and
+DBController writes every change through to SQLite before updating it.
+
+Created: 18.Oct.2026
+'''
+import copy
+import threading
+
+from app import LOGGER
+
+# Columns kept for every active alert, in active_alerts table order
+FIELDS = ('time', 'id', 'message', 'previouslevel', 'level', 'duration',
+          'pagerduty', 'jira', 'grafana', 'state_duration', 'sent')
+
+_CACHES = {}
+_CACHES_LOCK = threading.Lock()
+
+
+def get_cache(db):
+    """Return the cache shared by all controllers using the database db"""
+    with _CACHES_LOCK:
+        if db not in _CACHES:
+            _CACHES[db] = ActiveAlertCache()
+        return _CACHES[db]
+
+
+class ActiveAlertCache():
+    """Map from alert hash to alert state and tags"""
+
+    def __init__(self):
+        self._alerts = {}
+        self._loaded = False
+        self._lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+        self.mismatches = 0
+
+    def ensure_loaded(self, loader):
+        if self._loaded:
+            return
+        with self._lock:
+            if not self._loaded:
+                self._alerts = loader()
+                self._loaded = True
+                LOGGER.info("Loaded %d active alerts into cache",
+                            len(self._alerts))
+
+    def invalidate(self):
+        LOGGER.info("Invalidating active alert cache")
+        with self._lock:
+            self._alerts = {}
+            self._loaded = False
+
+    def get(self, alhash):
+        with self._lock:
+            entry = self._alerts.get(alhash)
+            if entry is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return entry
+
+    def alerts(self):
+        with self._lock:
+            self.hits += 1
+            return [copy.deepcopy(x) for x in self._alerts.values()]
+
+    def activate(self, al):
+        entry = {'time': al.time, 'id': al.id, 'message': al.message,
+                 'previouslevel': al.previouslevel, 'level': al.level,
+                 'duration': al.duration, 'pagerduty': al.pd_incident_key,
+                 'jira': al.jira_issue, 'grafana': al.grafana_url,
+                 'state_duration': al.state_duration, 'sent': al.sent,
+                 'tags': al.tags}
+        with self._lock:
+            if self._loaded:
+                self._alerts[al.alhash] = entry
+
+    def update(self, al):
+        with self._lock:
+            entry = self._alerts.get(al.alhash)
+            if entry is None:
+                return
+            entry.update({'time': al.time, 'message': al.message,
+                          'previouslevel': al.previouslevel,
+                          'level': al.level, 'duration': al.duration,
+                          'pagerduty': al.pd_incident_key,
+                          'jira': al.jira_issue, 'grafana': al.grafana_url,
+                          'state_duration': al.state_duration,
+                          'sent': al.sent})
+
+    def set_keys(self, alhash, keys):
+        with self._lock:
+            entry = self._alerts.get(alhash)
+            if entry is not None:
+                entry.update(keys)
+
+    def deactivate(self, alhash):
+        with self._lock:
+            self._alerts.pop(alhash, None)
+
+    def verify(self, stored, alhash=None):
+        """Compare the cache with the alerts read from SQLite, and return
+        the hashes that differ. If alhash is given only that alert is
+        compared"""
+        with self._lock:
+            keys = [alhash] if alhash else set(stored) | set(self._alerts)
+            diff = [h for h in keys
+                    if _normalize(stored.get(h)) !=
+                    _normalize(self._alerts.get(h))]
+            if diff:
+                self.mismatches += len(diff)
+                LOGGER.error("Active alert cache is inconsistent for %s",
+                             ", ".join(diff))
+            return diff
+
+    def stats(self):
+        with self._lock:
+            return {'size': len(self._alerts), 'loaded': self._loaded,
+                    'hits': self.hits, 'misses': self.misses,
+                    'mismatches': self.mismatches}
+
+
+def _normalize(entry):
+    if entry is None:
+        return None
+    res = {k: entry[k] for k in FIELDS}
+    res['state_duration'] = bool(res['state_duration'])
+    res['sent'] = bool(res['sent'])
+    res['tags'] = sorted(entry['tags'].items())
+    return res
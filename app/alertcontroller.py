@@ -8,18 +8,33 @@ Created by: Morten Hersson, <mhersson@gmail.com>
 '''
 import os
 import re
+import copy
 import time
+import threading
 import subprocess
-from datetime import datetime
 
 from app import app, LOGGER
-from app.alert import Alert
+from app.alert import Alert, Tags
+from app.dispatch import get_dispatcher
+from app.events import publish
+from app.matcher import compile_rules, compile_exclusions
+from app.metrics import REGISTRY
+from app.payload import parse_time
 from app.targets.slack import Slack
 from app.targets.jira import Incident
 from app.targets.pagerduty import Pagerduty
 from app.dbcontroller import DBController
 from app.influxdbcontroller import InfluxDBController
 
+REQUIRED_KEYS = ('id', 'message', 'level', 'previousLevel',
+                 'time', 'duration', 'data')
+
+_CREATE_SECONDS = REGISTRY.histogram('kap_create_alert_seconds',
+                                     'Time spent creating alerts')
+_DISPATCH_SECONDS = REGISTRY.histogram('kap_dispatch_seconds',
+                                       'Time spent dispatching to targets',
+                                       ['target'])
+
 
 class AlertController():
     """Main controller class for all incoming alerts """
@@ -38,36 +53,220 @@ class AlertController():
                              password=app.config['JIRA_PASSWORD'],
                              project_key=app.config['JIRA_PROJECT_KEY'],
                              assignee=app.config['JIRA_ASSIGNEE'])
+        self._exclusions = {
+            'slack': compile_exclusions(app.config['SLACK_EXCLUDED_TAGS']),
+            'pagerduty': compile_exclusions(
+                app.config['PAGERDUTY_EXCLUDED_TAGS'],
+                app.config['PAGERDUTY_EXCLUDED_TICKS']),
+            'jira': compile_exclusions(app.config['JIRA_EXCLUDED_TAGS'])}
+        # Keys from targets missing their dispatch deadline, by alert hash,
+        # until the alert is stored
+        self._late_keys = {}
+        self._late_lock = threading.Lock()
+
+    @staticmethod
+    def valid_payload(content):
+        if not isinstance(content, dict):
+            return False
+        for key in REQUIRED_KEYS:
+            if key not in content:
+                LOGGER.error("Alert payload is missing %s", key)
+                return False
+        try:
+            parse_time(content['time'])
+        except ValueError:
+            LOGGER.error("Alert payload has invalid time %r", content['time'])
+            return False
+        if isinstance(content['duration'], bool) or \
+                not isinstance(content['duration'], (int, float)):
+            LOGGER.error("Alert payload has invalid duration %r",
+                         content['duration'])
+            return False
+        try:
+            return isinstance(content['data']['series'], list)
+        except (KeyError, TypeError):
+            LOGGER.error("Alert payload is missing data series")
+        return False
 
+    def handle_alert(self, content):
+        al = self.create_alert(content)
+        if al is None:
+            return
+        al = self._db.get_tickets_and_keys(al)
+        self.dispatch_and_update_status(al, dispatch=self.should_dispatch(al))
+
+    def should_dispatch(self, al):
+        """Decide if the targets are notified about the alert"""
+        if not al.grafana_url:
+            al.grafana_url = self.add_grafana_url(al)
+        LOGGER.info("Alert info:\n%s\n%s -> %s, Duration: %d\n"
+                    "State duration: %s, Sent: %s\nJIRA: %s, PD: %s",
+                    al.id, al.previouslevel, al.level, al.duration,
+                    al.state_duration, al.sent,
+                    al.jira_issue, al.pd_incident_key)
+        if al.sent:
+            if al.level != al.previouslevel:
+                LOGGER.info("State has changed, notify targets")
+                return True
+            LOGGER.info("No change, updating existing alert")
+            return False
+        if (app.config['FLAPPING_DETECTION_ENABLED'] and
+                self._db.is_flapping(al)):
+            LOGGER.info("Alert is flapping")
+            al.message = "Flapping! " + al.message
+            return False
+        if al.state_duration:
+            LOGGER.info("Alert delayed by state duration, no dispatch")
+            return False
+        if al.duration < app.config['ALERTING_DELAY']:
+            LOGGER.info("Alert delayed, no dispatch")
+            return False
+        if al.level == 'OK':
+            LOGGER.info("Alert OK without being sent, no dispatch")
+            return False
+        LOGGER.info("New alert, notify targets")
+        return True
+
+    def handle_batch(self, contents):
+        """Handle a list of alert payloads like handle_alert, in order,
+        and write all changes to the active alerts and the log in one
+        transaction. Targets are notified after the write. Returns a
+        result for every payload"""
+        results = []
+        # The state of every alert in the batch, None when not active,
+        # and if it was active before the batch
+        state = {}
+        was_active = {}
+        deactivated = set()
+        events = []
+        log = []
+        # Every alert in the batch, and if it is dispatched
+        alerts = []
+        mrules = None
+        for content in contents:
+            try:
+                al = self.create_alert(content) \
+                    if self.valid_payload(content) else False
+            except (KeyError, TypeError, ValueError, AttributeError):
+                LOGGER.exception("Invalid alert payload in batch")
+                al = False
+            if al is False:
+                results.append({'Success': False, 'error': "Invalid payload"})
+                continue
+            if al is None:
+                results.append({'Success': True, 'id': content['id'],
+                                'event': 'suppressed'})
+                continue
+            if al.alhash not in state:
+                was_active[al.alhash] = self._db.is_active(al)
+                al = self._db.get_tickets_and_keys(al)
+                active = was_active[al.alhash]
+            else:
+                current = state[al.alhash]
+                active = current is not None
+                if active:
+                    al.grafana_url = current.grafana_url
+                    al.sent = current.sent
+                    al.pd_incident_key = current.pd_incident_key
+                    al.jira_issue = current.jira_issue
+            dispatch = False
+            if self.should_dispatch(al):
+                if mrules is None:
+                    mrules = self._db.get_active_maintenance_rules()
+                if self.affected_by_mrules(mrules, al):
+                    LOGGER.info("Alert is in maintenance, no notifications "
+                                "sent")
+                else:
+                    al.sent = dispatch = True
+            alerts.append((al, dispatch, active))
+            event = None
+            if al.level != 'OK':
+                event = 'update' if active else 'activate'
+            elif active:
+                event = 'deactivate'
+                deactivated.add(al.alhash)
+            state[al.alhash] = al if al.level != 'OK' else None
+            if al.level != al.previouslevel:
+                log.append(al)
+            events.append((event, al))
+            results.append({'Success': True, 'id': al.id,
+                            'hash': al.alhash, 'event': event})
+        activate = []
+        update = []
+        deactivate = []
+        for alhash, al in state.items():
+            if al is None:
+                if was_active[alhash]:
+                    deactivate.append(alhash)
+            elif not was_active[alhash]:
+                activate.append(al)
+            elif alhash in deactivated:
+                # Deleted and inserted, as its tags may have changed
+                deactivate.append(alhash)
+                activate.append(al)
+            else:
+                update.append(al)
+        written = {id(al): (al.pd_incident_key, al.jira_issue)
+                   for al, _, _ in alerts}
+        self._db.apply_batch(activate, update, deactivate, log)
+        self._dispatch_batch(alerts)
+        for al in activate + update:
+            if (al.pd_incident_key, al.jira_issue) != written[id(al)]:
+                self._db.set_alert_keys(al.alhash,
+                                        pagerduty=al.pd_incident_key,
+                                        jira=al.jira_issue)
+        self._db.set_log_keys([al for al in log if (
+            al.pd_incident_key, al.jira_issue) != written[id(al)]])
+        for event, al in events:
+            if event:
+                publish(event, al.to_dict())
+            self._influx.update(al)
+        return results
+
+    def _dispatch_batch(self, alerts):
+        """Dispatch the alerts of a stored batch in order. The incident
+        keys and issues set by the targets are passed on to the later
+        alerts with the same hash, while it is active"""
+        keys = {}
+        for al, dispatch, active in alerts:
+            if active and al.alhash in keys:
+                al.pd_incident_key, al.jira_issue = keys[al.alhash]
+            if dispatch:
+                self.dispatch(al)
+            keys[al.alhash] = (al.pd_incident_key, al.jira_issue)
+
+    @_CREATE_SECONDS.time()
     def create_alert(self, content):
         LOGGER.info("Creating alert")
         tags = []
         for s in content['data']['series']:
             try:
-                tags.extend([{'key': k, 'value': v}
-                             for k, v in s['tags'].items()])
+                tags.extend(s['tags'].items())
             except KeyError:
                 continue
 
+        if app.config['AWS_API_ENABLED']:
+            tags = [{'key': k, 'value': v} for k, v in tags]
+            suppress, modified_tags = self.check_instance_tags(tags)
+            if suppress:
+                return None
+            if modified_tags:
+                tags = modified_tags
+            tags = Tags.from_list(tags)
+
+        # Series of one alert mostly share their tags, Tags keeps each once
         al = Alert(alertid=content['id'],
                    duration=content['duration'] // (10 ** 9),
                    message=content['message'], level=content['level'],
                    previouslevel=content['previousLevel'],
-                   alerttime=self.datestr_to_timestamp(
-                       datestr=content['time']),
-                   tags=tags)
+                   # Stored as whole seconds, like the log always was
+                   alerttime=int(parse_time(content['time'])),
+                   tags=tags if isinstance(tags, Tags) else Tags(tags))
 
         for key in app.config['STATE_DURATION']:
             if al.id.find(key) != -1:
                 if al.duration < app.config['STATE_DURATION'][key]:
                     al.state_duration = True
-
-        if app.config['AWS_API_ENABLED']:
-            suppress, modified_tags = self.check_instance_tags(tags)
-            if suppress:
-                return None
-            if modified_tags:
-                al.tags = modified_tags
         return al
 
     def check_instance_tags(self, instance_tags):
@@ -135,50 +334,105 @@ class AlertController():
 
     def dispatch_and_update_status(self, al, dispatch=True):
         if dispatch:
-            LOGGER.info("Dispatch to all targets")
-            mrules = self._db.get_active_maintenance_rules()
-            if not self.affected_by_mrules(mrules, al):
-                al.sent = True
-                self.run_slack(al)
-                al.pd_incident_key = self.run_pagerduty(al)
-                al.jira_issue = self.run_jira(al)
-            else:
-                LOGGER.info("Alert is in maintenance, no notifications sent")
+            self.notify(al)
         self.update_active_alerts(al)
         self._influx.update(al)
 
+    def notify(self, al):
+        LOGGER.info("Dispatch to all targets")
+        mrules = self._db.get_active_maintenance_rules()
+        if not self.affected_by_mrules(mrules, al):
+            al.sent = True
+            self.dispatch(al)
+        else:
+            LOGGER.info("Alert is in maintenance, no notifications sent")
+
+    def dispatch(self, al):
+        if not app.config['DISPATCH_PARALLEL']:
+            self.run_slack(al)
+            al.pd_incident_key = self.run_pagerduty(al)
+            al.jira_issue = self.run_jira(al)
+            return
+        # Every target gets its own copy, as they set keys on the alert
+        copies = {t: copy.copy(al) for t in ('slack', 'pagerduty', 'jira')}
+        res = get_dispatcher().run(
+            {'slack': lambda: self.run_slack(copies['slack']),
+             'pagerduty': lambda: self.run_pagerduty(copies['pagerduty']),
+             'jira': lambda: self.run_jira(copies['jira'])},
+            default={'pagerduty': al.pd_incident_key,
+                     'jira': al.jira_issue},
+            on_late=lambda target, key: self._save_late_key(al, target, key))
+        al.pd_incident_key = res['pagerduty']
+        al.jira_issue = res['jira']
+
+    def _save_late_key(self, al, target, key):
+        if target == 'pagerduty' and key != al.pd_incident_key:
+            keys = {'pagerduty': key}
+        elif target == 'jira' and key != al.jira_issue:
+            keys = {'jira': key}
+        else:
+            return
+        # The alert may not be stored yet. The keys are kept before the
+        # update, so either it finds the alert, or update_active_alerts
+        # finds the keys after storing it
+        with self._late_lock:
+            self._late_keys.setdefault(al.alhash, {}).update(keys)
+        if self._db.set_alert_keys(al.alhash, **keys):
+            with self._late_lock:
+                pending = self._late_keys.get(al.alhash, {})
+                for k, v in keys.items():
+                    if pending.get(k) == v:
+                        del pending[k]
+                if not pending:
+                    self._late_keys.pop(al.alhash, None)
+
+    def _save_pending_keys(self, al):
+        with self._late_lock:
+            keys = self._late_keys.pop(al.alhash, None)
+        if keys and al.level != 'OK':
+            self._db.set_alert_keys(al.alhash, **keys)
+
+    def influx_stats(self):
+        return self._influx.stats()
+
     def update_active_alerts(self, al):
-        alert_is_active = self._db.is_active(al)
-        if al.level != 'OK' and alert_is_active:
-            self._db.update_alert(al)
-        elif al.level != 'OK' and not alert_is_active:
-            self._db.activate_alert(al)
-        elif al.level == 'OK' and alert_is_active:
-            self._db.deactivate_alert(al)
-        if al.level != al.previouslevel:
-            self._db.log_alert(al)
+        event = None
+        with self._db.transaction():
+            alert_is_active = self._db.is_active(al)
+            if al.level != 'OK' and alert_is_active:
+                self._db.update_alert(al)
+                event = 'update'
+            elif al.level != 'OK' and not alert_is_active:
+                self._db.activate_alert(al)
+                event = 'activate'
+            elif al.level == 'OK' and alert_is_active:
+                self._db.deactivate_alert(al)
+                event = 'deactivate'
+            if al.level != al.previouslevel:
+                self._db.log_alert(al)
+        self._save_pending_keys(al)
+        if event:
+            publish(event, al.to_dict())
 
+    @_DISPATCH_SECONDS.labels('slack').time()
     def run_slack(self, al):
         if app.config['SLACK_ENABLED']:
-            if not self.contains_excluded_tags(
-                    app.config['SLACK_EXCLUDED_TAGS'], al.tags):
+            if not self.excluded('slack', al):
                 self.slack.post(al)
 
+    @_DISPATCH_SECONDS.labels('pagerduty').time()
     def run_pagerduty(self, al):
         if app.config['PAGERDUTY_ENABLED']:
-            if self.contains_excluded_tags(
-                    app.config['PAGERDUTY_EXCLUDED_TAGS'], al.tags):
-                return al.pd_incident_key
-            if self.excluded_tick(al, app.config['PAGERDUTY_EXCLUDED_TICKS']):
+            if self.excluded('pagerduty', al):
                 return al.pd_incident_key
             al.pd_incident_key = self.pagerduty.post(al)
             LOGGER.info("Pagerduty incident key: %s", al.pd_incident_key)
         return al.pd_incident_key
 
+    @_DISPATCH_SECONDS.labels('jira').time()
     def run_jira(self, al):
         if app.config['JIRA_ENABLED']:
-            if self.contains_excluded_tags(
-                    app.config['JIRA_EXCLUDED_TAGS'], al.tags):
+            if self.excluded('jira', al):
                 return al.jira_issue
             al.jira_issue = self.jira.post(al)
             LOGGER.info("JIRA issue: %s", al.jira_issue)
@@ -206,10 +460,8 @@ class AlertController():
             else:
                 starttime = int(time.time() - 86400) * 1000
                 stoptime = int(time.time()) * 1000
-            urlvars = []
-            for var in app.config['GRAFANA_URL_VARS']:
-                urlvars.extend(
-                    [tag['value'] for tag in al.tags if tag['key'] == var])
+            urlvars = [al.tags[var] for var in app.config['GRAFANA_URL_VARS']
+                       if var in al.tags]
             if len(urlvars) != len(app.config['GRAFANA_URL_VARS']):
                 LOGGER.error("Failed setting Grafana url, missing variables")
                 return None
@@ -222,18 +474,20 @@ class AlertController():
         LOGGER.info("Checking for stale alerts from terminated instances")
         # Remove old stale alerts from terminated instances
         for al in self._db.get_active_alerts():
-            x = [tag['value'] for tag in al.tags if tag['key'] == 'host']
-            if not x:
+            host = al.tags.get('host')
+            if host is None:
                 # Alert does not have host tag set, nothing to do
                 continue
             else:
-                if not (x[0] in aws_instances and
-                        aws_instances[x[0]]['state'] in [16, 64, 80]):
+                if not (host in aws_instances and
+                        aws_instances[host]['state'] in [16, 64, 80]):
                     LOGGER.info(
                         "Stale alert found, host not in aws instance list")
                     LOGGER.info("Removing stale alert")
-                    self._db.deactivate_alert(al)
-                    self._db.log_alert(al)
+                    with self._db.transaction():
+                        self._db.deactivate_alert(al)
+                        self._db.log_alert(al)
+                    publish('deactivate', al.to_dict())
                     self._influx.delete_active(al)
                     LOGGER.info(
                         "Cleaning up existing Pagerduty or JIRA tickets")
@@ -251,50 +505,28 @@ class AlertController():
                 (al.jira_issue is not None or al.pd_incident_key is not None)):
             LOGGER.info(
                 "Running maintenance override to clear existing ticket")
-        else:
-            for mrule in mrules:
-                mrv = mrule['value']
-                v = [tag['value']
-                     for tag in al.tags if tag['key'] == mrule['key']]
-                if mrv in v:
-                    return True
-                if mrv[0] == '*' and v[0].endswith(mrv[1:]):
-                    return True
-                if mrv[-1] == '*' and v[0].startswith(mrv[:-1]):
-                    return True
-                if mrule['key'] == 'id':
-                    if mrule['value'] in al.id:
-                        return True
+        elif compile_rules(mrules).matches(al):
+            return True
         return False
 
-    @staticmethod
-    def contains_excluded_tags(excluded, tags):
-        x = [t for t in tags if t in excluded]
-        if x:
-            LOGGER.info("One or more tags in exclude list: %s", str(x))
+    def excluded(self, target, al):
+        """Check the alert against the exclude lists of target"""
+        exclusions = self._exclusions[target]
+        tag = exclusions.excluded_tag(al.tags)
+        if tag:
+            LOGGER.info("Tag in %s exclude list: %s", target, tag)
+            return True
+        tn = exclusions.excluded_tick(al.id)
+        if tn:
+            LOGGER.info("Tick %s is excluded", tn)
             return True
-        # MonGroup is a special tag we use
-        # that can have mulitple pipe separated values
-        x = [t['value'] for t in excluded if t['key'] == 'MonGroup']
-        if x:
-            # There is a MonGroup in the exclude list, so get tag MonGroup
-            y = [t['value'] for t in tags if t['key'] == 'MonGroup']
-            if y:
-                # y should always have length 1 here if exists
-                # Split the value and
-                # create a new list to compare with the exclude list
-                if not set(x).isdisjoint(y[0].split("|")):
-                    LOGGER.info("Excluded MonGroup: %s", y[0])
-                    return True
         return False
 
     @staticmethod
-    def excluded_tick(al, excluded_ticks):
-        # This only works if {{ .TaskName }} is the last element of the al.id
-        LOGGER.info("Check for excluded tick script")
-        tn = al.id.split()[-1]
-        if tn in excluded_ticks:
-            LOGGER.info("Tick %s is excluded", tn)
+    def contains_excluded_tags(excluded, tags):
+        tag = compile_exclusions(excluded).excluded_tag(tags)
+        if tag:
+            LOGGER.info("Tag in exclude list: %s", tag)
             return True
         return False
 
@@ -333,12 +565,3 @@ class AlertController():
             instance_status[x[0]] = s
         return instance_status
 
-    @staticmethod
-    def datestr_to_timestamp(datestr):
-        m = re.match(
-            "20[0-9]{2}-[0-2][0-9]-[0-3][0-9]T[0-2][0-9](:[0-5][0-9]){2}",
-            datestr)
-        if m:
-            return datetime.timestamp(
-                datetime.strptime(m.group(0), '%Y-%m-%dT%H:%M:%S'))
-        return None
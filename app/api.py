@@ -0,0 +1,136 @@
+# vim:set shiftwidth=4 softtabstop=4 expandtab:
+'''
+Module: api.py
+
+JSON API for active alerts, maintenance and the alert log. Every
+response carries an ETag built from the state version, which changes on
+any change to alerts or maintenance, so pollers sending If-None-Match
+get a 304 without the database being read. Use ?fields=a,b to return
+only some of the fields of each item.
+
+Created: 18.Oct.2026
+'''
+import time
+import json
+import uuid
+import functools
+import threading
+from flask import Response, request, jsonify
+from app import app
+from app.dbcontroller import state_version, LOG_FILTERS
+from app.routes import alertcontroller, db
+
+# The state version restarts on every boot, unless it is kept in the
+# database and shared by several processes
+_BOOT = 'db' if app.config['MULTI_PROCESS'] else uuid.uuid4().hex[:8]
+
+# Rendered bodies per URL, valid as long as the state version is unchanged
+_BODIES = {}
+_BODIES_LOCK = threading.Lock()
+_BODIES_MAX = 256
+
+
+def _etag(version):
+    return "{}-{}".format(_BOOT, version)
+
+
+def _select(items, fields):
+    if not fields:
+        return items
+    return [{k: v for k, v in i.items() if k in fields} for i in items]
+
+
+def cached(func):
+    """Serve func as JSON with an ETag, and answer If-None-Match with
+    304 while the state version is unchanged"""
+    @functools.wraps(func)
+    def wrapper():
+        version = state_version()
+        etag = _etag(version)
+        if request.if_none_match.contains(etag):
+            resp = Response(status=304)
+            resp.set_etag(etag)
+            return resp
+        key = request.full_path
+        with _BODIES_LOCK:
+            body = _BODIES.get(key)
+        if body is None or body[0] != version:
+            body = (version, json.dumps(func()))
+            with _BODIES_LOCK:
+                if len(_BODIES) >= _BODIES_MAX:
+                    _BODIES.clear()
+                _BODIES[key] = body
+        resp = Response(body[1], mimetype='application/json')
+        resp.set_etag(etag)
+        return resp
+    return wrapper
+
+
+def _fields():
+    fields = request.args.get('fields')
+    if not fields:
+        return None
+    return set(f.strip() for f in fields.split(","))
+
+
+@app.route("/kap/api/v1/alerts", methods=['GET'])
+@cached
+def api_alerts():
+    alerts = [a.to_dict() for a in db.get_active_alerts()]
+    return {'alerts': _select(alerts, _fields())}
+
+
+@app.route("/kap/api/v1/alerts/maintenance", methods=['GET'])
+@cached
+def api_alerts_in_maintenance():
+    mrules = db.get_active_maintenance_rules()
+    alerts = [a.to_dict() for a in db.get_active_alerts()
+              if alertcontroller.affected_by_mrules(mrules=mrules, al=a)]
+    return {'alerts': _select(alerts, _fields())}
+
+
+@app.route("/kap/api/v1/maintenance/rules", methods=['GET'])
+@cached
+def api_maintenance_rules():
+    return {'rules': _select(db.get_active_maintenance_rules(), _fields())}
+
+
+@app.route("/kap/api/v1/maintenance/schedules", methods=['GET'])
+@cached
+def api_maintenance_schedules():
+    return {'schedules': _select(db.get_maintenance_schedule(), _fields())}
+
+
+@app.route("/kap/api/v1/log", methods=['GET'])
+def api_log():
+    filters = {k: request.args.get(k) for k in LOG_FILTERS
+               if request.args.get(k)}
+    try:
+        hours = min(int(request.args.get('hours', 12)), 24 * 7)
+        limit = min(int(request.args.get('limit', 0)) or
+                    app.config['LOG_PAGE_SIZE'], 10000)
+        before = request.args.get('before')
+        if before:
+            t, h = before.split(":", 1)
+            before = (float(t), h)
+    except ValueError:
+        return jsonify(Success=False), 400
+    # The log window moves with time, so the ETag is only valid for the
+    # current minute
+    etag = "{}-{}".format(_etag(state_version()), int(time.time() // 60))
+    if request.if_none_match.contains(etag):
+        resp = Response(status=304)
+        resp.set_etag(etag)
+        return resp
+    records = []
+    nxt = None
+    for r in db.iter_log_records(hours, filters, before, limit + 1):
+        if len(records) == limit:
+            last = records[-1]
+            nxt = "{}:{}".format(last['time'], last['hash'])
+            break
+        records.append({'time': r[0], 'id': r[1], 'previouslevel': r[2],
+                        'level': r[3], 'environment': r[4], 'hash': r[5]})
+    resp = jsonify(records=_select(records, _fields()), next=nxt)
+    resp.set_etag(etag)
+    return resp
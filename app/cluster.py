@@ -0,0 +1,230 @@
+# vim:set shiftwidth=4 softtabstop=4 expandtab:
+'''
+Module: cluster.py
+
+Clustering of several KAP nodes behind a load balancer. Every alert is
+owned by one node, picked by consistent hashing of the alert hash over
+the nodes that are up. Alerts posted to any other node are forwarded to
+the owner, so the state of an alert, and the notifications sent for it,
+live on one node only. Batches are split by owner, and forwarded with one
+batch request per node.
+
+Nodes are health checked, and with CLUSTER_FAILOVER a node that fails a
+check, or cannot be connected to on a forward, is taken out of the ring
+until it answers again. Only the alerts owned by that node move. The new
+owner has no record of the notifications the old owner sent, so active
+alerts that move are notified again, and may get a second JIRA issue.
+Without CLUSTER_FAILOVER the ring never changes, and alerts owned by a
+node that is down are refused with 503.
+
+A forward is sent once. When the owner was reached but did not answer in
+time, it may still handle the alert, so it is not sent to another node.
+
+Created: 18.Oct.2026
+'''
+import json
+import bisect
+import hashlib
+import threading
+
+import requests
+
+from app import app, LOGGER
+from app.metrics import REGISTRY
+from app.targets.session import get_target, not_sent
+
+# Set on forwarded alerts, the receiving node handles them itself
+FORWARDED_HEADER = 'X-KAP-Forwarded'
+
+_FORWARDS = REGISTRY.counter('kap_cluster_forwards_total',
+                             'Alerts forwarded to the owning node',
+                             ['result'])
+_FORWARDED = _FORWARDS.labels('forwarded')
+_FORWARD_FAILED = _FORWARDS.labels('failed')
+
+
+class ForwardError(Exception):
+    """The owner of an alert did not answer a forward"""
+
+
+_CLUSTER = {'cluster': None}
+_CLUSTER_LOCK = threading.Lock()
+
+
+def get_cluster():
+    """Return the cluster membership of this node"""
+    with _CLUSTER_LOCK:
+        if _CLUSTER['cluster'] is None:
+            me = app.config['CLUSTER_SELF'] or "http://{}:{}".format(
+                app.config['SERVER_FQDN'], app.config['SERVER_PORT'])
+            _CLUSTER['cluster'] = Cluster(
+                app.config['CLUSTER_NODES'], me,
+                vnodes=app.config['CLUSTER_VNODES'],
+                interval=app.config['CLUSTER_HEALTH_INTERVAL'],
+                failover=app.config['CLUSTER_FAILOVER'])
+        return _CLUSTER['cluster']
+
+
+def _point(key):
+    return int(hashlib.sha256(key.encode()).hexdigest()[:16], 16)
+
+
+def _succeeded(res, count):
+    """Return if each of the count alerts in the batch response res was
+    handled"""
+    try:
+        results = res.json()['results']
+    except (ValueError, KeyError, TypeError):
+        results = None
+    if res.status_code >= 300 or not isinstance(results, list) or \
+            len(results) != count:
+        return [res.status_code < 300] * count
+    return [bool(isinstance(r, dict) and r.get('Success')) for r in results]
+
+
+class HashRing():
+    """Consistent hash ring with vnodes points per node"""
+
+    def __init__(self, nodes, vnodes=160):
+        points = sorted((_point("{}#{}".format(n, i)), n)
+                        for n in nodes for i in range(vnodes))
+        self._keys = [p for p, _ in points]
+        self._nodes = [n for _, n in points]
+
+    def get(self, alhash):
+        if not self._keys:
+            return None
+        i = bisect.bisect(self._keys, int(alhash[:16], 16))
+        return self._nodes[i % len(self._nodes)]
+
+
+class Cluster():
+    def __init__(self, nodes, me, vnodes=160, interval=5, failover=True):
+        self.me = me.rstrip('/')
+        self._nodes = [n.rstrip('/') for n in nodes]
+        if self.me not in self._nodes:
+            self._nodes.append(self.me)
+        self._vnodes = vnodes
+        self._interval = interval
+        self._failover = failover
+        self._up = set(self._nodes)
+        self._ring = HashRing(sorted(self._up), vnodes)
+        self._lock = threading.Lock()
+        self._http = get_target('cluster')
+        self._stop = threading.Event()
+        self._thread = None
+
+    def owner(self, alhash):
+        return self._ring.get(alhash)
+
+    def _set_up(self, node, up):
+        with self._lock:
+            if (node in self._up) == up:
+                return
+            if up:
+                self._up.add(node)
+            else:
+                self._up.discard(node)
+            if self._failover:
+                self._ring = HashRing(sorted(self._up), self._vnodes)
+        LOGGER.warning("Cluster node %s is %s, %d of %d nodes up", node,
+                       "up" if up else "down", len(self._up),
+                       len(self._nodes))
+
+    def forward(self, alhash, body):
+        """Forward the alert body to the node owning alhash, and return
+        its response. Returns None when this node is the owner, raises
+        ForwardError when the owner did not answer"""
+        for _ in range(len(self._nodes)):
+            owner = self.owner(alhash)
+            if owner is None or owner == self.me:
+                return None
+            try:
+                res = self._http.post(
+                    owner + "/kap/alert", data=body, raise_errors=True,
+                    headers={'Content-Type': 'application/json',
+                             FORWARDED_HEADER: self.me})
+            except requests.exceptions.RequestException as err:
+                _FORWARD_FAILED.inc()
+                if not (self._failover and not_sent(err)):
+                    # The owner may have the alert, another node
+                    # handling it too would notify twice
+                    raise ForwardError(owner) from err
+                # The owner is gone, try the next owner on the ring
+                self._set_up(owner, False)
+                continue
+            _FORWARDED.inc()
+            return res
+        return None
+
+    def forward_batch(self, items):
+        """Forward alert payloads to their owners, with one batch request
+        per node. items is a list of (alhash, content). Returns a result
+        for every item, None for those owned by this node"""
+        results = [None] * len(items)
+        pending = list(range(len(items)))
+        for _ in range(len(self._nodes)):
+            nodes = {}
+            for i in pending:
+                owner = self.owner(items[i][0])
+                if owner is not None and owner != self.me:
+                    nodes.setdefault(owner, []).append(i)
+            pending = []
+            for owner, indexes in nodes.items():
+                try:
+                    res = self._http.post(
+                        owner + "/kap/alerts/batch", raise_errors=True,
+                        data=json.dumps([items[i][1] for i in indexes]),
+                        headers={'Content-Type': 'application/json',
+                                 FORWARDED_HEADER: self.me})
+                except requests.exceptions.RequestException as err:
+                    _FORWARD_FAILED.inc(len(indexes))
+                    if self._failover and not_sent(err):
+                        # The owner is gone, try the next owners
+                        self._set_up(owner, False)
+                        pending.extend(indexes)
+                        continue
+                    # The owner may have the alerts, see forward
+                    for i in indexes:
+                        results[i] = {'Success': False,
+                                      'id': items[i][1]['id'],
+                                      'event': 'forward_failed'}
+                    continue
+                _FORWARDED.inc(len(indexes))
+                for i, ok in zip(indexes, _succeeded(res, len(indexes))):
+                    results[i] = {'Success': ok, 'id': items[i][1]['id'],
+                                  'event': 'forwarded'}
+            if not pending:
+                break
+        return results
+
+    def check(self):
+        for node in self._nodes:
+            if node == self.me:
+                continue
+            res = self._http.get(node + "/kap/cluster")
+            self._set_up(node, res is not None and res.status_code == 200)
+
+    def _run(self):
+        while not self._stop.wait(self._interval):
+            self.check()
+
+    def start(self):
+        LOGGER.info("Starting cluster node %s of %s", self.me,
+                    ", ".join(self._nodes))
+        self._thread = threading.Thread(target=self._run,
+                                        name="cluster-health", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+
+    def stats(self):
+        with self._lock:
+            up = sorted(self._up)
+        return {'me': self.me, 'nodes': self._nodes, 'up': up,
+                'failover': self._failover,
+                'forwarded': _FORWARDED.value(),
+                'failed': _FORWARD_FAILED.value()}
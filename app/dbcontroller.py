@@ -8,9 +8,182 @@ Created by: Morten Hersson, <mhersson@gmail.com>
 '''
 import os
 import time
+import uuid
 import sqlite3
+import threading
+from contextlib import contextmanager
 from app import app, INSTALLDIR, LOGGER
-from app.alert import Alert
+from app.alert import Alert, Tags
+from app.alertcache import FIELDS, get_cache
+from app.events import publish
+from app.flapcounter import get_flap_counter
+from app.metrics import REGISTRY
+
+# Connections borrowed by the current thread, per database file
+_LOCAL = threading.local()
+
+_POOLS = {}
+_POOLS_LOCK = threading.Lock()
+
+# Version of the alert and maintenance state, bumped on every change.
+# expires is the first time a maintenance rule runs out, which changes
+# the state without any write. With MULTI_PROCESS the version is kept in
+# the kap_state table instead, so all processes share it
+_STATE = {'version': 0, 'expires': float('inf')}
+_STATE_LOCK = threading.Lock()
+
+
+def get_pool(db):
+    """Return the connection pool of the database file db"""
+    with _POOLS_LOCK:
+        if db not in _POOLS:
+            _POOLS[db] = ConnectionPool(db, app.config['SQLITE_POOL_SIZE'],
+                                        app.config['SQLITE_POOL_TIMEOUT'])
+        return _POOLS[db]
+
+
+def _borrowed():
+    if not hasattr(_LOCAL, 'borrowed'):
+        _LOCAL.borrowed = {}
+    return _LOCAL.borrowed
+
+
+class ConnectionPool():
+    """Up to size open connections to one database file, shared by all
+    threads. Threads borrow a connection for one query or transaction and
+    give it back, so threads started per request reuse the connections
+    instead of opening their own"""
+
+    def __init__(self, db, size, timeout):
+        self.db = db
+        self._timeout = timeout
+        self._slots = threading.BoundedSemaphore(size)
+        self._idle = []
+        self._lock = threading.Lock()
+        self._size = size
+        self.opened = 0
+
+    def _open(self):
+        con = sqlite3.connect(self.db, check_same_thread=False)
+        con.execute("PRAGMA busy_timeout = %d" %
+                    app.config['SQLITE_BUSY_TIMEOUT'])
+        con.execute("PRAGMA journal_mode = %s" %
+                    app.config['SQLITE_JOURNAL_MODE'])
+        con.execute("PRAGMA synchronous = %s" %
+                    app.config['SQLITE_SYNCHRONOUS'])
+        con.execute("PRAGMA cache_size = %d" %
+                    app.config['SQLITE_CACHE_SIZE'])
+        con.execute("PRAGMA mmap_size = %d" %
+                    app.config['SQLITE_MMAP_SIZE'])
+        return con
+
+    def get(self):
+        """Return an idle connection, or open a new one. Waits for a
+        connection to be given back when size of them are in use"""
+        if not self._slots.acquire(timeout=self._timeout):
+            raise sqlite3.OperationalError(
+                "All {} connections to {} are in use".format(self._size,
+                                                             self.db))
+        with self._lock:
+            if self._idle:
+                return self._idle.pop()
+        try:
+            con = self._open()
+        except Exception:
+            self._slots.release()
+            raise
+        with self._lock:
+            self.opened += 1
+        return con
+
+    def put(self, con):
+        if con.in_transaction:
+            con.rollback()
+        with self._lock:
+            self._idle.append(con)
+        self._slots.release()
+
+    def close(self):
+        """Close the idle connections"""
+        with self._lock:
+            idle, self._idle = self._idle, []
+            self.opened -= len(idle)
+        for con in idle:
+            con.close()
+
+    def stats(self):
+        with self._lock:
+            return {'size': self._size, 'open': self.opened,
+                    'idle': len(self._idle)}
+
+
+def state_version():
+    if app.config['MULTI_PROCESS']:
+        return DBController().select("SELECT version FROM kap_state")[0]
+    with _STATE_LOCK:
+        if time.time() > _STATE['expires']:
+            _STATE['version'] += 1
+            _STATE['expires'] = float('inf')
+        return _STATE['version']
+
+
+def _state_changed(expires=None):
+    if app.config['MULTI_PROCESS']:
+        DBController().execute_query(
+            "UPDATE kap_state SET version = version + 1")
+        return
+    with _STATE_LOCK:
+        _STATE['version'] += 1
+        if expires is not None:
+            _STATE['expires'] = min(_STATE['expires'], expires)
+
+
+_ACTIVATE_QUERY = ("INSERT INTO active_alerts (hash, time, id, message,"
+                   "previouslevel, level, duration, pagerduty, jira, grafana, "
+                   "state_duration, sent) VALUES(?, ?, ?, ?, ?, ?, ? ,? , "
+                   "?, ?, ?, ?)")
+_TAGS_QUERY = ("INSERT OR IGNORE INTO active_alert_tags "
+               "(hash, key, value) VALUES (?, ?, ?)")
+_UPDATE_QUERY = ("UPDATE active_alerts set time = ? ,message = ?, "
+                 "previouslevel = ?, level = ?, duration = ?,"
+                 "pagerduty = ?, jira = ?, grafana = ?, state_duration = ?,"
+                 "sent = ? where hash = ?")
+_LOG_QUERY = ("INSERT OR IGNORE INTO alert_log(hash, time, id, "
+              "message, previouslevel, level, environment, host, duration, "
+              "pagerduty, jira) VALUES( ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)")
+
+
+def _activate_values(al):
+    return (al.alhash, al.time, al.id, al.message,
+            al.previouslevel, al.level, al.duration,
+            al.pd_incident_key, al.jira_issue, al.grafana_url,
+            al.state_duration, al.sent)
+
+
+def _update_values(al):
+    return (al.time, al.message,
+            al.previouslevel, al.level, al.duration,
+            al.pd_incident_key, al.jira_issue, al.grafana_url,
+            al.state_duration, al.sent, al.alhash)
+
+
+def _log_values(al):
+    return (al.alhash, al.time, al.id, al.message, al.previouslevel,
+            al.level, al.tags.get('Environment'), al.tags.get('host'),
+            al.duration, al.pd_incident_key, al.jira_issue)
+
+
+def _rollup_key(al):
+    return (int(al.time) // 60 * 60, al.id, al.tags.get('Environment') or '',
+            al.previouslevel, al.level)
+
+
+_QUERY_SECONDS = REGISTRY.histogram('kap_db_query_seconds',
+                                    'Latency of SQLite queries',
+                                    ['operation'])
+_SELECT_SECONDS = _QUERY_SECONDS.labels('select')
+_EXECUTE_SECONDS = _QUERY_SECONDS.labels('execute')
+_EXECUTE_MANY_SECONDS = _QUERY_SECONDS.labels('execute_many')
 
 
 class DBController():
@@ -20,53 +193,191 @@ class DBController():
 
     def __init__(self):
         super(DBController, self).__init__()
-        self.db = os.path.join(INSTALLDIR, 'db/kap.db')
+        self.db = os.path.join(INSTALLDIR, app.config['DATABASE_FILE'])
         self.flapping_window = app.config['FLAPPING_WINDOW']
+        # The in-memory state can not be shared between processes
+        multi = app.config['MULTI_PROCESS']
+        self._cache = None
+        if app.config['ACTIVE_ALERT_CACHE_ENABLED'] and not multi:
+            self._cache = get_cache(self.db)
+        self._flaps = None
+        if app.config['FLAPPING_COUNTERS_ENABLED'] and not multi:
+            self._flaps = get_flap_counter(self.db, self.flapping_window)
+
+    @contextmanager
+    def _connection(self):
+        """Borrow a connection from the pool for the block, or use the one
+        of the transaction the thread is in"""
+        borrowed = _borrowed()
+        if self.db in borrowed:
+            yield borrowed[self.db][0]
+            return
+        pool = get_pool(self.db)
+        con = pool.get()
+        # Connection and transaction depth
+        borrowed[self.db] = [con, 0]
+        try:
+            yield con
+        finally:
+            del borrowed[self.db]
+            pool.put(con)
+
+    def _in_transaction(self):
+        borrowed = _borrowed().get(self.db)
+        return borrowed is not None and borrowed[1] > 0
+
+    def _finish(self, con, failed=False):
+        # Commit or roll back unless we are inside a transaction block
+        if self._in_transaction():
+            return
+        if failed:
+            con.rollback()
+        else:
+            con.commit()
+
+    @contextmanager
+    def transaction(self):
+        """Commit all writes inside the block together, blocks can nest.
+        The thread keeps its connection until the outermost block ends"""
+        with self._connection() as con:
+            borrowed = _borrowed()[self.db]
+            borrowed[1] += 1
+            try:
+                yield con
+            except Exception:
+                borrowed[1] -= 1
+                self._finish(con, failed=True)
+                if not self._in_transaction():
+                    # Changes already written to memory were rolled back
+                    if self._cache:
+                        self._cache.invalidate()
+                    if self._flaps:
+                        self._flaps.invalidate()
+                raise
+            borrowed[1] -= 1
+            self._finish(con)
+
+    def close(self):
+        """Close the connections not in use"""
+        get_pool(self.db).close()
+
+    def pool_stats(self):
+        return get_pool(self.db).stats()
 
     def create_tables(self):
         LOGGER.info("Creating database tables")
-        con = sqlite3.connect(self.db)
-        with con:
-            cur = con.cursor()
-            cur.executescript(CREATE_TABLES_SQL)
+        with self._connection() as con:
+            con.executescript(CREATE_TABLES_SQL)
+            self.migrate()
+
+    def migrate(self):
+        with self._connection() as con:
+            version = con.execute("PRAGMA user_version").fetchone()[0]
+            for v, sql in SCHEMA_MIGRATIONS:
+                if v <= version:
+                    continue
+                LOGGER.info("Migrating database schema to version %d", v)
+                con.executescript("BEGIN;\n{}\nPRAGMA user_version = {};\n"
+                                  "COMMIT;".format(sql, v))
 
     def select(self, query, fetchone=True, use_column_name=False):
-        con = sqlite3.connect(self.db)
-        with con:
-            if use_column_name:
-                con.row_factory = sqlite3.Row
+        start = time.time()
+        with self._connection() as con:
             cur = con.cursor()
+            if use_column_name:
+                cur.row_factory = sqlite3.Row
             cur.execute(query)
             if fetchone:
                 res = cur.fetchone()
             else:
                 res = cur.fetchall()
-            if res:
-                return res
+            cur.close()
+        _SELECT_SECONDS.observe(time.time() - start)
+        if res:
+            return res
         return None
 
     def execute_query(self, query, values=None):
-        con = sqlite3.connect(self.db)
-        with con:
-            cur = con.cursor()
-            if values:
-                cur.execute(query, values)
-            else:
-                cur.execute(query)
-            return cur.rowcount
+        start = time.time()
+        with self._connection() as con:
+            try:
+                if values:
+                    cur = con.execute(query, values)
+                else:
+                    cur = con.execute(query)
+            except sqlite3.Error:
+                self._finish(con, failed=True)
+                raise
+            self._finish(con)
+        _EXECUTE_SECONDS.observe(time.time() - start)
+        return cur.rowcount
 
     def execute_many(self, query, values):
-        con = sqlite3.connect(self.db)
-        with con:
-            cur = con.cursor()
-            cur.executemany(query, values)
-            return cur.rowcount
+        start = time.time()
+        with self._connection() as con:
+            try:
+                cur = con.executemany(query, values)
+            except sqlite3.Error:
+                self._finish(con, failed=True)
+                raise
+            self._finish(con)
+        _EXECUTE_MANY_SECONDS.observe(time.time() - start)
+        return cur.rowcount
+
+    def _fetch(self, query, values):
+        """Return all rows of a query with bound values"""
+        with self._connection() as con:
+            cur = con.execute(query, values)
+            res = cur.fetchall()
+            cur.close()
+        return res
+
+    def _read_active_alerts(self, alhash=None):
+        query = "select hash, " + ", ".join(FIELDS) + " from active_alerts"
+        tag_query = "select hash, key, value from active_alert_tags"
+        if alhash:
+            query += " where hash = '{}'".format(alhash)
+            tag_query += " where hash = '{}'".format(alhash)
+        alerts = {}
+        tags = {}
+        for r in self.select(query, fetchone=False) or []:
+            alerts[r[0]] = dict(zip(FIELDS, r[1:]))
+            tags[r[0]] = []
+        for r in self.select(tag_query, fetchone=False) or []:
+            if r[0] in alerts:
+                tags[r[0]].append((r[1], r[2]))
+        for alhash, alert in alerts.items():
+            alert['tags'] = Tags(tags[alhash])
+        return alerts
+
+    def _get_active(self, alhash):
+        if self._cache:
+            self._cache.ensure_loaded(self._read_active_alerts)
+            entry = self._cache.get(alhash)
+            if app.config['ACTIVE_ALERT_CACHE_VERIFY']:
+                self._cache.verify(self._read_active_alerts(alhash), alhash)
+            return entry
+        # One query, the lookups without the cache do not need the tags
+        rows = self._fetch("select " + ", ".join(FIELDS) +
+                           " from active_alerts where hash = ?", (alhash,))
+        if rows:
+            return dict(zip(FIELDS, rows[0]))
+        return None
+
+    def verify_cache(self):
+        if not self._cache:
+            return []
+        self._cache.ensure_loaded(self._read_active_alerts)
+        return self._cache.verify(self._read_active_alerts())
+
+    def cache_stats(self):
+        if not self._cache:
+            return None
+        return self._cache.stats()
 
     def get_tickets_and_keys(self, al):
         LOGGER.info("Add tickets and keys")
-        query = "select pagerduty, jira, grafana, sent " + \
-            "from active_alerts where hash = '{}'".format(al.alhash)
-        res = self.select(query, use_column_name=True)
+        res = self._get_active(al.alhash)
         if res:
             al.pd_incident_key = res['pagerduty']
             al.jira_issue = res['jira']
@@ -76,100 +387,242 @@ class DBController():
 
     def activate_alert(self, al):
         LOGGER.info("Activate alert")
-        query = ("INSERT INTO active_alerts (hash, time, id, message,"
-                 "previouslevel, level, duration, pagerduty, jira, grafana, "
-                 "state_duration, sent) VALUES(?, ?, ?, ?, ?, ?, ? ,? , "
-                 "?, ?, ?, ?)")
-        values = (al.alhash, al.time, al.id, al.message,
-                  al.previouslevel, al.level, al.duration,
-                  al.pd_incident_key, al.jira_issue, al.grafana_url,
-                  al.state_duration, al.sent)
-        self.execute_query(query, values)
-        query = "INSERT OR IGNORE INTO active_alert_tags " + \
-            "(hash, key, value) VALUES (?, ?, ?)"
-        tags = [(al.alhash, x['key'], x['value']) for x in al.tags]
-        self.execute_many(query, tags)
+        with self.transaction():
+            self.execute_query(_ACTIVATE_QUERY, _activate_values(al))
+            tags = [(al.alhash, k, v) for k, v in al.tags.items()]
+            self.execute_many(_TAGS_QUERY, tags)
+            if self._cache:
+                self._cache.activate(al)
+        _state_changed()
 
     def update_alert(self, al):
         LOGGER.info("Update alert")
-        query = ("UPDATE active_alerts set time = ? ,message = ?, "
-                 "previouslevel = ?, level = ?, duration = ?,"
-                 "pagerduty = ?, jira = ?, grafana = ?, state_duration = ?,"
-                 "sent = ? where hash = ?")
-        values = (al.time, al.message,
-                  al.previouslevel, al.level, al.duration,
-                  al.pd_incident_key, al.jira_issue, al.grafana_url,
-                  al.state_duration, al.sent, al.alhash)
-        self.execute_query(query, values)
+        self.execute_query(_UPDATE_QUERY, _update_values(al))
+        if self._cache:
+            self._cache.update(al)
+        _state_changed()
+
+    def set_alert_keys(self, alhash, pagerduty=None, jira=None):
+        """Save an incident key or issue that arrived after the alert
+        was stored, if the alert is active. Returns False when there is
+        no active alert with alhash"""
+        keys = {k: v for k, v in (('pagerduty', pagerduty), ('jira', jira))
+                if v is not None}
+        if not keys:
+            return True
+        query = "UPDATE active_alerts set {} where hash = ?".format(
+            ", ".join("%s = ?" % k for k in keys))
+        if not self.execute_query(query, tuple(keys.values()) + (alhash,)):
+            return False
+        if self._cache:
+            self._cache.set_keys(alhash, keys)
+        _state_changed()
+        return True
+
+    def set_log_keys(self, alerts):
+        """Save the incident keys and issues of logged alerts, that were
+        notified after they were logged"""
+        if alerts:
+            self.execute_many("UPDATE alert_log SET pagerduty = ?, jira = ? "
+                              "WHERE hash = ? AND time = ?",
+                              [(al.pd_incident_key, al.jira_issue, al.alhash,
+                                al.time) for al in alerts])
 
     def deactivate_alert(self, al):
         LOGGER.info("Deactivate alert")
         query = "DELETE FROM active_alerts where hash = '{}'".format(al.alhash)
         self.execute_query(query)
+        if self._cache:
+            self._cache.deactivate(al.alhash)
+        _state_changed()
 
     def is_active(self, al):
-        query = "SELECT 1 FROM active_alerts where hash = '{}'".format(
-            al.alhash)
-        res = self.select(query)
-        if res:
+        if self._get_active(al.alhash):
             return True
         return False
 
     def state_duration(self, al):
         LOGGER.info("Checking state duration")
-        query = "SELECT state_duration FROM active_alerts " + \
-            "where hash = '{}'".format(al.alhash)
-        res = self.select(query)
+        res = self._get_active(al.alhash)
         if res:
-            return bool(res[0])
+            return bool(res['state_duration'])
         return False
 
     def get_active_alerts(self):
         LOGGER.info("Get active alerts")
-        query = "select id, duration, message, level, previouslevel, " + \
-            "time, grafana, jira, pagerduty from active_alerts"
-        result = self.select(query, fetchone=False)
+        if self._cache:
+            self._cache.ensure_loaded(self._read_active_alerts)
+            if app.config['ACTIVE_ALERT_CACHE_VERIFY']:
+                self.verify_cache()
+            result = self._cache.alerts()
+        else:
+            result = self._read_active_alerts().values()
         res = []
-        if result:
-            for r in result:
-                a = Alert(r[0], r[1], r[2], r[3], r[4], r[5], None)
-                a.grafana_url = r[6]
-                a.jira_issue = r[7]
-                a.pd_incident_key = r[8]
-                a.tags = self.get_tags(a.alhash)
-                res.append(a)
+        for r in result:
+            a = Alert(r['id'], r['duration'], r['message'], r['level'],
+                      r['previouslevel'], r['time'], r['tags'])
+            a.grafana_url = r['grafana']
+            a.jira_issue = r['jira']
+            a.pd_incident_key = r['pagerduty']
+            res.append(a)
         return res
 
     def get_tags(self, alhash):
-        query = "select key, value from active_alert_tags where " + \
-            "hash = '{}'".format(alhash)
-        result = self.select(query, fetchone=False)
-        tags = []
-        if result:
-            for r in result:
-                tags.append({'key': r[0], 'value': r[1]})
-        return tags
+        if not self._cache:
+            return Tags(self._fetch("select key, value from "
+                                    "active_alert_tags where hash = ?",
+                                    (alhash,))).to_list()
+        res = self._get_active(alhash)
+        if res:
+            return res['tags'].to_list()
+        return []
 
     def log_alert(self, al):
         LOGGER.info("Logging alert")
-        envir = None
-        host = None
-        for tag in al.tags:
-            if tag['key'] == 'Environment':
-                envir = tag['value']
-            if tag['key'] == 'host':
-                host = tag['value']
-        query = ("INSERT OR IGNORE INTO alert_log(hash, time, id, "
-                 "message, previouslevel, level, environment, host, duration, "
-                 "pagerduty, jira) VALUES( ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)")
-        values = (al.alhash, al.time, al.id, al.message, al.previouslevel,
-                  al.level, envir, host, al.duration, al.pd_incident_key,
-                  al.jira_issue)
-        self.execute_query(query, values)
+        with self.transaction():
+            if not self.execute_query(_LOG_QUERY, _log_values(al)):
+                # Already logged
+                return
+            if al.time is not None:
+                self._update_rollup(al)
+        _state_changed()
+        if (self._flaps and al.time is not None and
+                al.previouslevel == 'OK' and al.level != 'OK'):
+            self._flaps.record(al.alhash, al.id, al.tags.get('Environment'),
+                               al.time)
+
+    def apply_batch(self, activate=(), update=(), deactivate=(), log=()):
+        """Write the changes from a batch of alerts in one transaction,
+        with one executemany per statement. deactivate holds alert hashes
+        and is applied before activate, so an alert reactivated by the
+        batch can be in both"""
+        with self.transaction():
+            if deactivate:
+                self.execute_many("DELETE FROM active_alerts WHERE hash = ?",
+                                  [(h,) for h in deactivate])
+            if activate:
+                self.execute_many(_ACTIVATE_QUERY,
+                                  [_activate_values(al) for al in activate])
+                self.execute_many(_TAGS_QUERY,
+                                  [(al.alhash, k, v) for al in activate
+                                   for k, v in al.tags.items()])
+            if update:
+                self.execute_many(_UPDATE_QUERY,
+                                  [_update_values(al) for al in update])
+            logged = self._log_many(log) if log else []
+            if self._cache:
+                for alhash in deactivate:
+                    self._cache.deactivate(alhash)
+                for al in activate:
+                    self._cache.activate(al)
+                for al in update:
+                    self._cache.update(al)
+        if deactivate or activate or update or logged:
+            _state_changed()
+        if self._flaps:
+            for al in logged:
+                if al.time is not None and \
+                        al.previouslevel == 'OK' and al.level != 'OK':
+                    self._flaps.record(al.alhash, al.id,
+                                       al.tags.get('Environment'), al.time)
+
+    def _log_many(self, alerts):
+        """Log the alerts not logged already, and return them"""
+        rows = {}
+        for al in alerts:
+            rows.setdefault((al.alhash, al.time), al)
+        times = [t for _, t in rows if t is not None]
+        logged = set()
+        if times:
+            hashes = list({h for h, _ in rows})
+            # Stay below the SQLite limit of bound parameters
+            for i in range(0, len(hashes), 500):
+                chunk = hashes[i:i + 500]
+                query = ("SELECT hash, time FROM alert_log WHERE time >= ? "
+                         "AND hash IN ({})").format(",".join("?" * len(chunk)))
+                logged.update(self._fetch(query, [min(times)] + chunk))
+        new = [al for key, al in rows.items() if key not in logged]
+        self.execute_many(_LOG_QUERY, [_log_values(al) for al in new])
+        rollups = {}
+        for al in new:
+            if al.time is None:
+                continue
+            count, duration = rollups.get(_rollup_key(al), (0, 0))
+            rollups[_rollup_key(al)] = (count + 1,
+                                        duration + (al.duration or 0))
+        self.execute_many("INSERT OR IGNORE INTO alert_log_rollup "
+                          "VALUES (?, ?, ?, ?, ?, 0, 0)", list(rollups))
+        self.execute_many("UPDATE alert_log_rollup SET count = count + ?, "
+                          "duration = duration + ? WHERE minute = ? and "
+                          "id = ? and environment = ? and "
+                          "previouslevel = ? and level = ?",
+                          [(c, d) + key for key, (c, d) in rollups.items()])
+        return new
+
+    def _update_rollup(self, al):
+        key = _rollup_key(al)
+        self.execute_query("INSERT OR IGNORE INTO alert_log_rollup "
+                           "VALUES (?, ?, ?, ?, ?, 0, 0)", key)
+        self.execute_query("UPDATE alert_log_rollup SET count = count + 1, "
+                           "duration = duration + ? WHERE minute = ? and "
+                           "id = ? and environment = ? and "
+                           "previouslevel = ? and level = ?",
+                           (al.duration or 0,) + key)
+
+    def backfill_rollups(self, since=0):
+        """Rebuild the alert log rollups from the alert log"""
+        LOGGER.info("Rebuilding alert log rollups")
+        with self.transaction():
+            self.execute_query("DELETE FROM alert_log_rollup "
+                               "WHERE minute >= {}".format(
+                                   int(since) // 60 * 60))
+            self.execute_query(ROLLUP_BACKFILL_SQL.format(
+                since=int(since) // 60 * 60))
+
+    def _read_flap_transitions(self):
+        tlimit = int(time.time()) - self._flaps.window
+        query = ("select hash, id, environment, time from alert_log "
+                 "where time >= {} and previouslevel = 'OK' and "
+                 "level != 'OK' order by time".format(tlimit))
+        return self.select(query, fetchone=False) or []
+
+    def prune_alert_log(self, before, batch, archive=True):
+        """Delete up to batch alert log records older than before, and
+        move them to monthly archive tables if archive is set. Returns the
+        number of records removed"""
+        query = ("select rowid, " + ", ".join(LOG_COLUMNS) + " from "
+                 "alert_log where time < {} order by time limit {}".format(
+                     int(before), int(batch)))
+        with self.transaction():
+            rows = self.select(query, fetchone=False)
+            if not rows:
+                return 0
+            if archive:
+                months = {}
+                for r in rows:
+                    month = time.strftime("%Y%m", time.gmtime(r[2]))
+                    months.setdefault(month, []).append(r[1:])
+                for month, records in months.items():
+                    table = "alert_log_archive_" + month
+                    self.execute_query(
+                        "CREATE TABLE IF NOT EXISTS {} AS SELECT * FROM "
+                        "alert_log WHERE 0".format(table))
+                    self.execute_many(
+                        "INSERT INTO {} ({}) VALUES ({})".format(
+                            table, ", ".join(LOG_COLUMNS),
+                            ", ".join("?" * len(LOG_COLUMNS))), records)
+            self.execute_many("DELETE FROM alert_log where rowid = ?",
+                              [(r[0],) for r in rows])
+            self.execute_query("DELETE FROM alert_log_rollup "
+                               "WHERE minute < {}".format(int(before)))
+        return len(rows)
 
     def get_log_count_interval(self):
         # LOGGER.info("Getting alert occurences from alert log")
         now = int(time.time())
+        if self._flaps:
+            self._flaps.ensure_loaded(self._read_flap_transitions)
+            return self._flaps.counts(now)
         query = ("select hash, id, environment, count(*) as num, "
                  "max(diff) as diff "
                  "from (select l.hash, l.id, l.environment, "
@@ -186,33 +639,54 @@ class DBController():
         return []
 
     def get_statistics(self, hours):
-        tm = int(time.time() - hours * 3600)
-        query = "select id, previouslevel, environment, avg(duration), " + \
-            "count(*) from alert_log where level = 'OK' and " + \
-            "time >= {} group by id, level, environment".format(tm)
+        tm = int(time.time() - hours * 3600) // 60 * 60
+        query = ("select id, previouslevel, nullif(environment, ''), "
+                 "sum(duration) * 1.0 / sum(count), sum(count) "
+                 "from alert_log_rollup where level = 'OK' and "
+                 "minute >= {} group by id, level, environment".format(tm))
         result = self.select(query, fetchone=False)
         if result:
             return result
         return []
 
-    def get_log_records(self, hours, environment=None):
-        tm = int(time.time() - hours * 3600)
-        query = "select time, id, previouslevel, level, environment " + \
-            " from alert_log where time >= {} order by time desc".format(tm)
-        if environment:
-            query = ("select time, id, previouslevel, level, environment "
-                     "from alert_log where time >= {} and environment = '{}' "
-                     "order by time desc".format(tm, environment))
-        result = self.select(query, fetchone=False)
-        if result:
-            return result
-        return []
+    def iter_log_records(self, hours, filters=None, before=None,
+                         limit=None):
+        """Yield log records newest first straight from the cursor.
+        filters maps id, host, level or environment to a value, and
+        before is a (time, hash) key to continue after"""
+        where = ["time >= ?"]
+        values = [int(time.time() - hours * 3600)]
+        for key in LOG_FILTERS:
+            if filters and filters.get(key):
+                where.append("{} = ?".format(key))
+                values.append(filters[key])
+        if before:
+            where.append("(time < ? or (time = ? and hash < ?))")
+            values.extend([before[0], before[0], before[1]])
+        query = ("select time, id, previouslevel, level, environment, hash "
+                 "from alert_log where " + " and ".join(where) +
+                 " order by time desc, hash desc")
+        if limit:
+            query += " limit {}".format(int(limit))
+        # Borrowed for as long as the caller iterates, not registered as
+        # the connection of the thread
+        pool = get_pool(self.db)
+        con = pool.get()
+        try:
+            cur = con.execute(query, values)
+            try:
+                for row in cur:
+                    yield row
+            finally:
+                cur.close()
+        finally:
+            pool.put(con)
 
     def get_alert_summary(self, hours=1):
-        tm = int(time.time() - hours * 3600)
-        query = ("select environment, count(*) "
-                 "from alert_log where time >= {} and level != 'OK' "
-                 "group by environment".format(tm))
+        tm = int(time.time() - hours * 3600) // 60 * 60
+        query = ("select nullif(environment, ''), sum(count) "
+                 "from alert_log_rollup where minute >= {} and "
+                 "level != 'OK' group by environment".format(tm))
         result = self.select(query, fetchone=False)
         if result:
             return result
@@ -243,6 +717,7 @@ class DBController():
             "time, quarantine, modified) VALUES (?, ?, ?, ?, ?, ?)"
         values = (alhash, alid, environment, now, quarantine, now)
         self.execute_query(query, values)
+        _state_changed()
 
     def update_flapping(self, alhash, interval):
         LOGGER.debug("Updating flapping quarantine interval")
@@ -252,11 +727,13 @@ class DBController():
             "where hash = ?"
         values = (quarantine, now, alhash)
         self.execute_query(query, values)
+        _state_changed()
 
     def unset_flapping(self, alhash, alid):
         LOGGER.info("Unsetting flapping on %s", alid)
         query = "DELETE FROM flapping_alerts where hash = '{}'".format(alhash)
         self.execute_query(query)
+        _state_changed()
 
     def activate_maintenance(self, key, value, duration, comment):
         LOGGER.info("Activate maintenance on %s %s for %s",
@@ -268,6 +745,10 @@ class DBController():
             "(start, stop, key, value, comment) VALUES (?, ?, ?, ?, ?)"
         values = (start, stop, key, value, comment)
         self.execute_query(query, values)
+        _state_changed(expires=stop)
+        publish('maintenance', {'active': True, 'start': start, 'stop': stop,
+                                'key': key, 'value': value,
+                                'comment': comment})
 
     def deactive_maintenance(self, start, stop, key, value):
         LOGGER.info("Deactivate maintenance on %s %s", key, value)
@@ -276,6 +757,9 @@ class DBController():
                  "and value = '{value}'".format(
                      start=start, stop=stop, key=key, value=value))
         self.execute_query(query)
+        _state_changed()
+        publish('maintenance', {'active': False, 'start': start,
+                                'stop': stop, 'key': key, 'value': value})
 
     def get_active_maintenance_rules(self):
         # LOGGER.info("Get maintenance rules")
@@ -289,13 +773,18 @@ class DBController():
                                'key': r[2], 'value': r[3],
                                'comment': r[4]})
         if mrules:
-            tmp = mrules
-            for i, mr in enumerate(mrules):
-                if not mr['start'] <= int(time.time()) <= mr['stop']:
-                    del tmp[i]
+            now = int(time.time())
+            active = []
+            for mr in mrules:
+                if mr['start'] <= now <= mr['stop']:
+                    active.append(mr)
+                else:
                     self.deactive_maintenance(mr['start'], mr['stop'],
                                               mr['key'], mr['value'])
-            mrules = tmp
+            mrules = active
+        if mrules:
+            with _STATE_LOCK:
+                _STATE['expires'] = min(mr['stop'] for mr in mrules)
         return mrules
 
     def add_maintenance_schedule(self, starttime, duration,
@@ -308,10 +797,12 @@ class DBController():
                  "?, ?, ?, ?, ?, ?, ?)")
         values = (schedule_id, starttime, duration,
                   key, value, comment, repeat)
-        if self.execute_query(query, values):
-            query = ("INSERT INTO maintenance_schedule_days "
-                     "(schedule_id, day, runcounter) VALUES (?, ?, ?)")
-            self.execute_many(query, days)
+        with self.transaction():
+            if self.execute_query(query, values):
+                query = ("INSERT INTO maintenance_schedule_days "
+                         "(schedule_id, day, runcounter) VALUES (?, ?, ?)")
+                self.execute_many(query, days)
+        _state_changed()
 
     def get_maintenance_schedule(self):
         result = self.select(
@@ -348,12 +839,88 @@ class DBController():
             "where schedule_id = ? and day = ?"
         values = (schedule_id, day)
         self.execute_query(query, values)
+        _state_changed()
 
     def delete_maintenance_schedule(self, schedule_id):
         LOGGER.info("Deleting maintenance schedule")
         query = "DELETE FROM maintenance_schedule " + \
             "WHERE schedule_id = %d" % schedule_id
         self.execute_query(query)
+        _state_changed()
+
+    def outbox_put(self, target, url, payload, alhash=None, dedup_key=None,
+                   group_key=None, delay=0, incident_key=None):
+        """Add a notification to the outbox, to be sent after delay
+        seconds. A pending notification with the same dedup_key is
+        replaced, unless a newer one for the same alert is pending. A
+        notification in a group is sent with the group, so replacing
+        members do not hold the group back"""
+        now = time.time()
+        query = ("INSERT OR REPLACE INTO outbox (target, url, alhash, "
+                 "dedup_key, group_key, incident_key, idempotency_key, "
+                 "payload, attempts, next_attempt, created) "
+                 "VALUES (?, ?, ?, ?, ?, ?, ?, ?, 0, COALESCE("
+                 "(SELECT min(next_attempt) FROM outbox WHERE target = ? AND "
+                 "group_key = ? AND attempts = 0), ?), ?)")
+        with self.transaction():
+            if dedup_key:
+                # Keep it, as a CRITICAL followed by an OK must not lose
+                # the CRITICAL
+                self.execute_query(
+                    "UPDATE outbox SET dedup_key = NULL WHERE dedup_key = ? "
+                    "AND EXISTS (SELECT 1 FROM outbox p WHERE "
+                    "p.target = outbox.target AND p.alhash = outbox.alhash "
+                    "AND p.id > outbox.id)", (dedup_key,))
+            self.execute_query(query, (target, url, alhash, dedup_key,
+                                       group_key, incident_key,
+                                       uuid.uuid4().hex, payload, target,
+                                       group_key, now + delay, now))
+
+    def outbox_due(self, limit, skip=()):
+        """Return the notifications due for delivery, oldest first,
+        leaving out the targets in skip. A notification waits until all
+        older ones for the same alert and target are delivered"""
+        query = ("SELECT id, target, url, idempotency_key, payload, attempts, "
+                 "group_key, incident_key FROM outbox o "
+                 "WHERE next_attempt <= ? AND "
+                 "target NOT IN ({}) AND NOT EXISTS "
+                 "(SELECT 1 FROM outbox p WHERE p.target = o.target AND "
+                 "p.alhash = o.alhash AND p.id < o.id) "
+                 "ORDER BY id LIMIT ?").format(",".join("?" * len(skip)))
+        return self._fetch(query, (time.time(),) + tuple(skip) + (limit,))
+
+    def outbox_group(self, target, group_key):
+        """Return id and payload of the pending notifications in a group,
+        leaving out those waiting for an older notification"""
+        query = ("SELECT id, payload FROM outbox o WHERE target = ? AND "
+                 "group_key = ? AND NOT EXISTS "
+                 "(SELECT 1 FROM outbox p WHERE p.target = o.target AND "
+                 "p.alhash = o.alhash AND p.id < o.id) ORDER BY id")
+        return self._fetch(query, (target, group_key))
+
+    def outbox_incident_open(self, key, exclude):
+        """True while another alert than the one of notification exclude
+        has the incident key, or another notification for it is pending"""
+        query = ("SELECT EXISTS (SELECT 1 FROM active_alerts "
+                 "WHERE pagerduty = ? AND hash IS NOT "
+                 "(SELECT alhash FROM outbox WHERE id = ?)) OR EXISTS "
+                 "(SELECT 1 FROM outbox WHERE incident_key = ? AND id != ?)")
+        return bool(self._fetch(query, (key, exclude, key, exclude))[0][0])
+
+    def outbox_done(self, delivered, retries):
+        """Remove the delivered ids, and reschedule retries, a list of
+        (attempts, next_attempt, error, id)"""
+        with self.transaction():
+            if delivered:
+                self.execute_many("DELETE FROM outbox WHERE id = ?",
+                                  [(i,) for i in delivered])
+            if retries:
+                self.execute_many("UPDATE outbox SET attempts = ?, "
+                                  "next_attempt = ?, last_error = ? "
+                                  "WHERE id = ?", retries)
+
+    def outbox_size(self):
+        return self.select("SELECT count(*) FROM outbox")[0]
 
     def get_aws_instance_info(self):
         query = "SELECT host, environment, state " + \
@@ -385,6 +952,78 @@ class DBController():
         LOGGER.debug("Deleted %d instance records", rows)
 
 
+LOG_FILTERS = ('id', 'host', 'level', 'environment')
+
+LOG_COLUMNS = ('hash', 'time', 'id', 'message', 'environment', 'host',
+               'previouslevel', 'level', 'duration', 'pagerduty', 'jira')
+
+# Alert log counts and total duration per minute. Environment is stored
+# as '' instead of NULL to keep the primary key unique
+ROLLUP_TABLE_SQL = '''
+CREATE TABLE IF NOT EXISTS alert_log_rollup(minute INTEGER, id TEXT,
+environment TEXT, previouslevel TEXT, level TEXT, count INTEGER,
+duration INTEGER,
+PRIMARY KEY (minute, id, environment, previouslevel, level));
+CREATE INDEX IF NOT EXISTS alert_log_rollup_level_minute
+ON alert_log_rollup(level, minute);
+'''
+
+ROLLUP_BACKFILL_SQL = '''
+INSERT OR REPLACE INTO alert_log_rollup
+SELECT CAST(time AS INTEGER) / 60 * 60, id, ifnull(environment, ''),
+previouslevel, level, count(*), sum(ifnull(duration, 0))
+FROM alert_log WHERE time >= {since} GROUP BY 1, 2, 3, 4, 5;
+'''
+
+# Schema changes applied after CREATE_TABLES_SQL, in order, to databases
+# with a lower PRAGMA user_version. Never change an existing entry, add a
+# new one with the next version number instead.
+SCHEMA_MIGRATIONS = [
+    (1, '''
+CREATE INDEX IF NOT EXISTS alert_log_time
+ON alert_log(time, level, environment, id, previouslevel, duration);
+CREATE INDEX IF NOT EXISTS alert_log_id_time ON alert_log(id, time);
+CREATE INDEX IF NOT EXISTS alert_log_environment_time
+ON alert_log(environment, time, id, previouslevel, level);
+'''),
+    (2, ROLLUP_TABLE_SQL + ROLLUP_BACKFILL_SQL.format(since=0)),
+    (3, '''
+CREATE INDEX IF NOT EXISTS alert_log_time_hash
+ON alert_log(time, hash, id, previouslevel, level, environment, host);
+'''),
+    (4, '''
+CREATE TABLE IF NOT EXISTS kap_state
+(id INTEGER PRIMARY KEY CHECK (id = 0), version INTEGER NOT NULL);
+INSERT OR IGNORE INTO kap_state (id, version) VALUES (0, 0);
+'''),
+    (5, '''
+CREATE TABLE IF NOT EXISTS outbox
+(id INTEGER PRIMARY KEY AUTOINCREMENT, target TEXT, url TEXT, alhash TEXT,
+dedup_key TEXT UNIQUE, idempotency_key TEXT, payload TEXT,
+attempts INTEGER, next_attempt REAL, created REAL, last_error TEXT);
+CREATE INDEX IF NOT EXISTS outbox_alert ON outbox(target, alhash, id);
+'''),
+    (6, '''
+ALTER TABLE outbox ADD COLUMN group_key TEXT;
+CREATE INDEX IF NOT EXISTS outbox_group ON outbox(target, group_key);
+'''),
+    (7, '''
+ALTER TABLE outbox ADD COLUMN incident_key TEXT;
+CREATE INDEX IF NOT EXISTS outbox_incident ON outbox(incident_key);
+CREATE INDEX IF NOT EXISTS active_alerts_pagerduty ON active_alerts(pagerduty);
+'''),
+    # Alert times were the UTC time of the alert read as local time, they
+    # are true UTC from version 8. Uses the time zone of the process
+    # migrating, archived alert logs are not converted
+    (8, '''
+UPDATE OR REPLACE alert_log
+SET time = CAST(strftime('%s', time, 'unixepoch', 'localtime') AS INTEGER);
+UPDATE active_alerts
+SET time = CAST(strftime('%s', time, 'unixepoch', 'localtime') AS INTEGER);
+DELETE FROM alert_log_rollup;
+''' + ROLLUP_BACKFILL_SQL.format(since=0)),
+]
+
 CREATE_TABLES_SQL = '''
 
 -- DROP TABLE IF EXISTS active_alerts;
@@ -0,0 +1,83 @@
+# vim:set shiftwidth=4 softtabstop=4 expandtab:
+'''
+Module: dispatch.py
+
+Concurrent dispatch of an alert to the notification targets. Every
+target runs in a shared thread pool with its own deadline, so a slow or
+hung target does not hold back the others or the database update.
+
+Created: 18.Oct.2026
+'''
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+
+from app import app, LOGGER
+from app.metrics import REGISTRY
+
+_TIMEOUTS = REGISTRY.counter('kap_dispatch_timeouts_total',
+                             'Targets missing their dispatch deadline',
+                             ['target'])
+
+_DISPATCHER = {'dispatcher': None}
+_DISPATCHER_LOCK = threading.Lock()
+
+
+def get_dispatcher():
+    """Return the dispatcher shared by all controllers"""
+    with _DISPATCHER_LOCK:
+        if _DISPATCHER['dispatcher'] is None:
+            _DISPATCHER['dispatcher'] = Dispatcher(
+                workers=app.config['DISPATCH_WORKERS'],
+                deadlines=app.config['DISPATCH_DEADLINES'])
+        return _DISPATCHER['dispatcher']
+
+
+class Dispatcher():
+    def __init__(self, workers=16, deadlines=None):
+        self._pool = ThreadPoolExecutor(max_workers=workers,
+                                        thread_name_prefix="dispatch")
+        self._deadlines = deadlines or {}
+
+    def run(self, jobs, default=None, on_late=None):
+        """Run the callables in jobs, a dict from target name to callable,
+        concurrently and return a dict from target name to result.
+        Targets that fail or miss their deadline get the result from
+        default, a dict from target name to result. When a late target
+        finishes, on_late is called with its name and result"""
+        default = default or {}
+        start = time.time()
+        futures = {name: self._pool.submit(job)
+                   for name, job in jobs.items()}
+        results = {}
+        for name in sorted(futures, key=self._deadline):
+            future = futures[name]
+            timeout = max(0, start + self._deadline(name) - time.time())
+            try:
+                results[name] = future.result(timeout=timeout)
+            except TimeoutError:
+                LOGGER.error("Dispatch to %s missed its deadline", name)
+                _TIMEOUTS.labels(name).inc()
+                results[name] = default.get(name)
+                if on_late:
+                    future.add_done_callback(
+                        lambda f, name=name: _late(f, name, on_late))
+            except Exception:  # pylint: disable=W0703
+                LOGGER.exception("Dispatch to %s failed", name)
+                results[name] = default.get(name)
+        return results
+
+    def _deadline(self, name):
+        return self._deadlines.get(name, 30)
+
+    def shutdown(self):
+        self._pool.shutdown(wait=True)
+
+
+def _late(future, name, on_late):
+    if future.exception() is not None:
+        return
+    try:
+        on_late(name, future.result())
+    except Exception:  # pylint: disable=W0703
+        LOGGER.exception("Failed storing late result from %s", name)
@@ -0,0 +1,123 @@
+# vim:set shiftwidth=4 softtabstop=4 expandtab:
+'''
+Module: events.py
+
+Fan-out of alert, flapping and maintenance state changes to the
+clients of /kap/stream.
+
+Events are serialized once when published, numbered, and kept in a
+ring buffer so a client reconnecting with Last-Event-ID gets the events
+it missed. Every subscriber has a bounded buffer, and a subscriber that
+falls behind is dropped instead of slowing down the publisher. It will
+reconnect and resume from the ring buffer.
+
+Created: 18.Oct.2026
+'''
+import json
+import queue
+import threading
+import collections
+
+from app import app, LOGGER
+from app.metrics import REGISTRY
+
+_EVENTS = REGISTRY.counter('kap_events_total', 'Events published or dropped',
+                           ['result'])
+_PUBLISHED = _EVENTS.labels('published')
+_DROPPED = _EVENTS.labels('dropped')
+
+_BROADCASTER = {'broadcaster': None}
+_BROADCASTER_LOCK = threading.Lock()
+
+
+def get_broadcaster():
+    """Return the broadcaster shared by all publishers and subscribers"""
+    with _BROADCASTER_LOCK:
+        if _BROADCASTER['broadcaster'] is None:
+            _BROADCASTER['broadcaster'] = Broadcaster(
+                history=app.config['EVENT_HISTORY'],
+                client_buffer=app.config['EVENT_CLIENT_BUFFER'])
+        return _BROADCASTER['broadcaster']
+
+
+def publish(kind, data):
+    if app.config['EVENT_STREAM_ENABLED']:
+        get_broadcaster().publish(kind, data)
+
+
+class Broadcaster():
+    def __init__(self, history=1000, client_buffer=100):
+        self._history = collections.deque(maxlen=history)
+        self._client_buffer = client_buffer
+        self._subscribers = set()
+        self._next_id = 1
+        self._lock = threading.Lock()
+
+    def publish(self, kind, data):
+        data = json.dumps(data)
+        with self._lock:
+            event = (self._next_id, kind, data)
+            self._next_id += 1
+            self._history.append(event)
+            for sub in list(self._subscribers):
+                if not sub.offer(event):
+                    self._subscribers.discard(sub)
+                    _DROPPED.inc()
+                    LOGGER.warning("Dropping slow event stream subscriber")
+        _PUBLISHED.inc()
+
+    def subscribe(self, last_id=None):
+        """Return a new Subscription. If last_id is given the events after
+        it are replayed first, or a resync event if they are no longer
+        in the history"""
+        sub = Subscription(self._client_buffer)
+        with self._lock:
+            if last_id is not None:
+                first = self._history[0][0] if self._history else \
+                    self._next_id
+                if last_id < first - 1 or last_id >= self._next_id:
+                    sub.backlog.append((self._next_id - 1, 'resync', '{}'))
+                else:
+                    sub.backlog.extend(e for e in self._history
+                                       if e[0] > last_id)
+            self._subscribers.add(sub)
+        return sub
+
+    def unsubscribe(self, sub):
+        with self._lock:
+            self._subscribers.discard(sub)
+
+    def stats(self):
+        with self._lock:
+            return {'subscribers': len(self._subscribers),
+                    'last_id': self._next_id - 1,
+                    'history': len(self._history),
+                    'published': _PUBLISHED.value(),
+                    'dropped': _DROPPED.value()}
+
+
+class Subscription():
+    """Events for one subscriber. Iterate with events(), which yields
+    None every keepalive seconds while no events arrive"""
+
+    def __init__(self, maxsize):
+        self.backlog = []
+        self.dropped = False
+        self._queue = queue.Queue(maxsize=maxsize)
+
+    def offer(self, event):
+        try:
+            self._queue.put_nowait(event)
+        except queue.Full:
+            self.dropped = True
+            return False
+        return True
+
+    def events(self, keepalive=15):
+        while self.backlog:
+            yield self.backlog.pop(0)
+        while not self.dropped:
+            try:
+                yield self._queue.get(timeout=keepalive)
+            except queue.Empty:
+                yield None
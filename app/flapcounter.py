@@ -0,0 +1,93 @@
+# vim:set shiftwidth=4 softtabstop=4 expandtab:
+'''
+Module: flapcounter.py
+
+Sliding window counters of OK -> problem transitions per alert, used
+by the flapping detection. The counters are rebuilt from alert_log on
+first use, and DBController.log_alert updates them as transitions are
+logged, so the flap detective never has to scan the log table.
+
+Created: 18.Oct.2026
+'''
+import bisect
+import threading
+
+from app import LOGGER
+
+_COUNTERS = {}
+_COUNTERS_LOCK = threading.Lock()
+
+
+def get_flap_counter(db, window):
+    """Return the counter shared by all controllers using the database db,
+    window is the size of the sliding window in minutes"""
+    with _COUNTERS_LOCK:
+        if db not in _COUNTERS:
+            _COUNTERS[db] = FlapCounter(window)
+        return _COUNTERS[db]
+
+
+class FlapCounter():
+    """Transition times within the flapping window per alert hash"""
+
+    def __init__(self, window):
+        self._window = window * 60
+        self._alerts = {}
+        self._loaded = False
+        self._lock = threading.Lock()
+
+    @property
+    def window(self):
+        return self._window
+
+    def ensure_loaded(self, loader):
+        if self._loaded:
+            return
+        with self._lock:
+            if not self._loaded:
+                self._alerts = {}
+                for alhash, alid, environment, t in loader():
+                    self._record(alhash, alid, environment, t)
+                self._loaded = True
+                LOGGER.info("Loaded flap counters for %d alerts",
+                            len(self._alerts))
+
+    def invalidate(self):
+        with self._lock:
+            self._alerts = {}
+            self._loaded = False
+
+    def record(self, alhash, alid, environment, t):
+        with self._lock:
+            if self._loaded:
+                self._record(alhash, alid, environment, t)
+
+    def _record(self, alhash, alid, environment, t):
+        entry = self._alerts.get(alhash)
+        if entry is None:
+            entry = self._alerts[alhash] = {'id': alid, 'times': []}
+        entry['environment'] = environment
+        # Alerts normally arrive in order, so this is an append
+        bisect.insort(entry['times'], t)
+
+    def counts(self, now):
+        """Return (hash, id, environment, count, max interval) for every
+        alert with transitions inside the window. The interval is the
+        longest time between two consecutive transitions, or None"""
+        tlimit = now - self._window
+        res = []
+        with self._lock:
+            for alhash in list(self._alerts):
+                entry = self._alerts[alhash]
+                times = entry['times']
+                if times[0] < tlimit:
+                    del times[:bisect.bisect_left(times, tlimit)]
+                if not times:
+                    del self._alerts[alhash]
+                    continue
+                diff = None
+                if len(times) > 1:
+                    diff = max(b - a for a, b in zip(times, times[1:]))
+                res.append((alhash, entry['id'], entry['environment'],
+                            len(times), diff))
+        return res
@@ -6,19 +6,161 @@ Module: influxcontroller.py
 Created: 27.Dec.2018
 Created by: Morten Hersson, <mhersson@gmail.com>
 '''
+import gzip
+import time
+import threading
+from collections import deque
 import requests
 from influxdb import InfluxDBClient
 from influxdb.exceptions import InfluxDBClientError
+from influxdb.line_protocol import make_lines
 
 from app import app, LOGGER
+from app.targets.session import get_target
+
+_WRITER = {'writer': None}
+_WRITER_LOCK = threading.Lock()
+
+
+def get_writer():
+    """Return the batch writer shared by all controllers"""
+    with _WRITER_LOCK:
+        if _WRITER['writer'] is None:
+            _WRITER['writer'] = BatchWriter(
+                host=app.config['INFLUXDB_HOST'],
+                port=app.config['INFLUXDB_PORT'],
+                database='kap',
+                batch_size=app.config['INFLUXDB_BATCH_SIZE'],
+                flush_interval=app.config['INFLUXDB_FLUSH_INTERVAL'],
+                buffer_size=app.config['INFLUXDB_BUFFER_SIZE'])
+        return _WRITER['writer']
+
+
+class BatchWriter():
+    """Buffers points and series deletes, and writes them to InfluxDB
+    from a background thread
+
+    Points are sent as gzipped line protocol when batch_size points are
+    waiting or the oldest is flush_interval seconds old. Deletes are run
+    in order with the writes. If InfluxDB is unreachable everything stays
+    in the buffer, and when it holds more than buffer_size items the
+    oldest are dropped.
+    """
+
+    def __init__(self, host, port, database, batch_size=500,
+                 flush_interval=5, buffer_size=10000):
+        self._url = "http://{}:{}/write".format(host, port)
+        self._params = {'db': database, 'precision': 'n'}
+        self._client = InfluxDBClient(host=host, port=port,
+                                      database=database)
+        self._http = get_target('influxdb')
+        self._batch_size = batch_size
+        self._flush_interval = flush_interval
+        self._buffer = deque()
+        self._buffer_size = buffer_size
+        self._cond = threading.Condition()
+        self._thread = None
+        self.dropped = 0
+        self.written = 0
+
+    def _add(self, item):
+        with self._cond:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run,
+                                                name="influxdb-writer",
+                                                daemon=True)
+                self._thread.start()
+            self._buffer.append(item)
+            while len(self._buffer) > self._buffer_size:
+                self._buffer.popleft()
+                self.dropped += 1
+            if len(self._buffer) == self._batch_size:
+                self._cond.notify()
+
+    def write(self, point):
+        if 'time' not in point:
+            # Stamp the point now, it may be a while before it is sent
+            point['time'] = int(time.time() * 10**9)
+        self._add(('write', point))
+
+    def delete(self, alhash):
+        self._add(('delete', alhash))
+
+    def _run(self):
+        while True:
+            with self._cond:
+                notified = self._cond.wait(self._flush_interval)
+            # Woken up by a full batch, leave the rest until next interval
+            self.flush(full_batches=notified)
+
+    def flush(self, full_batches=False):
+        while True:
+            with self._cond:
+                if full_batches and len(self._buffer) < self._batch_size:
+                    return
+                items = []
+                while self._buffer and len(items) < self._batch_size:
+                    if items and self._buffer[0][0] != items[0][0]:
+                        break
+                    items.append(self._buffer.popleft())
+                    if items[0][0] == 'delete':
+                        break
+            if not items:
+                return
+            if items[0][0] == 'write':
+                ok = self._send([x[1] for x in items])
+            else:
+                ok = self._delete(items[0][1])
+            if not ok:
+                with self._cond:
+                    # Keep the batch first in line and retry later
+                    self._buffer.extendleft(reversed(items))
+                return
+
+    def _send(self, points):
+        LOGGER.debug("Writing %d points to InfluxDB", len(points))
+        body = gzip.compress(make_lines({'points': points}).encode())
+        res = self._http.post(self._url, params=self._params, data=body,
+                              headers={'Content-Encoding': 'gzip',
+                                       'Content-Type': 'text/plain'})
+        if res is None or res.status_code >= 500:
+            return False
+        if res.status_code >= 400:
+            # InfluxDB will never accept these, so do not retry them
+            LOGGER.error("Error(%s) - %s", res.status_code,
+                         res.content.decode())
+            with self._cond:
+                self.dropped += len(points)
+            return True
+        with self._cond:
+            self.written += len(points)
+        return True
+
+    def _delete(self, alhash):
+        LOGGER.debug("Running delete series")
+        try:
+            self._client.delete_series(measurement="active",
+                                       tags={"hash": alhash})
+        except InfluxDBClientError as err:
+            LOGGER.error("Error(%s) - %s", err.code, err.content)
+        except requests.ConnectionError as err:
+            LOGGER.error(err)
+            return False
+        return True
+
+    def stats(self):
+        with self._cond:
+            return {'buffered': len(self._buffer),
+                    'capacity': self._buffer_size,
+                    'fill': len(self._buffer) / self._buffer_size,
+                    'written': self.written,
+                    'dropped': self.dropped}
 
 
 class InfluxDBController():
     def __init__(self):
         super(InfluxDBController, self).__init__()
-        self._db = InfluxDBClient(host=app.config['INFLUXDB_HOST'],
-                                  port=app.config['INFLUXDB_PORT'],
-                                  database='kap')
+        self._writer = get_writer()
 
     @staticmethod
     def _influxify(al, alhash, measurement, zero_time=False):
@@ -26,13 +168,7 @@ class InfluxDBController():
         # Used to count currently active alerts
         if zero_time:
             LOGGER.debug("Creating zero time data")
-            try:
-                env = [tag['value'] for tag in al.tags
-                       if tag['key'] == 'Environment'][0]
-            except KeyError:
-                env = None
-            if env == ['']:
-                env = None
+            env = al.tags.get('Environment') or None
             json_body = {
                 "measurement": measurement,
                 "tags": {
@@ -55,10 +191,7 @@ class InfluxDBController():
                     "duration": al.duration,
                     "message": al.message}
             }
-            tags = json_body['tags']
-            for t in al.tags:
-                tags[t['key']] = t['value']
-            json_body['tags'] = tags
+            json_body['tags'].update(al.tags.items())
 
         return json_body
 
@@ -77,18 +210,13 @@ class InfluxDBController():
 
     def _update_db(self, data):
         LOGGER.debug("Running insert or update")
-        try:
-            self._db.write_points([data])
-        except InfluxDBClientError as err:
-            LOGGER.error("Error(%s) - %s", err.code, err.content)
-        except requests.ConnectionError as err:
-            LOGGER.error(err)
+        self._writer.write(data)
 
     def delete_active(self, al):
         if app.config['INFLUXDB_ENABLED'] is True:
-            LOGGER.debug("Running delete series")
-            try:
-                self._db.delete_series(measurement="active",
-                                       tags={"hash": al.alhash})
-            except InfluxDBClientError as err:
-                LOGGER.error("Error(%s) - %s", err.code, err.content)
+            self._writer.delete(al.alhash)
+
+    def stats(self):
+        if app.config['INFLUXDB_ENABLED'] is True:
+            return self._writer.stats()
+        return None
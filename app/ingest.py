@@ -0,0 +1,100 @@
+# vim:set shiftwidth=4 softtabstop=4 expandtab:
+'''
+Module: ingest.py
+
+Asynchronous ingest of incoming alerts. Payloads are put on a bounded
+in-process queue and handled by a pool of dispatch workers.
+
+Created: 18.Oct.2026
+'''
+import zlib
+import queue
+import threading
+
+from app import LOGGER
+from app.metrics import REGISTRY
+
+_INGESTED = REGISTRY.counter('kap_ingest_alerts_total',
+                             'Alerts handled by the ingest queue',
+                             ['result'])
+_ACCEPTED = _INGESTED.labels('accepted')
+_DROPPED = _INGESTED.labels('dropped')
+_PROCESSED = _INGESTED.labels('processed')
+_FAILED = _INGESTED.labels('failed')
+
+
+class IngestQueue():
+    """Bounded queue drained by a pool of dispatch workers
+
+    Every worker owns its own queue, and payloads are sharded on the
+    alert id, so all alerts with the same hash are handled by the same
+    worker in the order they were received.
+    """
+
+    def __init__(self, handler, workers=4, maxsize=1000):
+        self._handler = handler
+        self._workers = max(1, workers)
+        shard_size = max(1, maxsize // self._workers)
+        self._queues = [queue.Queue(maxsize=shard_size)
+                        for _ in range(self._workers)]
+        self._threads = []
+
+    def _shard(self, alertid):
+        return zlib.crc32(alertid.encode()) % self._workers
+
+    def put(self, content):
+        try:
+            self._queues[self._shard(content['id'])].put_nowait(content)
+        except queue.Full:
+            _DROPPED.inc()
+            LOGGER.error("Ingest queue is full, dropping alert %s",
+                         content['id'])
+            return False
+        _ACCEPTED.inc()
+        return True
+
+    def _work(self, q):
+        while True:
+            content = q.get()
+            if content is None:
+                q.task_done()
+                break
+            try:
+                self._handler(content)
+                _PROCESSED.inc()
+            except Exception:  # pylint: disable=W0703
+                _FAILED.inc()
+                LOGGER.exception("Failed handling alert %s", content['id'])
+            finally:
+                q.task_done()
+
+    def start(self):
+        LOGGER.info("Starting %d ingest workers", self._workers)
+        for i, q in enumerate(self._queues):
+            t = threading.Thread(target=self._work, args=(q,),
+                                 name="ingest-%d" % i, daemon=True)
+            t.start()
+            self._threads.append(t)
+
+    def stop(self):
+        LOGGER.info("Stopping ingest workers")
+        for q in self._queues:
+            q.put(None)
+        for t in self._threads:
+            t.join()
+        self._threads = []
+
+    def depth(self):
+        return sum(q.qsize() for q in self._queues)
+
+    def capacity(self):
+        return sum(q.maxsize for q in self._queues)
+
+    def stats(self):
+        return {'depth': self.depth(),
+                'capacity': self.capacity(),
+                'workers': self._workers,
+                'accepted': _ACCEPTED.value(),
+                'dropped': _DROPPED.value(),
+                'processed': _PROCESSED.value(),
+                'failed': _FAILED.value()}
@@ -0,0 +1,91 @@
+# vim:set shiftwidth=4 softtabstop=4 expandtab:
+'''
+Module: leader.py
+
+Leader election between KAP processes sharing one database. The leader
+holds an exclusive lock on a file and runs the scheduled jobs, the
+other processes only serve requests and keep trying to take the lock.
+The operating system releases the lock when the leader exits, so one
+of the others takes over.
+
+Created: 18.Oct.2026
+'''
+import os
+import fcntl
+import threading
+
+from app import LOGGER
+
+
+class FileLock():
+    """Exclusive lock on path, held until released or the process exits"""
+
+    def __init__(self, path):
+        self.path = path
+        self._fd = None
+
+    @property
+    def locked(self):
+        return self._fd is not None
+
+    def acquire(self, blocking=True):
+        if self._fd is not None:
+            return True
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        flags = fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB
+        try:
+            fcntl.flock(fd, flags)
+        except OSError:
+            os.close(fd)
+            return False
+        os.ftruncate(fd, 0)
+        os.write(fd, str(os.getpid()).encode())
+        self._fd = fd
+        return True
+
+    def release(self):
+        if self._fd is not None:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+            os.close(self._fd)
+            self._fd = None
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *args):
+        self.release()
+
+
+class LeaderElection():
+    """Calls on_elected once this process holds the lock on path"""
+
+    def __init__(self, path, on_elected, interval=10):
+        self._lock = FileLock(path)
+        self._on_elected = on_elected
+        self._interval = interval
+        self._stop = threading.Event()
+        self._thread = None
+
+    @property
+    def is_leader(self):
+        return self._lock.locked
+
+    def _run(self):
+        while not self._stop.is_set():
+            if self._lock.acquire(blocking=False):
+                LOGGER.info("Elected leader, pid %d", os.getpid())
+                self._on_elected()
+                return
+            self._stop.wait(self._interval)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run,
+                                        name="leader-election", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+        self._lock.release()
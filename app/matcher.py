@@ -0,0 +1,203 @@
+# vim:set shiftwidth=4 softtabstop=4 expandtab:
+'''
+Module: matcher.py
+
+Compiled matcher for maintenance rules. The matcher is built once per
+rule set, and matching an alert costs time proportional to the length
+of its tag values, not to the number of rules.
+
+The exclude lists of the targets are compiled the same way, into sets
+of excluded tags.
+
+Created: 18.Oct.2026
+'''
+import threading
+from collections import deque
+
+_LOCK = threading.Lock()
+_COMPILED = {'source': None, 'rules': None, 'matcher': None}
+_FILTERS = {}
+
+
+class Trie():
+    """Character trie answering whether any stored string is a prefix
+    of a given string"""
+
+    def __init__(self):
+        self._root = {}
+
+    def add(self, word):
+        node = self._root
+        for ch in word:
+            node = node.setdefault(ch, {})
+        node[None] = True
+
+    def has_prefix_of(self, s):
+        node = self._root
+        if None in node:
+            return True
+        for ch in s:
+            node = node.get(ch)
+            if node is None:
+                return False
+            if None in node:
+                return True
+        return False
+
+
+class AhoCorasick():
+    """Aho-Corasick automaton answering whether any stored string is a
+    substring of a given string"""
+
+    def __init__(self, words):
+        self._goto = [{}]
+        self._fail = [0]
+        self._out = [False]
+        for word in words:
+            self._add(word)
+        self._build()
+
+    def _add(self, word):
+        state = 0
+        for ch in word:
+            nxt = self._goto[state].get(ch)
+            if nxt is None:
+                nxt = len(self._goto)
+                self._goto.append({})
+                self._fail.append(0)
+                self._out.append(False)
+                self._goto[state][ch] = nxt
+            state = nxt
+        self._out[state] = True
+
+    def _build(self):
+        todo = deque(self._goto[0].values())
+        while todo:
+            state = todo.popleft()
+            for ch, nxt in self._goto[state].items():
+                todo.append(nxt)
+                f = self._fail[state]
+                while f and ch not in self._goto[f]:
+                    f = self._fail[f]
+                self._fail[nxt] = self._goto[f].get(ch, 0)
+                if self._out[self._fail[nxt]]:
+                    self._out[nxt] = True
+
+    def search(self, s):
+        if self._out[0]:
+            return True
+        state = 0
+        for ch in s:
+            while state and ch not in self._goto[state]:
+                state = self._fail[state]
+            state = self._goto[state].get(ch, 0)
+            if self._out[state]:
+                return True
+        return False
+
+
+class MaintenanceMatcher():
+    """Matches alerts against a set of maintenance rules
+
+    A rule matches if the alert has a tag with the rule key and a value
+    equal to the rule value. A leading or trailing * matches any
+    suffix or prefix of the tag value, and rules with the key id match
+    any alert whose id contains the rule value.
+    """
+
+    def __init__(self, mrules):
+        self._exact = {}
+        self._prefix = {}
+        self._suffix = {}
+        ids = []
+        for mrule in mrules:
+            key = mrule['key']
+            value = mrule['value']
+            if not value:
+                continue
+            if key == 'id':
+                ids.append(value.strip('*'))
+            if value[-1] == '*':
+                self._prefix.setdefault(key, Trie()).add(value[:-1])
+            if value[0] == '*':
+                self._suffix.setdefault(key, Trie()).add(value[:0:-1])
+            self._exact.setdefault(key, set()).add(value)
+        self._ids = AhoCorasick(ids) if ids else None
+
+    def matches(self, al):
+        if self._ids and self._ids.search(al.id):
+            return True
+        for key, value in al.tags.items():
+            if value is None:
+                continue
+            exact = self._exact.get(key)
+            if exact and value in exact:
+                return True
+            prefix = self._prefix.get(key)
+            if prefix and prefix.has_prefix_of(value):
+                return True
+            suffix = self._suffix.get(key)
+            if suffix and suffix.has_prefix_of(value[::-1]):
+                return True
+        return False
+
+
+def compile_rules(mrules):
+    """Return a matcher for mrules, rebuilt only when the rules change"""
+    with _LOCK:
+        # Callers matching many alerts pass the same list every time
+        if _COMPILED['source'] is mrules:
+            return _COMPILED['matcher']
+        rules = tuple((r['key'], r['value']) for r in mrules)
+        if _COMPILED['rules'] != rules:
+            _COMPILED['matcher'] = MaintenanceMatcher(mrules)
+            _COMPILED['rules'] = rules
+        _COMPILED['source'] = mrules
+        return _COMPILED['matcher']
+
+
+class ExclusionFilter():
+    """Excluded tags and tick scripts of a target. Checking an alert
+    costs time proportional to its number of tags"""
+
+    def __init__(self, excluded, ticks=()):
+        self._pairs = frozenset((t['key'], t['value']) for t in excluded)
+        # MonGroup is a special tag that can have multiple pipe
+        # separated values, excluded if any of them is
+        self._mongroups = frozenset(t['value'] for t in excluded
+                                    if t['key'] == 'MonGroup')
+        self._ticks = frozenset(ticks)
+
+    def excluded_tag(self, tags):
+        """Return the first excluded key and value pair in tags, or None"""
+        if not self._pairs:
+            return None
+        for t in tags.items():
+            if t in self._pairs:
+                return t
+            if t[0] == 'MonGroup' and self._mongroups and \
+                    not self._mongroups.isdisjoint(t[1].split('|')):
+                return t
+        return None
+
+    def excluded_tick(self, alertid):
+        """Return the tick script name if it is excluded, or None"""
+        if not self._ticks:
+            return None
+        # This only works if {{ .TaskName }} is the last element of the id
+        tn = alertid.rsplit(None, 1)[-1]
+        return tn if tn in self._ticks else None
+
+
+def compile_exclusions(excluded, ticks=()):
+    """Return the filter for the excluded tags and ticks, built once per
+    pair of lists"""
+    key = (id(excluded), id(ticks))
+    with _LOCK:
+        cached = _FILTERS.get(key)
+        # Keep the lists, so their ids are not reused
+        if cached is None or cached[0] is not excluded or \
+                cached[1] is not ticks:
+            cached = (excluded, ticks, ExclusionFilter(excluded, ticks))
+            _FILTERS[key] = cached
+        return cached[2]
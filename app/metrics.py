@@ -0,0 +1,290 @@
+# vim:set shiftwidth=4 softtabstop=4 expandtab:
+'''
+Module: metrics.py
+
+Counters, histograms and gauges served at /kap/metrics in the
+Prometheus text exposition format.
+
+Metrics with labels are bound to their label values once, typically at
+import time, and every thread updates its own shard of the values, so
+updating a metric takes no locks. Shards are summed when the metrics
+are collected. Shards of threads that have exited are folded into a
+base value at collection, and when new threads keep adding shards.
+
+Created: 18.Oct.2026
+'''
+import time
+import bisect
+import functools
+import threading
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25,
+                   0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+class _Shards():
+    """One list of values per thread"""
+
+    def __init__(self, size):
+        self._size = size
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._shards = []
+        self._base = [0] * size
+        # Fold the shards of exited threads when there are this many
+        self._limit = 64
+
+    def get(self):
+        try:
+            return self._local.shard
+        except AttributeError:
+            shard = [0] * self._size
+            with self._lock:
+                if len(self._shards) >= self._limit:
+                    # Threads started per request exit soon, do not keep
+                    # their shards until the next collection
+                    self._fold()
+                    self._limit = max(64, 2 * len(self._shards))
+                self._shards.append((threading.current_thread(), shard))
+            self._local.shard = shard
+            return shard
+
+    def _fold(self):
+        alive = []
+        for thread, shard in self._shards:
+            if thread.is_alive():
+                alive.append((thread, shard))
+            else:
+                self._base = [a + b for a, b in zip(self._base, shard)]
+        self._shards = alive
+
+    def values(self):
+        with self._lock:
+            self._fold()
+            res = list(self._base)
+            for _, shard in self._shards:
+                res = [a + b for a, b in zip(res, shard)]
+        return res
+
+    def __len__(self):
+        with self._lock:
+            return len(self._shards)
+
+
+class CounterChild():
+    def __init__(self):
+        self._shards = _Shards(1)
+
+    def inc(self, amount=1):
+        self._shards.get()[0] += amount
+
+    def value(self):
+        return self._shards.values()[0]
+
+
+class HistogramChild():
+    def __init__(self, buckets):
+        self._buckets = buckets
+        # One slot per bucket, then +Inf, sum and count
+        self._shards = _Shards(len(buckets) + 3)
+
+    def observe(self, value):
+        shard = self._shards.get()
+        shard[bisect.bisect_left(self._buckets, value)] += 1
+        shard[-2] += value
+        shard[-1] += 1
+
+    def time(self):
+        return _Timer(self)
+
+    def values(self):
+        return self._shards.values()
+
+
+class _Timer():
+    def __init__(self, child):
+        self._child = child
+        self._start = None
+
+    def __enter__(self):
+        self._start = time.time()
+        return self
+
+    def __exit__(self, *args):
+        self._child.observe(time.time() - self._start)
+
+    def __call__(self, func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            start = time.time()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self._child.observe(time.time() - start)
+        return wrapper
+
+
+class _Metric():
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children = {}
+        self._lock = threading.Lock()
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def labels(self, *values):
+        """Return the child for the label values, bind it once and keep
+        it rather than calling this on the hot path"""
+        values = tuple(str(v) for v in values)
+        if len(values) != len(self.labelnames):
+            raise ValueError("Wrong number of labels for %s" % self.name)
+        with self._lock:
+            child = self._children.get(values)
+            if child is None:
+                child = self._children[values] = self._new_child()
+            return child
+
+    def _items(self):
+        with self._lock:
+            return sorted(self._children.items())
+
+    def _labelstr(self, values, extra=None):
+        pairs = list(zip(self.labelnames, values))
+        if extra:
+            pairs.append(extra)
+        if not pairs:
+            return ""
+        return "{" + ",".join('%s="%s"' % (k, _escape(v))
+                              for k, v in pairs) + "}"
+
+    def expose(self):
+        lines = ["# HELP %s %s" % (self.name, self.documentation),
+                 "# TYPE %s %s" % (self.name, self.kind)]
+        lines.extend(self._samples())
+        return lines
+
+    def _samples(self):
+        raise NotImplementedError
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def _new_child(self):
+        return CounterChild()
+
+    def inc(self, amount=1):
+        self.labels().inc(amount)
+
+    def _samples(self):
+        return ["%s%s %s" % (self.name, self._labelstr(k), _fmt(c.value()))
+                for k, c in self._items()]
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(),
+                 buckets=DEFAULT_BUCKETS):
+        super(Histogram, self).__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def _new_child(self):
+        return HistogramChild(self.buckets)
+
+    def observe(self, value):
+        self.labels().observe(value)
+
+    def time(self):
+        return self.labels().time()
+
+    def _samples(self):
+        lines = []
+        for k, c in self._items():
+            values = c.values()
+            cumulative = 0
+            for le, n in zip(self.buckets + ('+Inf',), values):
+                cumulative += n
+                lines.append("%s_bucket%s %s" % (
+                    self.name, self._labelstr(k, ('le', _fmt(le))),
+                    _fmt(cumulative)))
+            lines.append("%s_sum%s %s" % (self.name, self._labelstr(k),
+                                          _fmt(values[-2])))
+            lines.append("%s_count%s %s" % (self.name, self._labelstr(k),
+                                            _fmt(values[-1])))
+        return lines
+
+
+class Gauge(_Metric):
+    """Gauge read from a callback when collected. The callback returns a
+    number, or a dict from label value tuples to numbers when the gauge
+    has labels. None values are left out"""
+    kind = 'gauge'
+
+    def __init__(self, name, documentation, func, labelnames=()):
+        super(Gauge, self).__init__(name, documentation, labelnames)
+        self._func = func
+
+    def _samples(self):
+        value = self._func()
+        if not self.labelnames:
+            value = {(): value}
+        return ["%s%s %s" % (self.name, self._labelstr(k), _fmt(v))
+                for k, v in sorted((value or {}).items()) if v is not None]
+
+
+class Registry():
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _register(self, metric):
+        with self._lock:
+            if metric.name in self._metrics:
+                return self._metrics[metric.name]
+            self._metrics[metric.name] = metric
+            return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self._register(Counter(name, documentation, labelnames))
+
+    def histogram(self, name, documentation, labelnames=(),
+                  buckets=DEFAULT_BUCKETS):
+        return self._register(
+            Histogram(name, documentation, labelnames, buckets))
+
+    def gauge(self, name, documentation, func, labelnames=()):
+        return self._register(Gauge(name, documentation, func, labelnames))
+
+    def expose(self):
+        with self._lock:
+            metrics = sorted(self._metrics.values(), key=lambda m: m.name)
+        lines = []
+        for metric in metrics:
+            try:
+                lines.extend(metric.expose())
+            except Exception:  # pylint: disable=W0703
+                # A failing gauge callback must not break the endpoint
+                continue
+        return "\n".join(lines) + "\n"
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace(
+        "\n", "\\n").replace('"', '\\"')
+
+
+def _fmt(value):
+    if isinstance(value, str):
+        return value
+    if isinstance(value, float):
+        return repr(value)
+    return str(int(value))
+
+
+REGISTRY = Registry()
@@ -0,0 +1,316 @@
+# vim:set shiftwidth=4 softtabstop=4 expandtab:
+'''
+Module: outbox.py
+
+Durable delivery of notifications. The targets write every
+notification to the outbox table and return, and the sender delivers
+them in the background, retrying failed deliveries with exponential
+backoff until they succeed or expire. Requests are sent once, the sender
+schedules all retries, and a 429 holds back the target for as long as
+its Retry-After asks. Every notification carries an Idempotency-Key
+header, so a receiver can drop a redelivery.
+
+During alert storms notifications for alerts in the same group, see
+coalesce_key, are held for a short window and sent as one digest, and
+token buckets limit the request rate to each target and channel. The
+resolve of an incident shared by a group is held until no active alert
+or pending notification has its key, as checked on every delivery.
+
+Created: 18.Oct.2026
+'''
+import json
+import time
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from urllib3.exceptions import InvalidHeader
+from urllib3.util.retry import Retry
+
+from app import app, LOGGER
+from app.dbcontroller import DBController
+from app.metrics import REGISTRY
+from app.targets.session import get_target
+
+_DELIVERIES = REGISTRY.counter('kap_outbox_deliveries_total',
+                               'Outbox delivery attempts',
+                               ['target', 'result'])
+REGISTRY.gauge('kap_outbox_backlog', 'Notifications waiting in the outbox',
+               lambda: DBController().outbox_size())
+
+_SENDER = {'sender': None}
+_SENDER_LOCK = threading.Lock()
+
+
+def get_sender():
+    """Return the outbox sender of this process"""
+    with _SENDER_LOCK:
+        if _SENDER['sender'] is None:
+            _SENDER['sender'] = OutboxSender(
+                workers=app.config['OUTBOX_WORKERS'],
+                batch_size=app.config['OUTBOX_BATCH_SIZE'],
+                interval=app.config['OUTBOX_POLL_INTERVAL'])
+        return _SENDER['sender']
+
+
+def coalesce_key(al):
+    """Return the coalescing group of the alert, or None when coalescing
+    is disabled"""
+    if not app.config['COALESCE_ENABLED']:
+        return None
+    values = []
+    for key in app.config['COALESCE_KEYS']:
+        if key == 'task':
+            # Only works if {{ .TaskName }} is the last element of the id
+            values.append(al.id.split()[-1])
+        else:
+            values.append(al.tags.get(key, ''))
+    return ", ".join(values)
+
+
+def incident_key(group):
+    """Return the PagerDuty incident key shared by the alerts in group"""
+    return "kap-" + hashlib.sha256(group.encode()).hexdigest()[:16]
+
+
+def enqueue(target, url, message, alhash=None, kind=None, group=None,
+            incident=None):
+    """Queue message for delivery to url. With alhash and kind set, the
+    newest pending message for the alert is replaced if it is of the same
+    kind, older ones are always delivered. Messages
+    with a group are held for the coalescing window and sent as one
+    digest. A resolve of a shared incident replaces the pending resolve
+    of the incident"""
+    dedup_key = None
+    if incident and kind == 'resolve':
+        dedup_key = "{}:{}:{}".format(target, incident, kind)
+    elif alhash and kind:
+        dedup_key = "{}:{}:{}".format(target, alhash, kind)
+    delay = app.config['COALESCE_WINDOW'] if group else 0
+    DBController().outbox_put(target, url, json.dumps(message),
+                              alhash=alhash, dedup_key=dedup_key,
+                              group_key=group, delay=delay,
+                              incident_key=incident)
+    if not group:
+        get_sender().notify()
+
+
+def _backoff(attempts):
+    return min(app.config['OUTBOX_BACKOFF'] * 2 ** (attempts - 1),
+               app.config['OUTBOX_MAX_BACKOFF'])
+
+
+def _retry_after(res):
+    """Return the seconds to wait given by the Retry-After header of res"""
+    try:
+        return Retry().parse_retry_after(res.headers.get('Retry-After'))
+    except (InvalidHeader, TypeError):
+        return 0
+
+
+def _slack_digest(group, payloads):
+    size = app.config['COALESCE_DIGEST_SIZE']
+    digest = dict(payloads[0])
+    attachments = [a for p in payloads for a in p['attachments']]
+    if len(attachments) > size:
+        more = len(attachments) - size
+        attachments = attachments[:size] + [
+            {'fallback': "... and {} more".format(more),
+             'text': "... and {} more".format(more)}]
+    digest['text'] = "{} alerts for {}".format(len(payloads), group)
+    digest['attachments'] = attachments
+    return digest
+
+
+def _pagerduty_digest(group, payloads):
+    digest = dict(payloads[0])
+    digest['description'] = "{} alerts for {}".format(len(payloads), group)
+    digest['details'] = {'alerts': [p['description'] for p in payloads]}
+    return digest
+
+
+_DIGESTS = {'slack': _slack_digest, 'pagerduty': _pagerduty_digest}
+
+
+class TokenBucket():
+    """Allows rate requests per second, with bursts of up to burst"""
+
+    def __init__(self, rate, burst):
+        self._rate = rate
+        self._burst = burst
+        self._tokens = burst
+        self._last = time.monotonic()
+
+    def wait(self):
+        """Return the seconds until a token is available"""
+        now = time.monotonic()
+        self._tokens = min(self._burst,
+                           self._tokens + (now - self._last) * self._rate)
+        self._last = now
+        return max(0, (1 - self._tokens) / self._rate)
+
+    def take(self):
+        self._tokens -= 1
+
+
+class OutboxSender():
+    def __init__(self, workers=8, batch_size=100, interval=1):
+        self._db = DBController()
+        self._workers = workers
+        self._batch_size = batch_size
+        self._interval = interval
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._pool = None
+        self._thread = None
+        self._buckets = {}
+        self._blocked = {}
+
+    def notify(self):
+        self._wake.set()
+
+    def _bucket(self, key, rates):
+        if key not in self._buckets:
+            rate = rates.get(key if isinstance(key, str) else key[0])
+            self._buckets[key] = TokenBucket(*rate) if rate else None
+        return self._buckets[key]
+
+    def _allowed(self, target, url):
+        """Take a token from the buckets of target and url. When either
+        of them is empty the target is blocked until it has a token, and
+        False is returned"""
+        if self._blocked.get(target, 0) > time.monotonic():
+            return False
+        buckets = [b for b in (
+            self._bucket(target, app.config['OUTBOX_TARGET_RATES']),
+            self._bucket((target, url), app.config['OUTBOX_CHANNEL_RATES']))
+                   if b is not None]
+        wait = max([b.wait() for b in buckets] + [0])
+        if wait:
+            self._blocked[target] = time.monotonic() + wait
+            return False
+        for b in buckets:
+            b.take()
+        return True
+
+    def _held(self, item):
+        """True for the resolve of a shared incident still in use"""
+        if not item[7] or json.loads(item[4]).get('event_type') != 'resolve':
+            return False
+        return self._db.outbox_incident_open(item[7], item[0])
+
+    def _coalesce(self, item):
+        """Return the ids of the notifications in the group of item, and
+        the digest to send for them"""
+        target, group = item[1], item[6]
+        members = self._db.outbox_group(target, group)
+        if len(members) < 2 or target not in _DIGESTS:
+            return [item[0]], item[4]
+        digest = _DIGESTS[target](group, [json.loads(p) for _, p in members])
+        LOGGER.info("Sending digest of %d notifications for %s to %s",
+                    len(members), group, target)
+        return [i for i, _ in members], json.dumps(digest)
+
+    def _deliver(self, unit):
+        """Return the result of the delivery, the error, and the seconds
+        the target asked to wait before the next request"""
+        item, _, payload = unit
+        target, url, idempotency_key = item[1:4]
+        res = get_target(target, retry=False).post(
+            url, data=payload,
+            headers={'Content-Type': 'application/json',
+                     'Idempotency-Key': idempotency_key})
+        if res is None:
+            return 'failed', "Connection failed", 0
+        if res.status_code < 300:
+            return 'delivered', None, 0
+        if res.status_code == 429:
+            return 'failed', "HTTP 429", _retry_after(res)
+        if res.status_code < 500:
+            return 'rejected', "HTTP %d" % res.status_code, 0
+        return 'failed', "HTTP %d" % res.status_code, 0
+
+    def flush(self):
+        """Deliver one batch of due notifications, returns the number of
+        deliveries attempted. Notifications held back by the rate limits
+        stay in the outbox"""
+        # Leave out blocked targets, so they do not hold back the others
+        now = time.monotonic()
+        blocked = [t for t, until in self._blocked.items() if until > now]
+        items = self._db.outbox_due(self._batch_size, skip=blocked)
+        if not items:
+            return 0
+        if self._pool is None:
+            self._pool = ThreadPoolExecutor(max_workers=self._workers,
+                                            thread_name_prefix="outbox")
+        units = []
+        seen = set()
+        held = []
+        for item in items:
+            if item[0] in seen:
+                continue
+            if self._held(item):
+                # Checked again after the coalescing window, without
+                # using an attempt
+                held.append((item[5], time.time() +
+                             app.config['COALESCE_WINDOW'], None, item[0]))
+                _DELIVERIES.labels(item[1], 'held').inc()
+                continue
+            if not self._allowed(item[1], item[2]):
+                _DELIVERIES.labels(item[1], 'limited').inc()
+                continue
+            if item[6]:
+                ids, payload = self._coalesce(item)
+            else:
+                ids, payload = [item[0]], item[4]
+            seen.update(ids)
+            units.append((item, ids, payload))
+        done = []
+        retries = held
+        now = time.time()
+        for unit, (result, error, wait) in zip(
+                units, self._pool.map(self._deliver, units)):
+            item, ids, _ = unit
+            attempts = item[5] + 1
+            if wait:
+                self._blocked[item[1]] = max(self._blocked.get(item[1], 0),
+                                             time.monotonic() + wait)
+            if result == 'failed' and \
+                    attempts >= app.config['OUTBOX_MAX_ATTEMPTS']:
+                result = 'expired'
+            _DELIVERIES.labels(item[1], result).inc()
+            if result == 'failed':
+                retry = now + max(_backoff(attempts), wait)
+                retries.extend((attempts, retry, error, i) for i in ids)
+            else:
+                if result != 'delivered':
+                    LOGGER.error("Dropping notification to %s after %d "
+                                 "attempts: %s", item[1], attempts, error)
+                done.extend(ids)
+        self._db.outbox_done(done, retries)
+        return len(units)
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                sent = self.flush()
+            except Exception:  # pylint: disable=W0703
+                LOGGER.exception("Outbox delivery failed")
+                sent = 0
+            if not sent:
+                self._wake.wait(self._interval)
+                self._wake.clear()
+
+    def start(self):
+        LOGGER.info("Starting outbox sender")
+        self._thread = threading.Thread(target=self._run, name="outbox",
+                                        daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._wake.set()
+        if self._thread:
+            self._thread.join()
+        if self._pool:
+            self._pool.shutdown(wait=True)
@@ -0,0 +1,77 @@
+# vim:set shiftwidth=4 softtabstop=4 expandtab:
+'''
+Module: payload.py
+
+Decoder for the alert payloads posted by Kapacitor. Uses orjson when it
+is installed. The values of the series are dropped after decoding, KAP
+only uses the tags, and batch tasks can send thousands of values with
+every alert.
+
+Created: 18.Oct.2026
+'''
+import re
+import json
+from datetime import date
+
+try:
+    import orjson
+    loads = orjson.loads
+except ImportError:
+    loads = json.loads
+
+_RFC3339 = re.compile(r"(\d{4})-(\d\d)-(\d\d)[Tt ](\d\d):(\d\d):(\d\d)"
+                      r"(\.\d+)?(?:[Zz]|([+-])(\d\d):(\d\d))?$")
+_EPOCH = date(1970, 1, 1).toordinal()
+
+
+def _drop_values(content):
+    try:
+        for s in content['data']['series']:
+            s.pop('values', None)
+    except (KeyError, TypeError, AttributeError):
+        # Invalid payloads are rejected by valid_payload
+        pass
+    return content
+
+
+def decode(data):
+    """Return the alert payload in data, or None if it is not JSON"""
+    try:
+        return _drop_values(loads(data))
+    except ValueError:
+        return None
+
+
+def decode_batch(data):
+    """Return the alert payloads in a JSON array or in newline delimited
+    JSON. Lines that are not JSON are returned as None. Returns None if
+    data is not a valid array"""
+    data = data.strip()
+    if data[:1] in (b'[', '['):
+        try:
+            contents = loads(data)
+        except ValueError:
+            return None
+        return [_drop_values(c) for c in contents]
+    return [decode(line) for line in data.splitlines() if line.strip()]
+
+
+def parse_time(datestr):
+    """Return the RFC3339 time in datestr as seconds since the epoch,
+    with the fraction of a second. Times without an offset are UTC.
+    Raises ValueError if datestr is not a valid time"""
+    m = _RFC3339.match(datestr) if isinstance(datestr, str) else None
+    if m is None:
+        raise ValueError("Invalid time %r" % (datestr,))
+    year, month, day, hour, minute, sec, frac, sign, oh, om = m.groups()
+    if int(hour) > 23 or int(minute) > 59 or int(sec) > 60 or \
+            (sign and (int(oh) > 23 or int(om) > 59)):
+        raise ValueError("Invalid time %r" % (datestr,))
+    days = date(int(year), int(month), int(day)).toordinal() - _EPOCH
+    ts = days * 86400 + int(hour) * 3600 + int(minute) * 60 + int(sec)
+    if sign:
+        offset = int(oh) * 3600 + int(om) * 60
+        ts = ts - offset if sign == '+' else ts + offset
+    if frac:
+        ts += float(frac)
+    return ts
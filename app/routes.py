@@ -7,66 +7,172 @@ Created: 23.Mar.2018
 Created by: Morten Hersson, <mhersson@gmail.com>
 '''
 import time
+import json
 import calendar
 import operator
 from datetime import timedelta
+from urllib.parse import urlencode
 from flask import Response, request, render_template, redirect, jsonify
+from flask import stream_with_context
 from app import app, LOGGER, TZNAME
 from app.forms.maintenance import ActivateForm, DeactivateForm, DeleteSchedule
 from app.forms.maintenance import QuickActivate
+from app.alert import alert_hash
 from app.alertcontroller import AlertController
-from app.dbcontroller import DBController
+from app.cluster import get_cluster, ForwardError, FORWARDED_HEADER
+from app.dbcontroller import DBController, LOG_FILTERS
+from app.ingest import IngestQueue
+from app.events import get_broadcaster
+from app.targets.session import target_stats
+from app.metrics import REGISTRY
+from app.payload import decode, decode_batch
 
 
 alertcontroller = AlertController()
 db = DBController()
+ingest = IngestQueue(alertcontroller.handle_alert,
+                     workers=app.config['INGEST_WORKERS'],
+                     maxsize=app.config['INGEST_QUEUE_SIZE'])
+
+_RECEIVED = REGISTRY.counter('kap_alerts_received_total',
+                             'Alerts received on /kap/alert', ['result'])
+_RECEIVED_OK = _RECEIVED.labels('handled')
+_RECEIVED_QUEUED = _RECEIVED.labels('queued')
+_RECEIVED_DROPPED = _RECEIVED.labels('dropped')
+_RECEIVED_INVALID = _RECEIVED.labels('invalid')
+REGISTRY.gauge('kap_ingest_queue_depth', 'Alerts waiting in ingest queue',
+               ingest.depth)
+REGISTRY.gauge('kap_ingest_queue_capacity', 'Size of the ingest queue',
+               ingest.capacity)
+REGISTRY.gauge('kap_active_alerts', 'Alerts in the active alert cache',
+               lambda: (db.cache_stats() or {}).get('size'))
+REGISTRY.gauge('kap_event_subscribers', 'Clients of /kap/stream',
+               lambda: get_broadcaster().stats()['subscribers'])
+REGISTRY.gauge('kap_active_alert_cache_lookups', 'Active alert cache lookups',
+               lambda: {(k,): (db.cache_stats() or {}).get(k)
+                        for k in ('hits', 'misses', 'mismatches')},
+               ['result'])
+REGISTRY.gauge('kap_influxdb_buffer_fill', 'Fill level of InfluxDB buffer',
+               lambda: (alertcontroller.influx_stats() or {}).get('fill'))
+REGISTRY.gauge('kap_influxdb_points_dropped', 'Points dropped by InfluxDB '
+               'buffer', lambda: (alertcontroller.influx_stats() or {}).get(
+                   'dropped'))
 
 
 @app.route("/kap/alert", methods=['post'])
 def alert():
     LOGGER.info("Received new data")
-    al = alertcontroller.create_alert(request.json)
-    if al is not None:
-        al = db.get_tickets_and_keys(al)
-        if not al.grafana_url:
-            al.grafana_url = alertcontroller.add_grafana_url(al)
-        LOGGER.info("Alert info:\n%s\n%s -> %s, Duration: %d\n"
-                    "State duration: %s, Sent: %s\nJIRA: %s, PD: %s",
-                    al.id, al.previouslevel, al.level, al.duration,
-                    al.state_duration, al.sent,
-                    al.jira_issue, al.pd_incident_key)
-        if al.sent:
-            if al.level != al.previouslevel:
-                LOGGER.info("State has changed, notify targets")
-                alertcontroller.dispatch_and_update_status(al)
-            else:
-                LOGGER.info("No change, updating existing alert")
-                alertcontroller.dispatch_and_update_status(al, dispatch=False)
-            return Response(response={'Success': True},
-                            status=200, mimetype='application/json')
-        else:
-            if app.config['FLAPPING_DETECTION_ENABLED'] and db.is_flapping(al):
-                LOGGER.info("Alert is flapping")
-                al.message = "Flapping! " + al.message
-                alertcontroller.dispatch_and_update_status(al, dispatch=False)
-                return Response(response={'Success': True},
-                                status=200, mimetype='application/json')
-            if al.state_duration:
-                LOGGER.info("Alert delayed by state duration, no dispatch")
-                alertcontroller.dispatch_and_update_status(al, dispatch=False)
-            elif al.duration < app.config['ALERTING_DELAY']:
-                LOGGER.info("Alert delayed, no dispatch")
-                alertcontroller.dispatch_and_update_status(al, dispatch=False)
-            elif al.level == 'OK':
-                LOGGER.info("Alert OK without being sent, no dispatch")
-                alertcontroller.dispatch_and_update_status(al, dispatch=False)
-            else:
-                LOGGER.info("New alert, notify targets")
-                alertcontroller.dispatch_and_update_status(al)
+    content = decode(request.get_data())
+    if not alertcontroller.valid_payload(content):
+        _RECEIVED_INVALID.inc()
+        return jsonify(Success=False), 400
+    if (app.config['CLUSTER_ENABLED'] and
+            not request.headers.get(FORWARDED_HEADER)):
+        try:
+            res = get_cluster().forward(alert_hash(content['id']),
+                                        request.get_data())
+        except ForwardError:
+            return jsonify(Success=False), 503
+        if res is not None:
+            return Response(response=res.content, status=res.status_code,
+                            mimetype='application/json')
+    if app.config['INGEST_ASYNC_ENABLED']:
+        if not ingest.put(content):
+            _RECEIVED_DROPPED.inc()
+            return jsonify(Success=False), 503
+        _RECEIVED_QUEUED.inc()
+        return jsonify(Success=True), 202
+    alertcontroller.handle_alert(content)
+    _RECEIVED_OK.inc()
     return Response(response={'Success': True},
                     status=200, mimetype='application/json')
 
 
+@app.route("/kap/alerts/batch", methods=['POST'])
+def alerts_batch():
+    contents = decode_batch(request.get_data())
+    if contents is None:
+        return jsonify(Success=False), 400
+    if len(contents) > app.config['BATCH_MAX_ALERTS']:
+        return jsonify(Success=False), 413
+    results = [None] * len(contents)
+    if (app.config['CLUSTER_ENABLED'] and
+            not request.headers.get(FORWARDED_HEADER)):
+        valid = [i for i, content in enumerate(contents)
+                 if alertcontroller.valid_payload(content)]
+        forwarded = get_cluster().forward_batch(
+            [(alert_hash(contents[i]['id']), contents[i]) for i in valid])
+        for i, res in zip(valid, forwarded):
+            results[i] = res
+    local = [i for i, res in enumerate(results) if res is None]
+    for i, res in zip(local, alertcontroller.handle_batch(
+            [contents[i] for i in local])):
+        results[i] = res
+    for res in results:
+        if res['Success']:
+            _RECEIVED_OK.inc()
+        else:
+            _RECEIVED_INVALID.inc()
+    return jsonify(Success=all(r['Success'] for r in results),
+                   results=results)
+
+
+@app.route("/kap/stats", methods=['GET'])
+def stats():
+    return jsonify(ingest=ingest.stats(),
+                   active_alert_cache=db.cache_stats(),
+                   sqlite=db.pool_stats(),
+                   targets=target_stats(),
+                   influxdb=alertcontroller.influx_stats(),
+                   events=get_broadcaster().stats(),
+                   outbox={'backlog': db.outbox_size()},
+                   cluster=get_cluster().stats()
+                   if app.config['CLUSTER_ENABLED'] else None)
+
+
+@app.route("/kap/cluster", methods=['GET'])
+def cluster():
+    if not app.config['CLUSTER_ENABLED']:
+        return jsonify(Success=False), 404
+    return jsonify(get_cluster().stats())
+
+
+@app.route("/kap/metrics", methods=['GET'])
+def metrics():
+    return Response(response=REGISTRY.expose(), status=200,
+                    mimetype='text/plain; version=0.0.4')
+
+
+@app.route("/kap/stream", methods=['GET'])
+def event_stream():
+    # Events are only seen by the process they happen in
+    if (not app.config['EVENT_STREAM_ENABLED'] or
+            app.config['MULTI_PROCESS']):
+        return jsonify(Success=False), 404
+    try:
+        last_id = request.headers.get('Last-Event-ID') or \
+            request.args.get('last_event_id')
+        last_id = int(last_id) if last_id else None
+    except ValueError:
+        last_id = None
+    broadcaster = get_broadcaster()
+    sub = broadcaster.subscribe(last_id)
+
+    def generate():
+        try:
+            yield "retry: 3000\n\n"
+            for event in sub.events(app.config['EVENT_KEEPALIVE']):
+                if event is None:
+                    yield ": keepalive\n\n"
+                else:
+                    yield "id: %d\nevent: %s\ndata: %s\n\n" % event
+        finally:
+            broadcaster.unsubscribe(sub)
+    return Response(generate(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache',
+                             'X-Accel-Buffering': 'no'})
+
+
 @app.route("/kap/maintenance", methods=['GET', 'POST'])
 def maintenance():
     af = ActivateForm()
@@ -123,12 +229,69 @@ def statistics():
 
 @app.route("/kap/log", methods=['GET'])
 def log():
-    environment = request.args.get('environment')
-    records = db.get_log_records(12)
-    if environment:
-        records = db.get_log_records(12, environment)
-    return render_template('log.html', title="Last 12 hours",
-                           records=records, tzname=TZNAME)
+    filters = {k: request.args.get(k) for k in LOG_FILTERS
+               if request.args.get(k)}
+    try:
+        limit = min(int(request.args.get('limit', 0)) or
+                    app.config['LOG_PAGE_SIZE'], 10000)
+        before = request.args.get('before')
+        if before:
+            t, h = before.split(":", 1)
+            before = (float(t), h)
+    except ValueError:
+        return jsonify(Success=False), 400
+    page = LogPage(db.iter_log_records(12, filters, before, limit + 1),
+                   limit, filters)
+    if request.args.get('format') == 'json':
+        return Response(stream_with_context(page.json()),
+                        mimetype='application/json')
+    return Response(stream_template(
+        'log.html', title="Last 12 hours", records=page, page=page,
+        filters=filters, tzname=TZNAME))
+
+
+class LogPage():
+    """Iterates over one page of log records, and remembers where the
+    next page starts"""
+
+    def __init__(self, records, limit, filters):
+        self._records = records
+        self._limit = limit
+        self._filters = filters
+        self.count = 0
+        self.next = None
+
+    def __iter__(self):
+        last = None
+        for r in self._records:
+            if self.count == self._limit:
+                self.next = "{}:{}".format(last[0], last[5])
+                break
+            self.count += 1
+            last = r
+            yield r
+
+    def next_url(self):
+        if not self.next:
+            return None
+        args = dict(self._filters)
+        args['before'] = self.next
+        args['limit'] = self._limit
+        return "?" + urlencode(args)
+
+    def json(self):
+        yield '{"records": ['
+        for i, r in enumerate(self):
+            yield (',' if i else '') + json.dumps(
+                {'time': r[0], 'id': r[1], 'previouslevel': r[2],
+                 'level': r[3], 'environment': r[4], 'hash': r[5]})
+        yield '], "next": %s}' % json.dumps(self.next)
+
+
+def stream_template(name, **context):
+    app.update_template_context(context)
+    template = app.jinja_env.get_template(name)
+    return stream_with_context(template.generate(context))
 
 
 @app.route("/kap/ticks", methods=['GET'])
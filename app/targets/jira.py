@@ -8,6 +8,9 @@ Create and update issues with JIRA REST API
 Created: 08.May.2018
 Created by: Morten Hersson, <mhersson@gmail.com>
 """
+import threading
+import requests
+from requests.exceptions import RequestException
 from jira.client import JIRA
 from jira.exceptions import JIRAError
 from app import LOGGER
@@ -21,17 +24,48 @@ class Incident():
         self._password = password
         self._project_key = project_key
         self._assignee = assignee
+        self._client = None
+        self._lock = threading.Lock()
+        # Transition ids by (project key, transition name)
+        self._transitions = {}
 
-    def _connect(self):
-        LOGGER.info("Connecting to JIRA")
+    def _connect(self, reconnect=False):
+        with self._lock:
+            if self._client is not None and not reconnect:
+                return self._client
+            LOGGER.info("Connecting to JIRA")
+            self._client = None
+            try:
+                self._client = JIRA(options={'server': self._server},
+                                    basic_auth=(self._username,
+                                                self._password))
+            except (JIRAError, RequestException) as err:
+                LOGGER.error("Failed connecting to JIRA")
+                LOGGER.error(err)
+            return self._client
+
+    def _call(self, func, idempotent=True):
+        """Run func with the shared client, and reconnect and try once
+        more if the session has expired or the connection is lost. When
+        func is not idempotent it is not tried again after errors like
+        read timeouts, where JIRA may already have done the work"""
+        jira = self._connect()
+        if jira is None:
+            return None
         try:
-            conn = JIRA(options={'server': self._server},
-                        basic_auth=(self._username, self._password))
-            return conn
-        except JIRAError as err:
-            LOGGER.error("Failed connecting to JIRA")
-            LOGGER.error(err)
-        return None
+            return func(jira)
+        except (JIRAError, RequestException) as err:
+            if isinstance(err, JIRAError):
+                if err.status_code != 401:
+                    raise
+            elif not idempotent and not isinstance(
+                    err, requests.exceptions.ConnectionError):
+                raise
+            LOGGER.info("Lost JIRA session, reconnecting")
+        jira = self._connect(reconnect=True)
+        if jira is None:
+            return None
+        return func(jira)
 
     def _create(self, alert):
         desc = alert.message
@@ -45,36 +79,56 @@ class Incident():
                       'components': [{'name': self._assignee}],
                       'issuetype': {'name': 'Incident'},
                       'security': {'name': 'Internal Issue'}}
-        jira = self._connect()
-        if jira:
-            try:
-                LOGGER.info("Creating JIRA ticket")
-                issue = jira.create_issue(fields=issue_dict)
-                if issue:
-                    return issue.key
-            except JIRAError as err:
-                LOGGER.error("Failed creating JIRA ticket")
-                LOGGER.error(err)
+        try:
+            LOGGER.info("Creating JIRA ticket")
+            # Trying again after a timeout could create the issue twice
+            issue = self._call(
+                lambda jira: jira.create_issue(fields=issue_dict),
+                idempotent=False)
+            if issue:
+                return issue.key
+        except (JIRAError, RequestException) as err:
+            LOGGER.error("Failed creating JIRA ticket")
+            LOGGER.error(err)
         return None
 
-    @staticmethod
-    def _get_transistion_id(jira, issue, name):
+    def _get_transistion_id(self, jira, issue, name):
+        project = issue.key.split('-')[0]
+        t = self._transitions.get((project, name))
+        if t:
+            return t
         try:
             LOGGER.info("Getting available transistions")
             transitions = jira.transitions(issue)
             t = [t['id'] for t in transitions if t['name'] == name]
             if t:
+                self._transitions[(project, name)] = t[0]
                 return t[0]
         except JIRAError as err:
             LOGGER.error(err)
         return None
 
+    def _transition(self, jira, issue, name):
+        t = self._get_transistion_id(jira, issue, name)
+        if not t:
+            return False
+        try:
+            jira.transition_issue(issue, t)
+        except JIRAError:
+            # The cached id is not valid for this issue, look it up again
+            project = issue.key.split('-')[0]
+            if self._transitions.pop((project, name), None) is None:
+                raise
+            t = self._get_transistion_id(jira, issue, name)
+            if not t:
+                return False
+            jira.transition_issue(issue, t)
+        return True
+
     def _resolve(self, jira, issue):
         try:
             LOGGER.info("Resolving JIRA ticket")
-            t = self._get_transistion_id(jira, issue, 'Resolve Issue')
-            if t:
-                jira.transition_issue(issue, t)
+            if self._transition(jira, issue, 'Resolve Issue'):
                 LOGGER.debug("JIRA ticket resolved")
         except JIRAError as err:
             LOGGER.error("Failed resolving JIRA ticket")
@@ -83,23 +137,28 @@ class Incident():
     def _close(self, jira, issue):
         try:
             LOGGER.info("Closing JIRA ticket")
-            t = self._get_transistion_id(jira, issue, 'Close Issue')
-            if t and len(issue.fields.comment.comments) <= 0:
-                jira.transition_issue(issue, t)
+            if len(issue.fields.comment.comments) > 0:
+                return
+            if self._transition(jira, issue, 'Close Issue'):
                 LOGGER.debug("JIRA ticket closed")
         except JIRAError as err:
             LOGGER.error("Failed closing JIRA ticket")
             LOGGER.error(err)
 
     def _resolve_and_close(self, key):
-        jira = self._connect()
-        if jira:
-            issue = jira.issue(key)
-            if not issue:
-                LOGGER.error("Failed to get issue")
-                return
-            self._resolve(jira, issue)
-            self._close(jira, issue)
+        try:
+            self._call(lambda jira: self._resolve_and_close_issue(jira, key))
+        except (JIRAError, RequestException) as err:
+            LOGGER.error("Failed to get issue")
+            LOGGER.error(err)
+
+    def _resolve_and_close_issue(self, jira, key):
+        issue = jira.issue(key)
+        if not issue:
+            LOGGER.error("Failed to get issue")
+            return
+        self._resolve(jira, issue)
+        self._close(jira, issue)
 
     def post(self, alert):
         if alert.level == 'CRITICAL' and alert.jira_issue is None:
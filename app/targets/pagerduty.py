@@ -8,8 +8,9 @@ Created: 17.Apr.2018
 Created by: Morten Hersson, <mhersson@gmail.com>
 """
 import json
-import requests
-from app import LOGGER
+from app import app, LOGGER
+from app.outbox import enqueue, coalesce_key, incident_key
+from app.targets.session import get_target
 
 
 class Pagerduty():
@@ -17,6 +18,7 @@ class Pagerduty():
         LOGGER.info("Initiating pagerduty")
         self._url = url
         self._service_key = service_key
+        self._http = get_target('pagerduty')
 
     def _create_event(self, alert, event_type="trigger"):
         LOGGER.info("Creating pagerduty event")
@@ -52,7 +54,27 @@ class Pagerduty():
             LOGGER.info("None critical event")
             return alert.pd_incident_key
         LOGGER.info("Sending event")
-        res = requests.post(self._url, json=message)
+        if app.config['OUTBOX_ENABLED']:
+            # The incident key is set by KAP, so it is known before the
+            # event is delivered, and repeated triggers are deduplicated
+            group = coalesce_key(alert)
+            if message['event_type'] == 'trigger' and group:
+                # Alerts in the same group share one incident
+                key = incident_key(group)
+            else:
+                key = alert.pd_incident_key or alert.alhash
+            # The outbox resolves a shared incident after its last alert
+            # has recovered
+            shared = key if group and key == incident_key(group) else None
+            message['incident_key'] = key
+            enqueue('pagerduty', self._url, message, alhash=alert.alhash,
+                    kind=message['event_type'],
+                    group=group if message['event_type'] == 'trigger'
+                    else None, incident=shared)
+            return key
+        res = self._http.post(self._url, json=message)
+        if res is None:
+            return alert.pd_incident_key
         LOGGER.debug("Status code: %d, Content: %s",
                      res.status_code, res.content.decode())
         if res:
@@ -0,0 +1,136 @@
+# vim:set shiftwidth=4 softtabstop=4 expandtab:
+"""
+Module: targets.session
+
+Shared keep-alive HTTP sessions for the notification targets, with
+connection pooling, timeouts and retries. Notifications are not
+idempotent, so only requests that never reached the target, or were
+refused with 429, are retried. Read timeouts and 5xx responses are
+retried only for the targets in HTTP_IDEMPOTENT_TARGETS. Sessions
+without retries are for callers scheduling retries themselves, like the
+outbox
+
+Created: 18.Oct.2026
+"""
+import time
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import ConnectTimeoutError
+from urllib3.util.retry import Retry
+from app import app, LOGGER
+from app.metrics import REGISTRY
+
+_REQUEST_SECONDS = REGISTRY.histogram('kap_target_request_seconds',
+                                      'Latency of requests to targets',
+                                      ['target'])
+_ERRORS = REGISTRY.counter('kap_target_errors_total',
+                           'Failed requests to targets', ['target'])
+
+_TARGETS = {}
+_TARGETS_LOCK = threading.Lock()
+
+
+def _retry(name):
+    retries = app.config['HTTP_RETRIES']
+    if name in app.config['HTTP_IDEMPOTENT_TARGETS']:
+        again, status = retries, (429, 500, 502, 503, 504)
+    else:
+        # The target may have acted on a request that timed out or
+        # failed with 5xx, sending it again could notify twice
+        again, status = 0, (429,)
+    kwargs = {'total': retries,
+              'connect': retries,
+              'read': again,
+              'other': again,
+              'backoff_factor': app.config['HTTP_BACKOFF_FACTOR'],
+              'status_forcelist': status,
+              'respect_retry_after_header': True,
+              'raise_on_status': False}
+    try:
+        # Notifications are POSTs, so retry on all methods
+        return Retry(allowed_methods=None, **kwargs)
+    except TypeError:
+        # urllib3 < 1.26
+        return Retry(method_whitelist=False, **kwargs)
+
+
+def not_sent(err):
+    """True if the request failed with err before it reached the server"""
+    if isinstance(err, requests.exceptions.ConnectTimeout):
+        return True
+    reason = err.args[0] if err.args else None
+    # NewConnectionError and NameResolutionError are ConnectTimeoutErrors
+    return isinstance(getattr(reason, 'reason', reason), ConnectTimeoutError)
+
+
+def create_session(name, retry=True):
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=app.config['HTTP_POOL_SIZE'],
+                          pool_maxsize=app.config['HTTP_POOL_SIZE'],
+                          max_retries=_retry(name) if retry else Retry(
+                              total=0, raise_on_status=False))
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def get_target(name, retry=True):
+    """Return the HTTPTarget shared by everyone posting to target name.
+    Requests from a target without retry are sent once"""
+    with _TARGETS_LOCK:
+        if (name, retry) not in _TARGETS:
+            _TARGETS[(name, retry)] = HTTPTarget(name, retry)
+        return _TARGETS[(name, retry)]
+
+
+def target_stats():
+    # Targets with and without retry share their statistics
+    with _TARGETS_LOCK:
+        targets = list(_TARGETS.values())
+    return {t.name: t.stats() for t in targets}
+
+
+class HTTPTarget():
+    """Keep-alive session and request statistics for one target"""
+
+    def __init__(self, name, retry=True):
+        self.name = name
+        self._session = create_session(name, retry)
+        self._timeout = (app.config['HTTP_CONNECT_TIMEOUT'],
+                         app.config['HTTP_READ_TIMEOUT'])
+        self._latency = _REQUEST_SECONDS.labels(name)
+        self._errors = _ERRORS.labels(name)
+
+    def post(self, url, **kwargs):
+        """Post to url, returns the response or None on connection errors"""
+        return self.request('post', url, **kwargs)
+
+    def get(self, url, **kwargs):
+        return self.request('get', url, **kwargs)
+
+    def request(self, method, url, raise_errors=False, **kwargs):
+        """Returns the response, or None on connection errors unless
+        raise_errors is set"""
+        kwargs.setdefault('timeout', self._timeout)
+        start = time.time()
+        res = None
+        error = None
+        try:
+            res = self._session.request(method, url, **kwargs)
+        except requests.exceptions.RequestException as err:
+            LOGGER.error("Failed %s to %s: %s", method.upper(), self.name,
+                         err)
+            error = err
+        self._latency.observe(time.time() - start)
+        if res is None or res.status_code >= 400:
+            self._errors.inc()
+        if error is not None and raise_errors:
+            raise error
+        return res
+
+    def stats(self):
+        values = self._latency.values()
+        avg = values[-2] / values[-1] if values[-1] else 0.0
+        return {'requests': values[-1], 'errors': self._errors.value(),
+                'latency_avg': avg}
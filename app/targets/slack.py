@@ -7,8 +7,9 @@ Send messages to slack using webhooks
 Created:24.Mar.2018
 Created by: Morten Hersson, <mhersson@gmail.com>
 """
-import requests
-from app import LOGGER
+from app import app, LOGGER
+from app.outbox import enqueue, coalesce_key
+from app.targets.session import get_target
 
 
 class Slack():
@@ -17,6 +18,7 @@ class Slack():
         self._url = url
         self._channel = channel
         self._username = username
+        self._http = get_target('slack')
         self._colors = {"OK": "good", "INFO": "#439FE0",
                         "WARNING": "warning", "CRITICAL": "danger"}
 
@@ -28,10 +30,8 @@ class Slack():
                                        "color": self._colors[alert.level],
                                        "text": alert.message}]}
         LOGGER.info("Posting to channel %s", self._channel)
-        res = requests.post(self._url, json=slack_json)
-        if res:
-            LOGGER.debug("Response from server: %d %s",
-                         res.status_code, res.content.decode())
+        self._post(slack_json, alhash=alert.alhash, kind=alert.level,
+                   group=coalesce_key(alert))
 
     def post_message(self, title, message, color='INFO'):
         '''Post message with title to slack '''
@@ -41,7 +41,14 @@ class Slack():
                                        "color": self._colors[color],
                                        "text": message}]}
         LOGGER.info("Posting to channel %s", self._channel)
-        res = requests.post(self._url, json=slack_json)
+        self._post(slack_json)
+
+    def _post(self, slack_json, alhash=None, kind=None, group=None):
+        if app.config['OUTBOX_ENABLED']:
+            enqueue('slack', self._url, slack_json, alhash=alhash,
+                    kind=kind, group=group)
+            return
+        res = self._http.post(self._url, json=slack_json)
         if res:
             LOGGER.debug("Response from server: %d %s",
                          res.status_code, res.content.decode())
@@ -7,16 +7,29 @@ Created by: Morten Hersson, <morten@escenic.com>
 Copyright (c) 2018 Morten Hersson
 """
 import time
+import gzip
+import json
 import boto3
-import calendar
 import datetime
-import requests
 from botocore.exceptions import NoCredentialsError, ProfileNotFound
 from botocore.exceptions import NoRegionError, ClientError
 
 from app import app, LOGGER
+from app.alert import Tags
 from app.alertcontroller import AlertController
-from app.dbcontroller import DBController
+from app.dbcontroller import DBController, state_version
+from app.events import publish
+from app.matcher import compile_exclusions
+from app.metrics import REGISTRY
+from app.targets.session import get_target
+
+_TASK_SECONDS = REGISTRY.histogram('kap_task_seconds',
+                                   'Duration of scheduled jobs', ['task'])
+_KAOS_REPORTS = REGISTRY.counter('kap_kaos_reports_total',
+                                 'Reports sent to KAOS', ['kind'])
+_KAOS_FULL = _KAOS_REPORTS.labels('full')
+_KAOS_DELTA = _KAOS_REPORTS.labels('delta')
+_KAOS_SKIPPED = _KAOS_REPORTS.labels('skipped')
 
 
 class AWSInfoCollector():
@@ -66,6 +79,7 @@ class AWSInfoCollector():
                     instance_info.append((x[0], None, i['State']['Code']))
         return instance_info
 
+    @_TASK_SECONDS.labels('AWSInfoCollector').time()
     def run(self):
         LOGGER.info("Updating AWS instance info")
         current = self._db.get_aws_instance_info()
@@ -93,39 +107,47 @@ class FlapDetective():
         self.slack_enabled = app.config['SLACK_ENABLED']
         self.excluded_tags = app.config['SLACK_EXCLUDED_TAGS']
 
+    @_TASK_SECONDS.labels('FlapDetective').time()
     def run(self):
         LOGGER.info("Searching for flapping alerts")
         logged_alerts = self.db.get_log_count_interval()
-        flapping_alerts = self.db.get_flapping_alerts()
-        flaphash = [x[0] for x in flapping_alerts]
-        logged_hash = []
+        flapping_alerts = {x[0]: x for x in self.db.get_flapping_alerts()}
+        logged_hash = set()
         for a in logged_alerts:
-            logged_hash.append(a[0])
-            if a[3] > self.limit and a[0] not in flaphash:
+            logged_hash.add(a[0])
+            flapping = flapping_alerts.get(a[0])
+            if a[3] > self.limit and flapping is None:
                 # Set flapping
                 self.db.set_flapping(a[0], a[1], a[2], a[3])
+                publish('flapping', {'hash': a[0], 'id': a[1],
+                                     'environment': a[2], 'count': a[3],
+                                     'flapping': True})
                 self.notify(a[1], a[2], a[3])
-            elif a[3] > self.limit and a[0] in flaphash:
+            elif a[3] > self.limit:
                 # Send reminder every hour if alert is still flapping
                 self.db.update_flapping(a[0], a[4])
-                flaptime = [x[2] for x in flapping_alerts if x[0] == a[0]]
-                if 0 < (time.time() % 3600 - flaptime[0] % 3600) <= 60:
+                flaptime = flapping[2]
+                if 0 < (time.time() % 3600 - flaptime % 3600) <= 60:
                     self.notify(a[1], a[2], a[3], reminder=True)
-            elif a[3] <= self.limit and a[0] in flaphash:
+            elif flapping is not None:
                 # Too low count to be marked as flapping
                 # Check that time now is bigger than
                 # modified + quarantine interval
-                quarantine = [x[3] + x[4] for x in flapping_alerts
-                              if x[0] == a[0]]
-                if time.time() > quarantine[0]:
+                if time.time() > flapping[3] + flapping[4]:
                     self.db.unset_flapping(a[0], a[1])
+                    publish('flapping', {'hash': a[0], 'id': a[1],
+                                         'environment': a[2], 'count': a[3],
+                                         'flapping': False})
         # If alert is no longer in the log it is not flapping, unset
-        for a in [(x[0], x[1]) for x in flapping_alerts
-                  if x[0] not in logged_hash]:
-            self.db.unset_flapping(a[0], a[1])
+        for x in flapping_alerts.values():
+            if x[0] not in logged_hash:
+                self.db.unset_flapping(x[0], x[1])
+                publish('flapping', {'hash': x[0], 'id': x[1],
+                                     'environment': None, 'count': 0,
+                                     'flapping': False})
 
     def notify(self, alertid, environ, count, flapping=True, reminder=False):
-        tag = [{'key': 'Environment', 'value': environ}]
+        tag = Tags([('Environment', environ)])
         ignore = self.alertctrl.contains_excluded_tags(self.excluded_tags, tag)
         if self.slack_enabled and not ignore:
             if flapping:
@@ -145,27 +167,28 @@ class SlackAlertSummary():
         self.url = "http://" + \
             app.config['SERVER_FQDN'] + "/kap/log?environment="
 
+    @_TASK_SECONDS.labels('SlackAlertSummary').time()
     def run(self):
-        if int(time.time()) % 3600 <= 60:
-            LOGGER.info("Creating alert summary")
-            summary = self.db.get_alert_summary()
-            if summary:
-                t = 0
-                s = 0
-                p = 0
-                for x in summary:
-                    if x[0] == 'test':
-                        t = x[1]
-                    if x[0] == 'staging':
-                        s = x[1]
-                    if x[0] == 'production':
-                        p = x[1]
-                msg = ("<{url}test|Test>: {test}, "
-                       "<{url}staging|Staging>: {staging}, "
-                       "<{url}production|Production>: {production}".format(
-                           url=self.url, test=t, staging=s, production=p))
-                title = "Last hour alert statistics"
-                self.alertctrl.slack.post_message(title, msg)
+        # Scheduled at the start of every hour
+        LOGGER.info("Creating alert summary")
+        summary = self.db.get_alert_summary()
+        if summary:
+            t = 0
+            s = 0
+            p = 0
+            for x in summary:
+                if x[0] == 'test':
+                    t = x[1]
+                if x[0] == 'staging':
+                    s = x[1]
+                if x[0] == 'production':
+                    p = x[1]
+            msg = ("<{url}test|Test>: {test}, "
+                   "<{url}staging|Staging>: {staging}, "
+                   "<{url}production|Production>: {production}".format(
+                       url=self.url, test=t, staging=s, production=p))
+            title = "Last hour alert statistics"
+            self.alertctrl.slack.post_message(title, msg)
 
 
 class KAOS():
@@ -174,20 +197,63 @@ class KAOS():
         LOGGER.info("Initiating KAOS scheduler")
         self.db = DBController()
         self.alertctrl = AlertController()
+        self._http = get_target('kaos')
+        self._exclusions = compile_exclusions(app.config['KAOS_EXCLUDED_TAGS'])
+        # Report and state version of the last successful send
+        self._sent = None
+        self._sent_version = None
+        self._last_full = 0
 
+    @_TASK_SECONDS.labels('KAOS').time()
     def run(self):
-        kaos_report = {app.config['KAOS_CUSTOMER']: []}
+        customer = app.config['KAOS_CUSTOMER']
+        if not app.config['KAOS_DELTA_ENABLED']:
+            self._send_report({customer: list(self._report().values())})
+            _KAOS_FULL.inc()
+            return
+        full = (time.time() - self._last_full >=
+                app.config['KAOS_FULL_SYNC_INTERVAL'])
+        # Read the version first, so changes made while the report is
+        # built are sent next time
+        version = state_version()
+        if not full and version == self._sent_version:
+            _KAOS_SKIPPED.inc()
+            return
+        report = self._report()
+        if full or self._sent is None:
+            ok = self._send_report({customer: list(report.values())})
+            _KAOS_FULL.inc()
+            if ok:
+                self._last_full = time.time()
+        else:
+            changed = [v for k, v in report.items()
+                       if self._sent.get(k) != v]
+            removed = [k for k in self._sent if k not in report]
+            if changed or removed:
+                ok = self._send_report({'Customer': customer, 'Full': False,
+                                        'Changed': changed,
+                                        'Removed': removed})
+                _KAOS_DELTA.inc()
+            else:
+                ok = True
+                _KAOS_SKIPPED.inc()
+        if ok:
+            self._sent = report
+            self._sent_version = version
+
+    def _report(self):
+        """Return the alerts to report to KAOS by alert hash"""
+        report = {}
         mrules = self.db.get_active_maintenance_rules()
         for v in self.db.get_active_alerts():
             if not self.alertctrl.affected_by_mrules(mrules, v):
-                if self.alertctrl.contains_excluded_tags(
-                        app.config['KAOS_EXCLUDED_TAGS'], v.tags):
+                if self._exclusions.excluded_tag(v.tags):
                     continue
                 # Create a copy we can play with
-                al_dict = dict(v.__dict__)
+                al_dict = v.fields()
                 al_dict['message'] = self.truncate_string(
                     al_dict['message'])
-                al_dict['time'] = self._fixtimezone(al_dict['time'])
+                al_dict['time'] = int(al_dict['time'])
                 # GO-lint complains about underscores in variables
                 # and there is no way do selectivly disable it,
                 # so to make the go linter shut up when developing KAOS
@@ -195,24 +261,23 @@ class KAOS():
                 al_dict['GrafanaURL'] = al_dict.pop('grafana_url')
                 al_dict['PDIncidentKey'] = al_dict.pop('pd_incident_key')
                 al_dict['JiraIssue'] = al_dict.pop('jira_issue')
-                kaos_report[app.config['KAOS_CUSTOMER']].append(al_dict)
-        self._send_report(kaos_report)
+                report[v.alhash] = al_dict
+        return report
 
-    @staticmethod
-    def _send_report(kaos_report):
+    def _send_report(self, kaos_report):
         LOGGER.info("Sending KAOS report")
-        try:
-            requests.post(app.config['KAOS_URL'],
-                          verify=app.config['KAOS_CERT'],
-                          json=kaos_report, timeout=5)
-        except requests.exceptions.RequestException:
-            LOGGER.exception("Failed posting to KAOS")
-
-    @staticmethod
-    def _fixtimezone(s):
-        tzdiff = calendar.timegm(
-            time.localtime()) - calendar.timegm(time.gmtime())
-        return s + tzdiff
+        body = json.dumps(kaos_report).encode()
+        headers = {'Content-Type': 'application/json'}
+        if app.config['KAOS_GZIP']:
+            body = gzip.compress(body)
+            headers['Content-Encoding'] = 'gzip'
+        res = self._http.post(app.config['KAOS_URL'],
+                              verify=app.config['KAOS_CERT'],
+                              data=body, headers=headers)
+        if not res:
+            LOGGER.error("Failed posting to KAOS")
+            return False
+        return True
 
     @staticmethod
     def truncate_string(s):
@@ -227,6 +292,7 @@ class MaintenanceScheduler():
         LOGGER.info("Initiating maintenance scheduler")
         self.db = DBController()
 
+    @_TASK_SECONDS.labels('MaintenanceScheduler').time()
     def run(self):
         now = datetime.datetime.today()
         LOGGER.info("Checking maintenance schedule")
@@ -243,6 +309,8 @@ class MaintenanceScheduler():
                         schedule['schedule_id']) and not schedule['repeat']:
                     self.db.delete_maintenance_schedule(
                         schedule['schedule_id'])
+        # Remove expired maintenance rules
+        self.db.get_active_maintenance_rules()
 
     @staticmethod
     def _check_day(now, days):
@@ -254,3 +322,29 @@ class MaintenanceScheduler():
         if int(hour) == now.hour and int(minute) == now.minute:
             return True
         return False
+
+
+class LogPruner():
+    """Removes or archives alert log records older than the retention"""
+
+    def __init__(self):
+        LOGGER.info("Initiating log pruner")
+        self.db = DBController()
+        self.retention = app.config['ALERT_LOG_RETENTION_DAYS'] * 86400
+        self.archive = app.config['ALERT_LOG_ARCHIVE']
+        self.batch = app.config['ALERT_LOG_PRUNE_BATCH']
+
+    @_TASK_SECONDS.labels('LogPruner').time()
+    def run(self):
+        LOGGER.info("Pruning alert log")
+        before = int(time.time()) - self.retention
+        total = 0
+        while True:
+            n = self.db.prune_alert_log(before, self.batch, self.archive)
+            total += n
+            if n < self.batch:
+                break
+            # Let waiting writers in between batches
+            time.sleep(0.1)
+        if total:
+            LOGGER.info("Pruned %d alert log records", total)
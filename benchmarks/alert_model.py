@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+# vim:set shiftwidth=4 softtabstop=4 expandtab:
+'''
+Module: alert_model.py
+
+Memory held per Alert and time spent in AlertController.create_alert for
+distinct alerts from the load test mix, and the time to read the active
+alerts from the cache with DBController.get_active_alerts.
+
+    python benchmarks/alert_model.py --alerts 100000 --active 5000
+
+Created: 18.Oct.2026
+'''
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir))
+
+from app import app  # noqa: E402
+from app.alertcontroller import AlertController  # noqa: E402
+from alertsimulator import AlertMix, TASKS  # noqa: E402
+
+
+def distinct_payloads(count, seed):
+    """Return count payloads, every one for another alert"""
+    mix = AlertMix(hosts=count // len(TASKS) + 1, seed=seed)
+    alerts = mix._alerts[:count]  # pylint: disable=W0212
+    for a in alerts:
+        a['level'] = 'CRITICAL'
+    return [mix._payload(a, 'OK') for a in alerts]  # pylint: disable=W0212
+
+
+def create(controller, payloads, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for content in payloads:
+            controller.create_alert(content)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return round(best / len(payloads) * 10 ** 6, 2)
+
+
+def memory(controller, payloads):
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    alerts = [controller.create_alert(content) for content in payloads]
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    size = sum(s.size_diff for s in after.compare_to(before, 'filename'))
+    # The list holding the alerts is not part of them
+    size -= sys.getsizeof(alerts)
+    return round(size / len(alerts))
+
+
+def active(controller, payloads, repeat):
+    db = controller._db  # pylint: disable=W0212
+    db.create_tables()
+    for content in payloads:
+        db.activate_alert(controller.create_alert(content))
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        db.get_active_alerts()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return round(best * 1000, 1)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--alerts", default=100000, type=int)
+    parser.add_argument("--active", default=5000, type=int)
+    parser.add_argument("--repeat", default=5, type=int)
+    parser.add_argument("--seed", default=1, type=int)
+    options = parser.parse_args()
+    payloads = distinct_payloads(options.alerts, options.seed)
+    with tempfile.TemporaryDirectory() as directory:
+        app.config.update(DATABASE_FILE=os.path.join(directory, 'kap.db'),
+                          AWS_API_ENABLED=False,
+                          ACTIVE_ALERT_CACHE_ENABLED=True)
+        controller = AlertController()
+        report = {
+            'alerts': options.alerts,
+            'create_alert_us': create(controller, payloads, options.repeat),
+            'bytes_per_alert': memory(controller, payloads),
+            'get_active_alerts_ms': active(
+                controller, payloads[:options.active], options.repeat)}
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+# vim:set shiftwidth=4 softtabstop=4 expandtab:
+'''
+Module: maintenance_matcher.py
+
+Time to match alerts against maintenance rules with MaintenanceMatcher,
+compared with the nested loop over all rules that was used before. The
+nested loop is too slow to run for every alert at 10k rules, so it runs
+for --sample alerts and the total is extrapolated.
+
+    python benchmarks/maintenance_matcher.py --rules 10000 --alerts 10000
+
+Created: 18.Oct.2026
+'''
+import os
+import sys
+import json
+import time
+import random
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir))
+
+from app.alert import Alert, Tags  # noqa: E402
+from app.matcher import MaintenanceMatcher  # noqa: E402
+from tests.test_matcher import nested_loop  # noqa: E402
+
+ENVIRONMENTS = ['production', 'staging', 'test', 'qa']
+
+
+def make_rules(rnd, count, hosts):
+    rules = []
+    for _ in range(count):
+        kind = rnd.random()
+        host = "host%05d.example.com" % rnd.randrange(hosts)
+        if kind < 0.6:
+            rules.append({'key': 'host', 'value': host})
+        elif kind < 0.75:
+            rules.append({'key': 'host', 'value': host[:7] + '*'})
+        elif kind < 0.85:
+            rules.append({'key': 'host', 'value': '*' + host[6:]})
+        elif kind < 0.95:
+            rules.append({'key': 'id', 'value': host + " disk"})
+        else:
+            rules.append({'key': 'Environment',
+                          'value': rnd.choice(ENVIRONMENTS) + 'x'})
+    return rules
+
+
+def make_alerts(rnd, count, hosts):
+    alerts = []
+    for _ in range(count):
+        host = "host%05d.example.com" % rnd.randrange(hosts * 2)
+        alerts.append(Alert(host + " cpu", 0, "", 'CRITICAL', 'OK', 0,
+                            Tags([('host', host),
+                                  ('Environment', rnd.choice(ENVIRONMENTS)),
+                                  ('MonGroup', 'web|cpu')])))
+    return alerts
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rules", default=10000, type=int)
+    parser.add_argument("--alerts", default=10000, type=int)
+    parser.add_argument("--sample", default=100, type=int,
+                        help="Alerts matched with the nested loop")
+    parser.add_argument("--seed", default=1, type=int)
+    options = parser.parse_args()
+    rnd = random.Random(options.seed)
+    hosts = max(options.rules, 1)
+    rules = make_rules(rnd, options.rules, hosts)
+    alerts = make_alerts(rnd, options.alerts, hosts)
+
+    start = time.perf_counter()
+    matcher = MaintenanceMatcher(rules)
+    build = time.perf_counter() - start
+    start = time.perf_counter()
+    matched = [matcher.matches(al) for al in alerts]
+    compiled = time.perf_counter() - start
+
+    sample = alerts[:options.sample]
+    start = time.perf_counter()
+    expected = [nested_loop(rules, al) for al in sample]
+    loop = (time.perf_counter() - start) / max(len(sample), 1)
+    assert expected == matched[:len(sample)]
+
+    print(json.dumps({
+        'rules': len(rules), 'alerts': len(alerts),
+        'matched': sum(matched),
+        'compiled': {'build_ms': round(build * 1000, 1),
+                     'match_ms': round(compiled * 1000, 1),
+                     'us_per_alert': round(compiled / len(alerts) * 1e6, 2)},
+        'nested_loop': {'sampled_alerts': len(sample),
+                        'us_per_alert': round(loop * 1e6, 2),
+                        'estimated_ms': round(loop * len(alerts) * 1000)}},
+                     indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+# vim:set shiftwidth=4 softtabstop=4 expandtab:
+'''
+Module: payload_decode.py
+
+Time to decode, validate and create an alert from Kapacitor payloads of
+growing size, with the json module and with orjson when it is installed,
+and the memory held by the decoded payload. Also compares parse_time
+with the strptime parsing used before.
+
+    python benchmarks/payload_decode.py --repeat 5
+
+Created: 18.Oct.2026
+'''
+import os
+import sys
+import json
+import time
+import argparse
+import tracemalloc
+from datetime import datetime
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir))
+
+from app import app, payload  # noqa: E402
+from app.alertcontroller import AlertController  # noqa: E402
+
+# Series x values per series
+SIZES = [(1, 1), (20, 10), (200, 60)]
+TIME = "2026-10-18T10:00:00.123456789Z"
+
+
+def make_payload(series, values):
+    return json.dumps({
+        'id': "host1.example.com cpu", 'message': "cpu is CRITICAL",
+        'details': '', 'time': TIME, 'duration': 600 * 10 ** 9,
+        'level': 'CRITICAL', 'previousLevel': 'OK',
+        'data': {'series': [
+            {'name': 'cpu',
+             'tags': {'host': "host1.example.com", 'Environment': 'production',
+                      'cpu': "cpu%d" % n},
+             'columns': ['time', 'usage_idle', 'usage_user'],
+             'values': [[TIME, 12.5 + i, 80.25 - i] for i in range(values)]}
+            for n in range(series)]}}).encode()
+
+
+def best(func, repeat, number):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(number):
+            func()
+        times.append((time.perf_counter() - start) / number)
+    return min(times)
+
+
+def handle(controller, data):
+    content = payload.decode(data)
+    controller.valid_payload(content)
+    controller.create_alert(content)
+
+
+def held(data):
+    tracemalloc.start()
+    content = payload.decode(data)
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del content
+    return size
+
+
+def strptime(datestr):
+    """The parsing used before parse_time"""
+    return datetime.strptime(datestr[:19], "%Y-%m-%dT%H:%M:%S").timestamp()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--repeat", default=5, type=int)
+    options = parser.parse_args()
+    app.config.update(AWS_API_ENABLED=False)
+    controller = AlertController()
+    decoders = {'json': json.loads}
+    try:
+        import orjson
+        decoders['orjson'] = orjson.loads
+    except ImportError:
+        pass
+    report = {}
+    for series, values in SIZES:
+        data = make_payload(series, values)
+        number = max(1, 2000 // (series * values))
+        result = {'bytes': len(data)}
+        for name, loads in decoders.items():
+            payload.loads = loads
+            result[name + '_us'] = round(best(
+                lambda: handle(controller, data), options.repeat,
+                number) * 10 ** 6, 1)
+            result[name + '_held_kib'] = round(held(data) / 1024, 1)
+        report["%dx%d" % (series, values)] = result
+    report['parse_time_us'] = round(best(
+        lambda: payload.parse_time(TIME), options.repeat, 10000) * 10 ** 6, 2)
+    report['strptime_us'] = round(best(
+        lambda: strptime(TIME), options.repeat, 10000) * 10 ** 6, 2)
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+# vim:set shiftwidth=4 softtabstop=4 expandtab:
+'''
+Module: sqlite_connections.py
+
+Alerts per second handled by AlertController.handle_alert with the
+pooled SQLite connections, compared with opening a new connection for
+every query, as KAP did before the pool. Every alert is handled in a new
+thread, like app.run(threaded=True) does with every request.
+
+    python benchmarks/sqlite_connections.py --alerts 2000
+
+Created: 18.Oct.2026
+'''
+import os
+import sys
+import json
+import time
+import sqlite3
+import argparse
+import tempfile
+import threading
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir))
+
+from app import app  # noqa: E402
+from app import dbcontroller  # noqa: E402
+from app.alertcontroller import AlertController  # noqa: E402
+from alertsimulator import AlertMix  # noqa: E402
+
+
+class NewConnections(dbcontroller.ConnectionPool):
+    """Opens a new connection with the default rollback journal for
+    every query, and closes it afterwards"""
+
+    def get(self):
+        with self._lock:
+            self.opened += 1
+        return sqlite3.connect(self.db, check_same_thread=False)
+
+    def put(self, con):
+        if con.in_transaction:
+            con.rollback()
+        con.close()
+
+
+def run(mode, payloads, directory):
+    app.config['DATABASE_FILE'] = os.path.join(directory, mode + '.db')
+    controller = AlertController()
+    controller._db.create_tables()  # pylint: disable=W0212
+    pool = dbcontroller.get_pool(controller._db.db)  # pylint: disable=W0212
+    if mode == 'connect':
+        pool = NewConnections(pool.db, 1, 1)
+        dbcontroller._POOLS[pool.db] = pool  # pylint: disable=W0212
+    start = time.perf_counter()
+    for content in payloads:
+        t = threading.Thread(target=controller.handle_alert, args=(content,))
+        t.start()
+        t.join()
+    elapsed = time.perf_counter() - start
+    return {'alerts_per_second': round(len(payloads) / elapsed),
+            'connections_opened': pool.opened}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--alerts", default=2000, type=int)
+    parser.add_argument("--seed", default=1, type=int)
+    options = parser.parse_args()
+    app.config.update(ALERTING_DELAY=0, SLACK_ENABLED=False,
+                      PAGERDUTY_ENABLED=False, JIRA_ENABLED=False,
+                      INFLUXDB_ENABLED=False)
+    mix = AlertMix(hosts=100, seed=options.seed)
+    payloads = [mix.next() for _ in range(options.alerts)]
+    report = {}
+    with tempfile.TemporaryDirectory() as directory:
+        for mode in ('connect', 'pool'):
+            report[mode] = run(mode, payloads, directory)
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+# vim:set shiftwidth=4 softtabstop=4 expandtab:
+'''
+Module: worker_scaling.py
+
+Throughput and latency of POST /kap/alert with KAP served by gunicorn
+with 1, 2 and 4 workers in MULTI_PROCESS mode. Alerts are dispatched
+synchronously to the stub Slack, PagerDuty and InfluxDB servers from
+alertsimulator.py. Requires gunicorn.
+
+    python benchmarks/worker_scaling.py --workers 1 2 4 --seconds 20
+
+Created: 18.Oct.2026
+'''
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import subprocess
+
+import requests
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+sys.path.insert(0, ROOT)
+
+from alertsimulator import AlertMix, LoadRunner, start_stubs  # noqa: E402
+
+SETTINGS = '''
+DATABASE_FILE = {db!r}
+MULTI_PROCESS = True
+INGEST_ASYNC_ENABLED = False
+OUTBOX_ENABLED = False
+ALERTING_DELAY = 0
+SLACK_ENABLED = True
+SLACK_URL = "http://127.0.0.1:{stub}/"
+PAGERDUTY_ENABLED = True
+PAGERDUTY_URL = "http://127.0.0.1:{pagerduty}/"
+INFLUXDB_ENABLED = True
+INFLUXDB_HOST = "127.0.0.1"
+INFLUXDB_PORT = {influxdb}
+'''
+
+
+def _wait_ready(url, timeout=30):
+    end = time.time() + timeout
+    while time.time() < end:
+        try:
+            if requests.get(url, timeout=1).status_code == 200:
+                return
+        except requests.exceptions.RequestException:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError("KAP did not start at " + url)
+
+
+def run(workers, options, directory):
+    settings = os.path.join(directory, 'w%d.cfg' % workers)
+    with open(settings, 'w') as f:
+        f.write(SETTINGS.format(
+            db=os.path.join(directory, 'w%d.db' % workers),
+            stub=options.stub_port, pagerduty=options.stub_port + 1,
+            influxdb=options.stub_port + 3))
+    env = dict(os.environ, KAP_SETTINGS=settings)
+    base = "http://127.0.0.1:%d" % options.port
+    proc = subprocess.Popen(
+        [sys.executable, '-m', 'gunicorn', '-w', str(workers), '-k',
+         'gthread', '-b', '127.0.0.1:%d' % options.port,
+         'kapacitoralertproxy:create_app()'],
+        cwd=ROOT, env=env, stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL)
+    try:
+        _wait_ready(base + "/kap/stats")
+        runner = LoadRunner(base + "/kap/alert",
+                            AlertMix(hosts=100, seed=options.seed),
+                            clients=options.clients, seconds=options.seconds)
+        report = runner.run()
+    finally:
+        proc.terminate()
+        proc.wait()
+    return {'throughput': report['throughput'],
+            'latency_ms': report['latency_ms'],
+            'errors': report['errors']}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--workers", default=[1, 2, 4], type=int, nargs='+')
+    parser.add_argument("--clients", default=8, type=int)
+    parser.add_argument("--seconds", default=20, type=float)
+    parser.add_argument("--port", default=9195, type=int)
+    parser.add_argument("--stub-port", default=9100, type=int)
+    parser.add_argument("--seed", default=1, type=int)
+    options = parser.parse_args()
+    servers, counter = start_stubs(options.stub_port)
+    report = {}
+    with tempfile.TemporaryDirectory() as directory:
+        for workers in options.workers:
+            report[workers] = run(workers, options, directory)
+    report['stubs'] = counter.counts
+    for srv in servers.values():
+        srv.shutdown()
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -15,6 +15,90 @@ class Config():
     SERVER_ADDRESS = "0.0.0.0"
     SERVER_PORT = 9095
     SECRET_KEY = "Something-really-clever"
+    # SQLite database, relative to the install directory
+    DATABASE_FILE = "db/kap.db"
+
+    # With clustering enabled every node in CLUSTER_NODES owns a share of
+    # the alerts, picked by consistent hashing of the alert hash. Alerts
+    # posted to another node are forwarded to the owner, so only the
+    # owner keeps state and notifies targets. Nodes failing the health
+    # check every CLUSTER_HEALTH_INTERVAL seconds are taken out of the
+    # ring and their alerts move to the remaining nodes, unless
+    # CLUSTER_FAILOVER is False. State is not handed over, so the new
+    # owner notifies active alerts again and may open a second JIRA
+    # issue. Without failover, alerts owned by a node that is down are
+    # refused with 503.
+    # CLUSTER_SELF is the url of this node as given in CLUSTER_NODES,
+    # e.g. CLUSTER_NODES = ["http://kap1:9095", "http://kap2:9095"]
+    CLUSTER_ENABLED = False
+    CLUSTER_NODES = []
+    CLUSTER_SELF = ""
+    CLUSTER_VNODES = 160
+    CLUSTER_HEALTH_INTERVAL = 5
+    CLUSTER_FAILOVER = True
+
+    # Set when several KAP processes share the database, e.g. under
+    # gunicorn with more than one worker. The active alert cache and the
+    # flap counters are then disabled, the state version used for ETags
+    # is kept in the database, and /kap/stream is not available.
+    # Only the process holding a lock on the file DATABASE_FILE +
+    # ".scheduler.lock" runs the scheduled jobs, the others retry every
+    # LEADER_RETRY_INTERVAL seconds and take over if the leader exits
+    MULTI_PROCESS = False
+    LEADER_RETRY_INTERVAL = 10
+
+    # With async ingest enabled /kap/alert only validates the payload,
+    # puts it on a bounded in-process queue and returns 202 at once.
+    # A pool of dispatch workers drains the queue, alerts with the same id
+    # are always handled by the same worker and in the order received.
+    # When the queue is full new alerts are dropped and answered with 503
+    INGEST_ASYNC_ENABLED = False
+    INGEST_QUEUE_SIZE = 1000
+    INGEST_WORKERS = 4
+
+    # Max number of alerts in one post to /kap/alerts/batch. Batches are
+    # handled directly, also with INGEST_ASYNC_ENABLED
+    BATCH_MAX_ALERTS = 5000
+
+    # SQLite connection settings. Up to SQLITE_POOL_SIZE connections are
+    # kept open and shared by all threads, and these pragmas are applied
+    # when one is opened. A thread waiting more than SQLITE_POOL_TIMEOUT
+    # seconds for a free connection fails
+    SQLITE_POOL_SIZE = 8
+    SQLITE_POOL_TIMEOUT = 30
+    SQLITE_JOURNAL_MODE = "WAL"
+    SQLITE_SYNCHRONOUS = "NORMAL"
+    SQLITE_CACHE_SIZE = -16000  # Negative values are KiB, i.e 16MB
+    SQLITE_MMAP_SIZE = 67108864  # 64MB
+    # Milliseconds to wait for a lock held by another connection
+    SQLITE_BUSY_TIMEOUT = 5000
+
+    # Set ALERT_LOG_RETENTION_DAYS to have an hourly job remove alert log
+    # records older than that, by default they are kept forever. With
+    # ALERT_LOG_ARCHIVE they are moved to monthly alert_log_archive_YYYYMM
+    # tables instead of deleted. Records are moved ALERT_LOG_PRUNE_BATCH
+    # at the time
+    ALERT_LOG_RETENTION_DAYS = 0
+    ALERT_LOG_ARCHIVE = True
+    ALERT_LOG_PRUNE_BATCH = 1000
+    # Number of records on each page of the log
+    LOG_PAGE_SIZE = 500
+
+    # Alert, flapping and maintenance changes are pushed to clients of
+    # /kap/stream as server-sent events. The last EVENT_HISTORY events
+    # are kept so reconnecting clients can resume from Last-Event-ID.
+    # Clients more than EVENT_CLIENT_BUFFER events behind are disconnected
+    EVENT_STREAM_ENABLED = True
+    EVENT_HISTORY = 1000
+    EVENT_CLIENT_BUFFER = 100
+    # Seconds between keepalive comments on idle streams
+    EVENT_KEEPALIVE = 15
+
+    # Keep all active alerts in memory, and write every change through
+    # to the database. With verify enabled every cached read is compared
+    # with the database, and differences are logged (slow, debug only)
+    ACTIVE_ALERT_CACHE_ENABLED = True
+    ACTIVE_ALERT_CACHE_VERIFY = False
 
     # This is used to gather instance info, suppress alerts from
     # terminated auto-scaling instances, and remove stale alerts from
@@ -37,6 +121,9 @@ class Config():
     # The number of alerts within the FLAPPING_WINDOW
     # before the alert is considered flapping
     FLAPPING_LIMIT = 4
+    # Keep per alert transition counters in memory instead of scanning
+    # the alert log every time the flap detective runs
+    FLAPPING_COUNTERS_ENABLED = True
     # Number of seconds to hold back an alert before dispatching to targets
     # This is a global setting and affects all alerts. To hold back individual
     # alerts use STATE_DURATION
@@ -46,17 +133,89 @@ class Config():
     # {"match string", delay secs} - match string must be part of the alert id
     STATE_DURATION = {}
 
+    # Send alerts to Slack, PagerDuty and JIRA at the same time from a
+    # pool of DISPATCH_WORKERS threads. A target still running after its
+    # deadline in seconds is left behind, and a PagerDuty incident key or
+    # JIRA issue it returns later is saved to the active alert
+    DISPATCH_PARALLEL = True
+    DISPATCH_WORKERS = 16
+    DISPATCH_DEADLINES = {'slack': 10, 'pagerduty': 10, 'jira': 30}
+
+    # With OUTBOX_ENABLED, Slack and PagerDuty notifications are written
+    # to an outbox table and delivered by a background sender, so none are
+    # lost when a target is down. Failed deliveries are retried with
+    # exponential backoff from OUTBOX_BACKOFF up to OUTBOX_MAX_BACKOFF
+    # seconds, or after the Retry-After of a 429, and dropped after
+    # OUTBOX_MAX_ATTEMPTS attempts. HTTP_RETRIES does not apply to the
+    # outbox. Notifications for the same alert are delivered in order. The
+    # newest pending one is replaced by a newer one of the same kind, e.g.
+    # a Slack message for the same level. PagerDuty incident keys are the
+    # alert hash
+    OUTBOX_ENABLED = False
+    OUTBOX_WORKERS = 8
+    OUTBOX_BATCH_SIZE = 100
+    OUTBOX_BACKOFF = 2
+    OUTBOX_MAX_BACKOFF = 600
+    OUTBOX_MAX_ATTEMPTS = 20
+    # Seconds between checks for notifications queued by other processes
+    OUTBOX_POLL_INTERVAL = 1
+    # Token bucket limits on requests from the outbox, as (requests per
+    # second, burst). OUTBOX_TARGET_RATES applies to all requests to a
+    # target, OUTBOX_CHANNEL_RATES to each url, i.e. Slack webhook
+    OUTBOX_TARGET_RATES = {'slack': (5, 20), 'pagerduty': (10, 50)}
+    OUTBOX_CHANNEL_RATES = {'slack': (1, 10)}
+
+    # Coalesce notifications during alert storms (requires OUTBOX_ENABLED).
+    # Alerts with the same values for the COALESCE_KEYS tags are held for
+    # COALESCE_WINDOW seconds, and sent as one digest message to Slack and
+    # one incident to PagerDuty. The incident is resolved when the last
+    # alert in it recovers. Use 'task' for the tick script name, which
+    # must be the last word of the alert id
+    COALESCE_ENABLED = False
+    COALESCE_KEYS = ['Environment']
+    COALESCE_WINDOW = 10
+    # Max number of alerts listed in a Slack digest
+    COALESCE_DIGEST_SIZE = 20
+
+    # HTTP settings for Slack, PagerDuty and KAOS. Connections are kept
+    # alive and pooled per target. Connection errors and 429 responses are
+    # retried with exponential backoff, honoring any Retry-After header.
+    # Read timeouts and 5xx responses are only retried for the targets in
+    # HTTP_IDEMPOTENT_TARGETS, others may already have acted on the request
+    HTTP_CONNECT_TIMEOUT = 3.05
+    HTTP_READ_TIMEOUT = 10
+    HTTP_POOL_SIZE = 10
+    HTTP_RETRIES = 3
+    HTTP_BACKOFF_FACTOR = 0.5
+    HTTP_IDEMPOTENT_TARGETS = ['kaos', 'influxdb']
+
     # Send Active Alerts to KAOS
     KAOS_ENABLED = False
     KAOS_CUSTOMER = "Test-Customer"
     KAOS_URL = "https://localhost/kaos/update/"
     KAOS_CERT = "server_bundle.pem"
     KAOS_EXCLUDED_TAGS = []
+    # In delta mode only alerts that changed since the last successful
+    # report are sent, together with the hashes of alerts that are gone,
+    # and nothing is sent when nothing changed. A full report is still
+    # sent every KAOS_FULL_SYNC_INTERVAL seconds. Requires a KAOS server
+    # that understands delta reports
+    KAOS_DELTA_ENABLED = False
+    KAOS_FULL_SYNC_INTERVAL = 600
+    # Send reports gzip compressed
+    KAOS_GZIP = False
 
     # Write stats to influxdb
     INFLUXDB_ENABLED = False
     INFLUXDB_HOST = 'localhost'
     INFLUXDB_PORT = 8086
+    # Points are buffered and written in batches from a background thread
+    # when INFLUXDB_BATCH_SIZE points are waiting, or every
+    # INFLUXDB_FLUSH_INTERVAL seconds. While InfluxDB is unreachable up to
+    # INFLUXDB_BUFFER_SIZE points are kept, after that the oldest are dropped
+    INFLUXDB_BATCH_SIZE = 500
+    INFLUXDB_FLUSH_INTERVAL = 5
+    INFLUXDB_BUFFER_SIZE = 10000
 
     # Slack
     SLACK_ENABLED = False
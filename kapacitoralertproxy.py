@@ -3,18 +3,30 @@
 '''
 Module: kapacitoralertproxy.py
 
+Run with python kapacitoralertproxy.py, or serve create_app() with a
+WSGI server, e.g.
+gunicorn -w 4 -k gthread -b 0.0.0.0:9095 'kapacitoralertproxy:create_app()'
+
 Created: 27.Mar.2018
 Created by: Morten Hersson, <mhersson@gmail.com>
 '''
-from app import app
+import sys
+import atexit
+import argparse
+from app import app, LOGGER
+from app.cluster import get_cluster
 from app.dbcontroller import DBController
+from app.leader import FileLock, LeaderElection
+from app.outbox import get_sender
+from app.routes import ingest
 from app.tasks import MaintenanceScheduler, KAOS, FlapDetective
-from app.tasks import AWSInfoCollector, SlackAlertSummary
+from app.tasks import AWSInfoCollector, SlackAlertSummary, LogPruner
 from apscheduler.schedulers.background import BackgroundScheduler
 
+_RUNTIME = {'scheduler': None, 'election': None}
 
-if __name__ == '__main__':
-    DBController().create_tables()
+
+def start_scheduler():
     scheduler = BackgroundScheduler()
     ms = MaintenanceScheduler()
     scheduler.add_job(ms.run, 'interval', seconds=60)
@@ -30,8 +42,64 @@ if __name__ == '__main__':
         scheduler.add_job(awscollector.run, 'interval', seconds=60)
     if app.config['SLACK_ENABLED'] and app.config['SLACK_SUMMARY']:
         slacksummary = SlackAlertSummary()
-        scheduler.add_job(slacksummary.run, 'interval', seconds=60)
+        scheduler.add_job(slacksummary.run, 'cron', minute=0)
+    if app.config['ALERT_LOG_RETENTION_DAYS'] > 0:
+        pruner = LogPruner()
+        scheduler.add_job(pruner.run, 'interval', hours=1)
     scheduler.start()
+    _RUNTIME['scheduler'] = scheduler
+    if app.config['OUTBOX_ENABLED']:
+        get_sender().start()
+
+
+def create_app():
+    """Prepare the database, start the ingest workers and the leader
+    election, and return the WSGI application. Every process serves
+    requests, only the leader runs the scheduled jobs and delivers the
+    outbox"""
+    db = DBController()
+    # Only one process at the time creates tables and migrates
+    with FileLock(db.db + '.migrate.lock'):
+        db.create_tables()
+    if app.config['INGEST_ASYNC_ENABLED']:
+        ingest.start()
+    if app.config['CLUSTER_ENABLED']:
+        get_cluster().start()
+    election = LeaderElection(db.db + '.scheduler.lock', start_scheduler,
+                              interval=app.config['LEADER_RETRY_INTERVAL'])
+    election.start()
+    _RUNTIME['election'] = election
+    atexit.register(shutdown)
+    return app
+
+
+def shutdown():
+    election = _RUNTIME.pop('election', None)
+    if election is None:
+        return
+    LOGGER.info("Shutting down")
+    if app.config['INGEST_ASYNC_ENABLED']:
+        ingest.stop()
+    if app.config['CLUSTER_ENABLED']:
+        get_cluster().stop()
+    election.stop()
+    if _RUNTIME['scheduler']:
+        _RUNTIME['scheduler'].shutdown()
+        if app.config['OUTBOX_ENABLED']:
+            get_sender().stop()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--backfill-rollups", action="store_true",
+                        help="Rebuild the statistics rollups from the alert "
+                        "log and exit")
+    options = parser.parse_args()
+    if options.backfill_rollups:
+        DBController().create_tables()
+        DBController().backfill_rollups()
+        sys.exit(0)
+    create_app()
     app.run(host=app.config['SERVER_ADDRESS'], port=app.config['SERVER_PORT'],
             debug=False, threaded=True)
-    scheduler.shutdown()
+    shutdown()
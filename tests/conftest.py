@@ -0,0 +1,127 @@
+# vim:set shiftwidth=4 softtabstop=4 expandtab:
+'''
+Module: conftest.py
+
+Shared fixtures. Every test runs with its own database file, and with
+all targets disabled unless the test enables them.
+
+Created: 18.Oct.2026
+'''
+import json
+import time
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from app import app, api, routes
+from app.alertcontroller import AlertController
+from app.dbcontroller import DBController
+
+
+@pytest.fixture
+def config(tmp_path):
+    """app.config pointing at a new database, restored after the test"""
+    saved = dict(app.config)
+    app.config.update(DATABASE_FILE=str(tmp_path / 'kap.db'),
+                      SLACK_ENABLED=False, PAGERDUTY_ENABLED=False,
+                      JIRA_ENABLED=False, INFLUXDB_ENABLED=False,
+                      KAOS_ENABLED=False, AWS_API_ENABLED=False,
+                      CLUSTER_ENABLED=False, INGEST_ASYNC_ENABLED=False,
+                      ALERTING_DELAY=0)
+    yield app.config
+    app.config.clear()
+    app.config.update(saved)
+
+
+@pytest.fixture
+def db(config):
+    db = DBController()
+    db.create_tables()
+    yield db
+    db.close()
+
+
+@pytest.fixture
+def client(db, monkeypatch):
+    """Test client of the app, with the routes using the test database"""
+    controller = AlertController()
+    for module in (routes, api):
+        monkeypatch.setattr(module, 'db', db)
+        monkeypatch.setattr(module, 'alertcontroller', controller)
+    return app.test_client()
+
+
+def payload(alertid="host1 cpu", level='CRITICAL', previous='OK',
+            time="2026-10-18T10:00:00Z", duration=600, **tags):
+    """Return a Kapacitor alert payload"""
+    tags = tags or {'host': alertid.split()[0], 'Environment': 'production'}
+    return {'id': alertid, 'message': "%s is %s" % (alertid, level),
+            'details': '', 'time': time, 'duration': duration * 10 ** 9,
+            'level': level, 'previousLevel': previous,
+            'data': {'series': [{'name': 'cpu', 'tags': tags,
+                                 'columns': ['time', 'value'],
+                                 'values': [[time, 1.0]]}]}}
+
+
+class _StubHandler(BaseHTTPRequestHandler):
+    def do_POST(self):  # pylint: disable=C0103
+        self.server.stub.handle(self)
+
+    do_GET = do_POST
+
+    def log_message(self, *args):  # pylint: disable=W0221
+        pass
+
+
+class StubServer():
+    """HTTP server on localhost recording the requests it gets. Answers
+    with the queued responses in order, then with 200"""
+
+    def __init__(self):
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), _StubHandler)
+        self._server.stub = self
+        self.url = "http://127.0.0.1:%d" % self._server.server_address[1]
+        self.requests = []
+        self._responses = []
+        self._lock = threading.Lock()
+        threading.Thread(target=self._server.serve_forever,
+                         daemon=True).start()
+
+    def respond(self, status=200, body=b'{}', headers=None, delay=0):
+        self._responses.append((status, body, headers or {}, delay))
+
+    def handle(self, handler):
+        length = int(handler.headers.get('Content-Length') or 0)
+        with self._lock:
+            self.requests.append({'path': handler.path,
+                                  'headers': dict(handler.headers),
+                                  'body': handler.rfile.read(length)})
+            response = self._responses.pop(0) if self._responses else \
+                (200, b'{}', {}, 0)
+        status, body, headers, delay = response
+        time.sleep(delay)
+        try:
+            handler.send_response(status)
+            for k, v in headers.items():
+                handler.send_header(k, v)
+            handler.send_header('Content-Length', str(len(body)))
+            handler.end_headers()
+            handler.wfile.write(body)
+        except OSError:
+            # The client gave up waiting
+            pass
+
+    def json(self):
+        return [json.loads(r['body']) for r in self.requests]
+
+    def close(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+@pytest.fixture
+def stub():
+    server = StubServer()
+    yield server
+    server.close()
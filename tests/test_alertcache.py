@@ -0,0 +1,64 @@
+# vim:set shiftwidth=4 softtabstop=4 expandtab:
+'''
+Module: test_alertcache.py
+
+Created: 18.Oct.2026
+'''
+import pytest
+
+from app.alertcontroller import AlertController
+from app.dbcontroller import DBController, get_pool
+from tests.conftest import payload
+
+
+def _trace(db):
+    # The pool hands the last returned connection out first
+    pool = get_pool(db.db)
+    con = pool.get()
+    queries = []
+    con.set_trace_callback(queries.append)
+    pool.put(con)
+    return queries
+
+
+@pytest.fixture
+def uncached(config):
+    config['ACTIVE_ALERT_CACHE_ENABLED'] = False
+    db = DBController()
+    db.create_tables()
+    return db
+
+
+def test_lookup_without_cache_is_one_query(uncached):
+    ctrl = AlertController()
+    ctrl.handle_alert(payload())
+    al = ctrl.create_alert(payload(previous='CRITICAL'))
+    queries = _trace(uncached)
+    assert uncached.is_active(al)
+    assert len(queries) == 1
+    uncached.get_tickets_and_keys(al)
+    assert len(queries) == 2
+    assert sorted(uncached.get_tags(al.alhash), key=str) == sorted(
+        al.tags.to_list(), key=str)
+    assert len(queries) == 3
+
+
+def test_cache_matches_database(db):
+    ctrl = AlertController()
+    ctrl.handle_alert(payload())
+    ctrl.handle_alert(payload("host2 cpu"))
+    ctrl.handle_alert(payload(level='WARNING', previous='CRITICAL'))
+    ctrl.handle_alert(payload("host2 cpu", level='OK', previous='CRITICAL'))
+    assert db.verify_cache() == []
+    assert [a.id for a in db.get_active_alerts()] == ["host1 cpu"]
+    assert db.cache_stats()['size'] == 1
+
+
+def test_cached_lookups_do_not_query(db):
+    ctrl = AlertController()
+    ctrl.handle_alert(payload())
+    al = ctrl.create_alert(payload(previous='CRITICAL'))
+    queries = _trace(db)
+    assert db.is_active(al)
+    assert db.get_tags(al.alhash) == al.tags.to_list()
+    assert queries == []
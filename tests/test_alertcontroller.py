@@ -0,0 +1,161 @@
+# vim:set shiftwidth=4 softtabstop=4 expandtab:
+'''
+Module: test_alertcontroller.py
+
+Created: 18.Oct.2026
+'''
+import sqlite3
+import threading
+
+import pytest
+
+from app import dispatch
+from app.alertcontroller import AlertController
+from tests.conftest import payload
+
+
+@pytest.fixture
+def controller(db):
+    return AlertController()
+
+
+def _keys(controller, al):
+    # pylint: disable=W0212
+    return controller._db.get_tickets_and_keys(controller.create_alert(
+        payload(al.id))).pd_incident_key
+
+
+def test_late_key_saved_after_alert_is_stored(config, controller,
+                                              monkeypatch):
+    """PagerDuty answers after its deadline, but before the alert row
+    is inserted"""
+    config.update(DISPATCH_PARALLEL=True,
+                  DISPATCH_DEADLINES={'pagerduty': 0.05})
+    monkeypatch.setattr(dispatch, '_DISPATCHER', {'dispatcher': None})
+    answered = threading.Event()
+    saved = threading.Event()
+
+    def run_pagerduty(al):
+        answered.wait(5)
+        return 'pd-late'
+
+    db = controller._db  # pylint: disable=W0212
+    set_alert_keys = db.set_alert_keys
+    activate_alert = db.activate_alert
+
+    def set_keys(*args, **kwargs):
+        try:
+            return set_alert_keys(*args, **kwargs)
+        finally:
+            saved.set()
+
+    def activate(al):
+        answered.set()
+        assert saved.wait(5)
+        activate_alert(al)
+
+    monkeypatch.setattr(controller, 'run_pagerduty', run_pagerduty)
+    monkeypatch.setattr(db, 'set_alert_keys', set_keys)
+    monkeypatch.setattr(db, 'activate_alert', activate)
+    al = controller.create_alert(payload())
+    controller.dispatch_and_update_status(al)
+    assert al.pd_incident_key is None
+    assert _keys(controller, al) == 'pd-late'
+
+
+def test_late_key_after_alert_is_stored(controller):
+    al = controller.create_alert(payload())
+    controller.update_active_alerts(al)
+    save = controller._save_late_key  # pylint: disable=W0212
+    save(al, 'pagerduty', 'pd-late')
+    assert _keys(controller, al) == 'pd-late'
+    assert not controller._late_keys  # pylint: disable=W0212
+
+
+def test_late_key_dropped_when_alert_recovers(controller):
+    al = controller.create_alert(payload())
+    save = controller._save_late_key  # pylint: disable=W0212
+    save(al, 'pagerduty', 'pd-late')
+    controller.update_active_alerts(
+        controller.create_alert(payload(level='OK', previous='CRITICAL')))
+    assert not controller._late_keys  # pylint: disable=W0212
+    assert not controller._db.get_active_alerts()  # pylint: disable=W0212
+
+
+@pytest.fixture
+def dispatched(controller, monkeypatch):
+    """Record dispatches, PagerDuty keys are 'pd-' and the alert id"""
+    calls = []
+
+    def dispatch(al):
+        calls.append((al.id, al.level, al.pd_incident_key))
+        if al.level == 'CRITICAL':
+            al.pd_incident_key = 'pd-' + al.id
+    monkeypatch.setattr(controller, 'dispatch', dispatch)
+    return calls
+
+
+def test_batch_with_invalid_alerts(controller, dispatched):
+    broken = payload("host3 cpu")
+    broken['data']['series'] = ["not a series"]
+    duration = payload("host4 cpu")
+    duration['duration'] = "600"
+    results = controller.handle_batch([
+        payload("host1 cpu"), payload("host2 cpu", time="garbage"),
+        broken, duration, payload("host5 cpu")])
+    assert [r['Success'] for r in results] == [True, False, False, False,
+                                               True]
+    assert [c[0] for c in dispatched] == ["host1 cpu", "host5 cpu"]
+    db = controller._db  # pylint: disable=W0212
+    assert sorted(a.id for a in db.get_active_alerts()) == ["host1 cpu",
+                                                            "host5 cpu"]
+
+
+def test_batch_not_notified_when_write_fails(controller, dispatched,
+                                             monkeypatch):
+    def apply_batch(*args):
+        raise sqlite3.OperationalError("database is locked")
+    monkeypatch.setattr(controller._db,  # pylint: disable=W0212
+                        'apply_batch', apply_batch)
+    with pytest.raises(sqlite3.OperationalError):
+        controller.handle_batch([payload("host1 cpu"), payload("host2 cpu")])
+    assert dispatched == []
+
+
+def test_batch_keys_saved_after_dispatch(controller, dispatched):
+    controller.handle_batch([
+        payload("host1 cpu"),
+        payload("host1 cpu", previous='CRITICAL',
+                time="2026-10-18T10:01:00Z"),
+        payload("host2 cpu"),
+        payload("host2 cpu", level='OK', previous='CRITICAL',
+                time="2026-10-18T10:01:00Z")])
+    # The recovery in the same batch resolves the incident just created
+    assert dispatched == [("host1 cpu", 'CRITICAL', None),
+                          ("host2 cpu", 'CRITICAL', None),
+                          ("host2 cpu", 'OK', 'pd-host2 cpu')]
+    db = controller._db  # pylint: disable=W0212
+    assert [a.id for a in db.get_active_alerts()] == ["host1 cpu"]
+    al = db.get_tickets_and_keys(controller.create_alert(payload()))
+    assert (al.pd_incident_key, al.sent) == ('pd-host1 cpu', True)
+    assert db.select("SELECT id, level, pagerduty FROM alert_log "
+                     "ORDER BY time, id", fetchone=False) == [
+                         ("host1 cpu", 'CRITICAL', 'pd-host1 cpu'),
+                         ("host2 cpu", 'CRITICAL', 'pd-host2 cpu'),
+                         ("host2 cpu", 'OK', 'pd-host2 cpu')]
+
+
+def test_batch_resolves_ticket_in_maintenance(controller, dispatched):
+    """A recovery still resolves an open ticket during maintenance, when
+    the alert is seen earlier in the same batch"""
+    controller.handle_batch([payload("host1 cpu")])
+    db = controller._db  # pylint: disable=W0212
+    db.activate_maintenance('host', 'host1', '1h', "reboot")
+    controller.handle_batch([
+        payload("host1 cpu", previous='CRITICAL',
+                time="2026-10-18T10:01:00Z"),
+        payload("host1 cpu", level='OK', previous='CRITICAL',
+                time="2026-10-18T10:02:00Z")])
+    assert dispatched == [("host1 cpu", 'CRITICAL', None),
+                          ("host1 cpu", 'OK', 'pd-host1 cpu')]
+    assert not db.get_active_alerts()
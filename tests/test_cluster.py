@@ -0,0 +1,157 @@
+# vim:set shiftwidth=4 softtabstop=4 expandtab:
+'''
+Module: test_cluster.py
+
+Created: 18.Oct.2026
+'''
+import json
+
+import pytest
+
+from app import routes
+from app.alert import alert_hash
+from app.cluster import Cluster, ForwardError, HashRing, FORWARDED_HEADER
+from app.targets.session import HTTPTarget
+from tests.conftest import StubServer, payload
+
+ME = "http://127.0.0.1:1"
+
+
+@pytest.fixture
+def http(config):
+    config.update(HTTP_RETRIES=3, HTTP_BACKOFF_FACTOR=0,
+                  HTTP_CONNECT_TIMEOUT=1, HTTP_READ_TIMEOUT=0.3)
+    return config
+
+
+@pytest.fixture
+def nodes():
+    servers = [StubServer(), StubServer()]
+    yield servers
+    for server in servers:
+        server.close()
+
+
+def _cluster(nodes, failover=True):
+    cluster = Cluster([n.url for n in nodes], ME, vnodes=16,
+                      failover=failover)
+    cluster._http = HTTPTarget('cluster')  # pylint: disable=W0212
+    return cluster
+
+
+def _owned_by(cluster, node, then=None):
+    """Return an alert id owned by node, and by then when node is gone"""
+    for i in range(1000):
+        alertid = "host%d cpu" % i
+        alhash = alert_hash(alertid)
+        if cluster.owner(alhash) != node.url:
+            continue
+        if then is None or HashRing([ME, then.url], 16).get(
+                alhash) == then.url:
+            return alertid
+    raise AssertionError("No alert owned by " + node.url)
+
+
+def test_forward_to_owner(http, nodes):
+    cluster = _cluster(nodes)
+    alhash = alert_hash(_owned_by(cluster, nodes[0]))
+    res = cluster.forward(alhash, b'{}')
+    assert res.status_code == 200
+    assert [len(n.requests) for n in nodes] == [1, 0]
+    assert nodes[0].requests[0]['headers'][FORWARDED_HEADER] == ME
+
+
+def test_read_timeout_not_sent_again(http, nodes):
+    cluster = _cluster(nodes)
+    alhash = alert_hash(_owned_by(cluster, nodes[0]))
+    nodes[0].respond(200, delay=0.6)
+    with pytest.raises(ForwardError):
+        cluster.forward(alhash, b'{}')
+    # Neither retried on the owner, nor sent to the next node
+    assert [len(n.requests) for n in nodes] == [1, 0]
+    assert cluster.owner(alhash) == nodes[0].url
+
+
+def test_5xx_not_sent_again(http, nodes):
+    cluster = _cluster(nodes)
+    alhash = alert_hash(_owned_by(cluster, nodes[0]))
+    nodes[0].respond(503)
+    assert cluster.forward(alhash, b'{}').status_code == 503
+    assert [len(n.requests) for n in nodes] == [1, 0]
+
+
+def test_failover_when_owner_is_gone(http, nodes):
+    cluster = _cluster(nodes)
+    alhash = alert_hash(_owned_by(cluster, nodes[0], then=nodes[1]))
+    nodes[0].close()
+    assert cluster.forward(alhash, b'{}').status_code == 200
+    assert len(nodes[1].requests) == 1
+    assert cluster.owner(alhash) == nodes[1].url
+
+
+def test_no_failover(http, nodes):
+    cluster = _cluster(nodes, failover=False)
+    alhash = alert_hash(_owned_by(cluster, nodes[0]))
+    nodes[0].close()
+    with pytest.raises(ForwardError):
+        cluster.forward(alhash, b'{}')
+    assert not nodes[1].requests
+    assert cluster.owner(alhash) == nodes[0].url
+
+
+def test_route_refuses_alert_when_forward_fails(http, client, nodes,
+                                                monkeypatch):
+    cluster = _cluster(nodes)
+    content = payload(_owned_by(cluster, nodes[0]))
+    nodes[0].respond(200, delay=0.6)
+    monkeypatch.setattr(routes, 'get_cluster', lambda: cluster)
+    http.update(CLUSTER_ENABLED=True)
+    assert client.post('/kap/alert', json=content).status_code == 503
+    assert [len(n.requests) for n in nodes] == [1, 0]
+    assert not routes.db.get_active_alerts()
+
+
+def test_forward_batch_one_request_per_node(http, nodes):
+    cluster = _cluster(nodes)
+    ids = [_owned_by(cluster, nodes[0]), _owned_by(cluster, nodes[1])]
+    mine = next("host%d mem" % i for i in range(1000)
+                if cluster.owner(alert_hash("host%d mem" % i)) == ME)
+    contents = [payload(ids[0]), payload(mine), payload(ids[1]),
+                payload(ids[0], level='OK', previous='CRITICAL')]
+    nodes[0].respond(200, json.dumps({'Success': False, 'results': [
+        {'Success': True}, {'Success': False}]}).encode())
+    results = cluster.forward_batch(
+        [(alert_hash(c['id']), c) for c in contents])
+    assert [len(n.requests) for n in nodes] == [1, 1]
+    assert nodes[0].requests[0]['path'] == "/kap/alerts/batch"
+    assert [c['level'] for c in nodes[0].json()[0]] == ['CRITICAL', 'OK']
+    assert [c['id'] for c in nodes[1].json()[0]] == [ids[1]]
+    assert results[1] is None
+    assert [(r['Success'], r['event']) for r in results[::2]] == [
+        (True, 'forwarded'), (True, 'forwarded')]
+    assert results[3]['Success'] is False
+
+
+def test_forward_batch_failover_and_timeout(http, nodes):
+    cluster = _cluster(nodes)
+    alertid = _owned_by(cluster, nodes[0], then=nodes[1])
+    nodes[0].close()
+    nodes[1].respond(200, delay=0.6)
+    results = cluster.forward_batch([(alert_hash(alertid),
+                                      payload(alertid))])
+    assert len(nodes[1].requests) == 1
+    assert results[0]['event'] == 'forward_failed'
+
+
+def test_batch_route_keeps_own_alerts(http, client, nodes, monkeypatch):
+    cluster = _cluster(nodes)
+    theirs = _owned_by(cluster, nodes[0])
+    mine = next("host%d mem" % i for i in range(1000)
+                if cluster.owner(alert_hash("host%d mem" % i)) == ME)
+    monkeypatch.setattr(routes, 'get_cluster', lambda: cluster)
+    http.update(CLUSTER_ENABLED=True)
+    res = client.post('/kap/alerts/batch',
+                      json=[payload(theirs), payload(mine)])
+    assert [r['event'] for r in res.get_json()['results']] == [
+        'forwarded', 'activate']
+    assert [a.id for a in routes.db.get_active_alerts()] == [mine]
@@ -0,0 +1,113 @@
+# vim:set shiftwidth=4 softtabstop=4 expandtab:
+'''
+Module: test_coalesce.py
+
+Created: 18.Oct.2026
+'''
+import pytest
+
+from app.alertcontroller import AlertController
+from app.outbox import OutboxSender
+from tests.conftest import StubServer, payload
+
+
+@pytest.fixture
+def targets():
+    servers = {'slack': StubServer(), 'pagerduty': StubServer()}
+    yield servers
+    for server in servers.values():
+        server.close()
+
+
+@pytest.fixture
+def setup(db, config, targets):
+    """Controller with Slack and PagerDuty going through the outbox"""
+    def create(coalesce=True):
+        config.update(SLACK_ENABLED=True, SLACK_URL=targets['slack'].url,
+                      PAGERDUTY_ENABLED=True,
+                      PAGERDUTY_URL=targets['pagerduty'].url,
+                      OUTBOX_ENABLED=True, OUTBOX_TARGET_RATES={},
+                      OUTBOX_CHANNEL_RATES={}, COALESCE_ENABLED=coalesce,
+                      COALESCE_KEYS=['Environment'], COALESCE_WINDOW=0,
+                      GRAFANA_ENABLED=False, FLAPPING_DETECTION_ENABLED=False,
+                      DISPATCH_PARALLEL=False)
+        return AlertController(), OutboxSender(workers=2)
+    return create
+
+
+def _alert(host, level='CRITICAL', previous='OK', env='production'):
+    return payload("%s cpu" % host, level=level, previous=previous,
+                   host=host, Environment=env)
+
+
+def _drain(sender):
+    while sender.flush():
+        pass
+
+
+def _events(server):
+    return [m['event_type'] for m in server.json()]
+
+
+def test_storm_requests_drop_with_coalescing(setup, targets):
+    """30 alerts in 3 environments trigger and recover"""
+    counts = {}
+    for coalesce in (False, True):
+        controller, sender = setup(coalesce)
+        for server in targets.values():
+            server.requests.clear()
+        for level, previous in (('CRITICAL', 'OK'), ('OK', 'CRITICAL')):
+            for i in range(30):
+                controller.handle_alert(_alert(
+                    "%s%d" % (coalesce, i), level, previous,
+                    env="env%d" % (i % 3)))
+            _drain(sender)
+        counts[coalesce] = {t: len(s.requests) for t, s in targets.items()}
+        assert _events(targets['pagerduty']).count('resolve') == \
+            (30 if not coalesce else 3)
+    assert counts[False] == {'slack': 60, 'pagerduty': 60}
+    assert counts[True] == {'slack': 6, 'pagerduty': 6}
+
+
+def test_group_shares_one_incident(setup, targets):
+    controller, sender = setup()
+    for host in ('host1', 'host2', 'host3'):
+        controller.handle_alert(_alert(host))
+    _drain(sender)
+    [trigger] = targets['pagerduty'].json()
+    assert len(trigger['details']['alerts']) == 3
+    assert len(targets['slack'].json()[0]['attachments']) == 3
+
+
+def test_resolve_waits_for_last_alert(setup, targets):
+    controller, sender = setup()
+    for host in ('host1', 'host2'):
+        controller.handle_alert(_alert(host))
+    _drain(sender)
+    controller.handle_alert(_alert('host1', 'OK', 'CRITICAL'))
+    _drain(sender)
+    assert _events(targets['pagerduty']) == ['trigger']
+    controller.handle_alert(_alert('host2', 'OK', 'CRITICAL'))
+    _drain(sender)
+    assert _events(targets['pagerduty']) == ['trigger', 'resolve']
+    key = targets['pagerduty'].json()[0]['incident_key']
+    assert targets['pagerduty'].json()[1]['incident_key'] == key
+
+
+def test_group_resolved_when_all_recover_in_one_batch(setup, targets):
+    controller, sender = setup()
+    hosts = ('host1', 'host2', 'host3')
+    controller.handle_batch([_alert(h) for h in hosts])
+    _drain(sender)
+    controller.handle_batch([_alert(h, 'OK', 'CRITICAL') for h in hosts])
+    _drain(sender)
+    assert _events(targets['pagerduty']) == ['trigger', 'resolve']
+
+
+def test_resolve_sent_after_pending_trigger(setup, targets):
+    """The resolve is not sent before the pending trigger"""
+    controller, sender = setup()
+    controller.handle_alert(_alert('host1'))
+    controller.handle_alert(_alert('host1', 'OK', 'CRITICAL'))
+    _drain(sender)
+    assert _events(targets['pagerduty']) == ['trigger', 'resolve']
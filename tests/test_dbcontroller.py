@@ -0,0 +1,135 @@
+# vim:set shiftwidth=4 softtabstop=4 expandtab:
+'''
+Module: test_dbcontroller.py
+
+Created: 18.Oct.2026
+'''
+import time
+import sqlite3
+import threading
+
+import pytest
+
+from app.alert import Alert, Tags
+from app.dbcontroller import ConnectionPool, get_pool
+
+
+def _in_threads(func, count):
+    # One thread per call, like app.run(threaded=True) per request
+    for _ in range(count):
+        t = threading.Thread(target=func)
+        t.start()
+        t.join()
+
+
+def test_threads_reuse_pooled_connections(db):
+    _in_threads(lambda: db.select("SELECT 1"), 50)
+    assert db.pool_stats()['open'] == 1
+
+
+def test_concurrent_threads_are_bounded(config, db):
+    pool = get_pool(db.db)
+    barrier = threading.Barrier(4)
+
+    def hold():
+        with db.transaction():
+            barrier.wait()
+
+    threads = [threading.Thread(target=hold) for _ in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert pool.stats()['open'] == 4
+    assert pool.stats()['idle'] == 4
+    assert pool.stats()['open'] <= config['SQLITE_POOL_SIZE']
+
+
+def test_pool_waits_and_times_out(tmp_path):
+    pool = ConnectionPool(str(tmp_path / 'pool.db'), 1, 0.05)
+    con = pool.get()
+    with pytest.raises(sqlite3.OperationalError):
+        pool.get()
+    pool.put(con)
+    assert pool.get() is con
+
+
+def test_transaction_commits_together(db):
+    with db.transaction():
+        db.execute_query("INSERT INTO aws_instances (host, environment, "
+                         "state) VALUES ('a', 'test', 16)")
+        with db.transaction():
+            db.execute_query("INSERT INTO aws_instances (host, "
+                             "environment, state) VALUES ('b', 'test', 16)")
+        # Not committed yet, other connections do not see it
+        other = sqlite3.connect(db.db)
+        assert other.execute("SELECT count(*) FROM aws_instances"
+                             ).fetchone()[0] == 0
+        other.close()
+    assert len(db.get_aws_instance_info()) == 2
+
+
+def test_transaction_rolls_back_and_returns_connection(db):
+    with pytest.raises(RuntimeError):
+        with db.transaction():
+            db.execute_query("INSERT INTO aws_instances (host, environment, "
+                             "state) VALUES ('a', 'test', 16)")
+            raise RuntimeError
+    assert db.get_aws_instance_info() == []
+    assert db.pool_stats()['idle'] == db.pool_stats()['open']
+
+
+def test_log_records_stream_from_own_connection(db):
+    db.execute_many("INSERT INTO alert_log (hash, time, id) VALUES (?, ?, ?)",
+                    [("h%d" % i, 2 ** 31 - i, "a") for i in range(3)])
+    records = db.iter_log_records(12)
+    first = next(records)
+    # The thread can query while the cursor is open
+    assert db.select("SELECT count(*) FROM alert_log")[0] == 3
+    assert [first[5]] + [r[5] for r in records] == ['h0', 'h1', 'h2']
+    assert db.pool_stats()['idle'] == db.pool_stats()['open']
+
+
+def test_log_without_time_skips_rollup(db):
+    # Alerts stored before times were validated can have none
+    al = Alert("host1 cpu", 60, "", 'CRITICAL', 'OK', None,
+               Tags([('Environment', 'production')]))
+    db.log_alert(al)
+    db.apply_batch(log=[Alert("host2 cpu", 60, "", 'OK', 'CRITICAL', None,
+                              Tags())])
+    assert db.select("SELECT count(*) FROM alert_log")[0] == 2
+    assert db.select("SELECT count(*) FROM alert_log_rollup")[0] == 0
+
+
+def test_migration_converts_local_times_to_utc(db, monkeypatch):
+    # Stored in UTC+2 before version 8, the alert was at 10:00 UTC
+    monkeypatch.setenv('TZ', 'XXX-2')
+    time.tzset()
+    try:
+        utc = 1792317600
+        db.execute_query("INSERT INTO alert_log (hash, time, id, "
+                         "environment, previouslevel, level, duration) "
+                         "VALUES ('h1', ?, 'host1 cpu', 'production', 'OK', "
+                         "'CRITICAL', 60)", (utc - 7200,))
+        db.execute_query("INSERT INTO active_alerts (hash, time, id) "
+                         "VALUES ('h1', ?, 'host1 cpu')", (utc - 7200,))
+        db.execute_query("PRAGMA user_version = 7")
+        db.migrate()
+    finally:
+        monkeypatch.delenv('TZ')
+        time.tzset()
+    assert db.select("SELECT time FROM alert_log")[0] == utc
+    assert db.select("SELECT time FROM active_alerts")[0] == utc
+    assert db.select("SELECT minute FROM alert_log_rollup")[0] == utc
+
+
+def test_backfill_rounds_fractional_times_to_minutes(db):
+    # Stored by a build that kept the fraction of the second
+    utc = 1792317600
+    db.execute_query("INSERT INTO alert_log (hash, time, id, environment, "
+                     "previouslevel, level, duration) VALUES ('h1', ?, "
+                     "'host1 cpu', 'production', 'OK', 'CRITICAL', 60)",
+                     (utc + 30.5,))
+    db.backfill_rollups()
+    assert db.select("SELECT minute, count FROM alert_log_rollup",
+                     fetchone=False) == [(utc, 1)]
@@ -0,0 +1,53 @@
+# vim:set shiftwidth=4 softtabstop=4 expandtab:
+'''
+Module: test_jira.py
+
+Created: 18.Oct.2026
+'''
+import requests
+from jira.exceptions import JIRAError
+
+from app.alert import Alert, Tags
+from app.targets.jira import Incident
+
+
+class FakeJIRA():
+    """Client failing the first calls with the given errors"""
+
+    def __init__(self, errors):
+        self.errors = list(errors)
+        self.created = 0
+
+    def create_issue(self, fields):
+        self.created += 1
+        if self.errors:
+            raise self.errors.pop(0)
+        return type('Issue', (), {'key': 'KAP-%d' % self.created})
+
+
+def _incident(client):
+    incident = Incident("http://jira", "user", "secret", "KAP", "ops")
+    incident._connect = lambda reconnect=False: client  # noqa
+    return incident
+
+
+def _alert():
+    return Alert("host1 cpu", 0, "cpu is high", 'CRITICAL', 'OK', 0, Tags())
+
+
+def test_create_not_repeated_after_read_timeout():
+    client = FakeJIRA([requests.exceptions.ReadTimeout()])
+    assert _incident(client).post(_alert()) is None
+    assert client.created == 1
+
+
+def test_create_repeated_after_connection_error():
+    client = FakeJIRA([requests.exceptions.ConnectionError()])
+    assert _incident(client).post(_alert()) == 'KAP-2'
+    assert client.created == 2
+
+
+def test_create_repeated_after_expired_session():
+    client = FakeJIRA([JIRAError(status_code=401)])
+    assert _incident(client).post(_alert()) == 'KAP-2'
+    assert client.created == 2
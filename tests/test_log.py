@@ -0,0 +1,72 @@
+# vim:set shiftwidth=4 softtabstop=4 expandtab:
+'''
+Module: test_log.py
+
+Created: 18.Oct.2026
+'''
+import time
+
+import pytest
+
+
+@pytest.fixture
+def log(db):
+    """30 records in 10 seconds, three at the same time, newest first"""
+    now = int(time.time())
+    rows = []
+    for i in range(30):
+        env = 'production' if i % 2 else 'staging'
+        rows.append(("h%02d" % i, now - i // 3, "host%d cpu" % (i % 5),
+                     env, "host%d" % (i % 5), 'OK', 'CRITICAL'))
+    db.execute_many("INSERT INTO alert_log (hash, time, id, environment, "
+                    "host, previouslevel, level) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    rows)
+    return sorted(rows, key=lambda r: (r[1], r[0]), reverse=True)
+
+
+def _pages(client, limit):
+    pages = []
+    url = "/kap/log?format=json&limit=%d" % limit
+    while url:
+        res = client.get(url).get_json()
+        pages.append(res['records'])
+        url = None
+        if res['next']:
+            url = "/kap/log?format=json&limit=%d&before=%s" % (limit,
+                                                               res['next'])
+    return pages
+
+
+def test_pages_cover_all_records_once(client, log):
+    pages = _pages(client, 7)
+    assert [len(p) for p in pages] == [7, 7, 7, 7, 2]
+    assert [r['hash'] for p in pages for r in p] == [r[0] for r in log]
+
+
+def test_filters(client, log):
+    res = client.get("/kap/log?format=json&environment=staging&host=host2"
+                     ).get_json()
+    expected = [r[0] for r in log if r[3] == 'staging' and r[4] == 'host2']
+    assert [r['hash'] for r in res['records']] == expected
+    assert res['next'] is None
+
+
+def test_html_is_streamed_with_next_link(client, log):
+    res = client.get("/kap/log?limit=10")
+    assert res.is_streamed
+    body = res.get_data(as_text=True)
+    assert body.count("host1 cpu") >= 1
+    assert "before=" in body
+
+
+def test_invalid_before_is_rejected(client):
+    assert client.get("/kap/log?before=garbage").status_code == 400
+
+
+def test_api_pages(client, log):
+    res = client.get("/kap/api/v1/log?limit=20&fields=hash").get_json()
+    assert [r['hash'] for r in res['records']] == [r[0] for r in log[:20]]
+    res = client.get("/kap/api/v1/log?limit=20&before=" + res['next']
+                     ).get_json()
+    assert [r['hash'] for r in res['records']] == [r[0] for r in log[20:]]
+    assert res['next'] is None
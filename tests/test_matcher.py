@@ -0,0 +1,106 @@
+# vim:set shiftwidth=4 softtabstop=4 expandtab:
+'''
+Module: test_matcher.py
+
+Created: 18.Oct.2026
+'''
+import random
+
+from app.alert import Alert, Tags
+from app.matcher import MaintenanceMatcher, ExclusionFilter, compile_rules
+
+
+def nested_loop(mrules, al):
+    """The matching loop AlertController.affected_by_mrules used before
+    the compiled matcher, with a guard for rules on missing tags"""
+    for mrule in mrules:
+        mrv = mrule['value']
+        v = [value for key, value in al.tags.items() if key == mrule['key']]
+        if mrv in v:
+            return True
+        if v and mrv[0] == '*' and v[0].endswith(mrv[1:]):
+            return True
+        if v and mrv[-1] == '*' and v[0].startswith(mrv[:-1]):
+            return True
+        if mrule['key'] == 'id':
+            if mrule['value'] in al.id:
+                return True
+    return False
+
+
+def _alert(alertid, **tags):
+    return Alert(alertid, 0, "", 'CRITICAL', 'OK', 0, Tags(tags.items()))
+
+
+def _random_rules(rnd, count):
+    rules = []
+    for _ in range(count):
+        key = rnd.choice(['host', 'Environment', 'id'])
+        if key == 'id':
+            # The old loop read v[0] for wildcard id rules and failed
+            value = "%04d" % rnd.randrange(2000)
+        elif key == 'Environment':
+            value = rnd.choice(['prod', 'staging', 'test', 'prod*', '*ing'])
+        else:
+            n = "%04d" % rnd.randrange(2000)
+            value = rnd.choice(["host%s.example.com" % n, "host%s*" % n[:3],
+                                "*%s.example.com" % n[1:]])
+        rules.append({'key': key, 'value': value})
+    return rules
+
+
+def test_matches_like_nested_loop():
+    rnd = random.Random(4)
+    alerts = [_alert("host%04d.example.com cpu" % n,
+                     host="host%04d.example.com" % n,
+                     Environment=rnd.choice(['prod', 'prodx', 'staging',
+                                             'test', 'dev']))
+              for n in range(2000)]
+    for size in (0, 1, 10, 200):
+        rules = _random_rules(rnd, size)
+        matcher = MaintenanceMatcher(rules)
+        matched = [matcher.matches(al) for al in alerts]
+        assert matched == [nested_loop(rules, al) for al in alerts]
+        if size == 200:
+            assert 0 < sum(matched) < len(alerts)
+
+
+def test_wildcards_and_ids():
+    matcher = MaintenanceMatcher([
+        {'key': 'host', 'value': 'web*'},
+        {'key': 'host', 'value': '*.db'},
+        {'key': 'Environment', 'value': 'staging'},
+        {'key': 'id', 'value': 'disk'}])
+    assert matcher.matches(_alert("a cpu", host="web01"))
+    assert matcher.matches(_alert("a cpu", host="main.db"))
+    assert matcher.matches(_alert("a cpu", host="x", Environment="staging"))
+    assert matcher.matches(_alert("host1 disk_used", host="x"))
+    assert not matcher.matches(_alert("a cpu", host="db.main"))
+    assert not matcher.matches(_alert("a cpu", Environment="stagingx"))
+
+
+def test_rule_for_missing_tag_does_not_match():
+    matcher = MaintenanceMatcher([{'key': 'MonGroup', 'value': 'web*'},
+                                  {'key': 'host', 'value': ''}])
+    assert not matcher.matches(_alert("a cpu", host="web01"))
+
+
+def test_compiled_once_per_rule_set():
+    rules = [{'key': 'host', 'value': 'a'}]
+    matcher = compile_rules(rules)
+    assert compile_rules(rules) is matcher
+    assert compile_rules([dict(r) for r in rules]) is matcher
+    assert compile_rules([{'key': 'host', 'value': 'b'}]) is not matcher
+
+
+def test_exclusion_filter():
+    excluded = ExclusionFilter([{'key': 'Environment', 'value': 'test'},
+                                {'key': 'MonGroup', 'value': 'db'}],
+                               ticks=['noisy'])
+    assert excluded.excluded_tag(Tags([('Environment', 'test')])) == \
+        ('Environment', 'test')
+    assert excluded.excluded_tag(Tags([('MonGroup', 'web|db')])) == \
+        ('MonGroup', 'web|db')
+    assert excluded.excluded_tag(Tags([('Environment', 'prod')])) is None
+    assert excluded.excluded_tick("host1 noisy") == 'noisy'
+    assert excluded.excluded_tick("host1 quiet") is None
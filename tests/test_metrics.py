@@ -0,0 +1,56 @@
+# vim:set shiftwidth=4 softtabstop=4 expandtab:
+'''
+Module: test_metrics.py
+
+Created: 18.Oct.2026
+'''
+import threading
+
+from app.metrics import Registry
+
+
+def _in_threads(func, count):
+    for _ in range(count):
+        t = threading.Thread(target=func)
+        t.start()
+        t.join()
+
+
+def test_counter_sums_threads():
+    counter = Registry().counter('test_total', 'Test', ['result'])
+    ok = counter.labels('ok')
+    _in_threads(ok.inc, 10)
+    ok.inc(5)
+    assert ok.value() == 15
+    assert counter.labels('failed').value() == 0
+
+
+def test_shards_of_exited_threads_are_folded():
+    child = Registry().counter('test_total', 'Test').labels()
+    _in_threads(child.inc, 1000)
+    # Folded when new threads arrive, without waiting for a scrape
+    assert len(child._shards) <= 64  # pylint: disable=W0212
+    assert child.value() == 1000
+
+
+def test_histogram_buckets():
+    hist = Registry().histogram('test_seconds', 'Test', buckets=(0.1, 1))
+    for value in (0.05, 0.5, 0.5, 5):
+        hist.observe(value)
+    assert hist.labels().values() == [1, 2, 1, 6.05, 4]
+    lines = hist.expose()
+    assert 'test_seconds_bucket{le="0.1"} 1' in lines
+    assert 'test_seconds_bucket{le="1"} 3' in lines
+    assert 'test_seconds_bucket{le="+Inf"} 4' in lines
+    assert 'test_seconds_count 4' in lines
+
+
+def test_gauge_and_exposition():
+    registry = Registry()
+    registry.gauge('test_depth', 'Depth', lambda: {('a',): 1, ('b',): None},
+                   ['queue'])
+    registry.gauge('test_broken', 'Broken', lambda: 1 / 0)
+    text = registry.expose()
+    assert 'test_depth{queue="a"} 1\n' in text
+    assert 'queue="b"' not in text
+    assert 'test_broken' not in text
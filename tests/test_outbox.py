@@ -0,0 +1,103 @@
+# vim:set shiftwidth=4 softtabstop=4 expandtab:
+'''
+Module: test_outbox.py
+
+Created: 18.Oct.2026
+'''
+import time
+
+import pytest
+
+from app.outbox import OutboxSender, enqueue
+
+
+@pytest.fixture
+def outbox(db, config):
+    config.update(OUTBOX_BACKOFF=2, OUTBOX_MAX_BACKOFF=600,
+                  OUTBOX_MAX_ATTEMPTS=3, OUTBOX_TARGET_RATES={},
+                  OUTBOX_CHANNEL_RATES={}, COALESCE_ENABLED=False,
+                  HTTP_RETRIES=3)
+    sender = OutboxSender(workers=2)
+    yield sender
+    sender.stop()
+
+
+def _pending(db):
+    return db.select("SELECT attempts, next_attempt, last_error FROM outbox",
+                     fetchone=False)
+
+
+def test_delivered(db, outbox, stub):
+    enqueue('slack', stub.url, {'text': "one"})
+    assert outbox.flush() == 1
+    assert stub.json() == [{'text': "one"}]
+    assert stub.requests[0]['headers']['Idempotency-Key']
+    assert not _pending(db)
+
+
+def test_pending_message_replaced(db, outbox, stub):
+    enqueue('slack', stub.url, {'text': "one"}, alhash='a1', kind='CRITICAL')
+    enqueue('slack', stub.url, {'text': "two"}, alhash='a1', kind='CRITICAL')
+    outbox.flush()
+    assert stub.json() == [{'text': "two"}]
+
+
+def test_older_messages_kept(db, outbox, stub):
+    """A CRITICAL pending during an outage is not lost to the OK, or to
+    the next CRITICAL after the OK"""
+    stub.respond(503)
+    for level in ('CRITICAL', 'OK', 'CRITICAL', 'CRITICAL'):
+        enqueue('slack', stub.url, {'text': level}, alhash='a1', kind=level)
+    outbox.flush()
+    db.execute_query("UPDATE outbox SET next_attempt = 0")
+    while outbox.flush():
+        pass
+    assert [m['text'] for m in stub.json()] == [
+        'CRITICAL', 'CRITICAL', 'OK', 'CRITICAL']
+
+
+def test_failure_sent_once_and_rescheduled(db, outbox, stub):
+    stub.respond(503)
+    enqueue('pagerduty', stub.url, {'event_type': 'trigger'})
+    start = time.time()
+    assert outbox.flush() == 1
+    # The session does not retry, the outbox does
+    assert len(stub.requests) == 1
+    [(attempts, next_attempt, error)] = _pending(db)
+    assert (attempts, error) == (1, "HTTP 503")
+    assert next_attempt >= start + 2
+    assert outbox.flush() == 0
+
+
+def test_retry_after_holds_target(db, outbox, stub):
+    stub.respond(429, headers={'Retry-After': '120'})
+    enqueue('slack', stub.url, {'text': "one"})
+    enqueue('slack', stub.url, {'text': "two"})
+    start = time.time()
+    outbox.flush()
+    # Sent once each, no retry inside the session
+    assert len(stub.requests) == 2
+    [(attempts, next_attempt, error)] = _pending(db)
+    assert (attempts, error) == (1, "HTTP 429")
+    assert next_attempt >= start + 120
+    blocked = outbox._blocked  # pylint: disable=W0212
+    assert blocked['slack'] >= time.monotonic() + 119
+
+
+def test_rejected_dropped(db, outbox, stub):
+    stub.respond(400)
+    enqueue('slack', stub.url, {'text': "one"})
+    outbox.flush()
+    assert len(stub.requests) == 1
+    assert not _pending(db)
+
+
+def test_expired_after_max_attempts(db, outbox, stub, config):
+    config.update(OUTBOX_BACKOFF=0)
+    for _ in range(3):
+        stub.respond(503)
+    enqueue('slack', stub.url, {'text': "one"})
+    while outbox.flush():
+        pass
+    assert len(stub.requests) == 3
+    assert not _pending(db)
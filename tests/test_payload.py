@@ -0,0 +1,77 @@
+# vim:set shiftwidth=4 softtabstop=4 expandtab:
+'''
+Module: test_payload.py
+
+Created: 18.Oct.2026
+'''
+import json
+from datetime import datetime, timezone
+
+import pytest
+
+from app.payload import decode, decode_batch, parse_time
+from tests.conftest import payload
+
+
+@pytest.mark.parametrize('datestr', [
+    "2026-10-18T10:00:00Z",
+    "2026-10-18T10:00:00.123456789Z",
+    "2026-10-18T10:00:00+02:00",
+    "2026-10-18T10:00:00-05:30",
+    "2026-10-18 10:00:00",
+    "2016-12-31T23:59:59.5z",
+    "1970-01-01T00:00:00Z",
+])
+def test_parse_time(datestr):
+    # datetime only takes microseconds, and no z
+    fixed = datestr.upper().replace('.123456789', '.123456789'[:7])
+    expected = datetime.fromisoformat(fixed.replace('Z', '+00:00'))
+    if expected.tzinfo is None:
+        expected = expected.replace(tzinfo=timezone.utc)
+    assert parse_time(datestr) == pytest.approx(expected.timestamp(),
+                                                abs=1e-6)
+
+
+@pytest.mark.parametrize('datestr', [
+    "garbage",
+    "2026-10-18T10:00:00Z trailing",
+    "2026-10-18T10:00:00+02:00:00",
+    "2026-10-18T10:00",
+    "2026-02-30T10:00:00Z",
+    "2026-10-18T25:00:00Z",
+    "2026-10-18T10:61:00Z",
+    "2026-10-18T10:00:00+24:00",
+    "",
+    None,
+    1760781600,
+])
+def test_parse_invalid_time(datestr):
+    with pytest.raises(ValueError):
+        parse_time(datestr)
+
+
+def test_decode_drops_values():
+    content = decode(json.dumps(payload()).encode())
+    assert content['id'] == "host1 cpu"
+    assert 'values' not in content['data']['series'][0]
+    assert content['data']['series'][0]['tags']['host'] == "host1"
+
+
+def test_decode_invalid():
+    assert decode(b"{") is None
+    # Left to valid_payload
+    assert decode(b'"text"') == "text"
+
+
+def test_decode_batch():
+    contents = [payload("host%d cpu" % i) for i in range(3)]
+    array = decode_batch(json.dumps(contents).encode())
+    ndjson = decode_batch(b"\n".join(json.dumps(c).encode()
+                                     for c in contents) + b"\n\n")
+    assert [c['id'] for c in array] == [c['id'] for c in contents]
+    assert array == ndjson
+
+
+def test_decode_batch_invalid():
+    assert decode_batch(b"[{") is None
+    assert decode_batch(b'{"id": 1}\n{\n') == [{'id': 1}, None]
@@ -0,0 +1,63 @@
+# vim:set shiftwidth=4 softtabstop=4 expandtab:
+'''
+Module: test_routes.py
+
+Created: 18.Oct.2026
+'''
+import json
+
+import pytest
+
+from tests.conftest import payload
+
+
+def _post(client, content):
+    return client.post("/kap/alert", data=json.dumps(content),
+                       content_type='application/json')
+
+
+def test_alert_is_stored(client, db):
+    assert _post(client, payload()).status_code == 200
+    assert [a.id for a in db.get_active_alerts()] == ["host1 cpu"]
+
+
+@pytest.mark.parametrize('key,value', [
+    ('time', "garbage"),
+    ('time', "2026-10-18T10:00:00Z trailing"),
+    ('time', None),
+    ('duration', "600"),
+    ('duration', None),
+    ('data', {'series': None}),
+])
+def test_invalid_payload_is_rejected(client, db, key, value):
+    content = payload()
+    content[key] = value
+    assert _post(client, content).status_code == 400
+    assert db.get_active_alerts() == []
+
+
+def test_not_json_is_rejected(client):
+    assert client.post("/kap/alert", data=b"{").status_code == 400
+
+
+def test_batch_with_invalid_alert(client, db):
+    broken = payload("host2 cpu")
+    broken['data']['series'] = [None]
+    res = client.post("/kap/alerts/batch", data=json.dumps(
+        [payload("host1 cpu"), broken, payload("host3 cpu")]),
+                      content_type='application/json')
+    assert res.status_code == 200
+    assert [r['Success'] for r in res.get_json()['results']] == [
+        True, False, True]
+    assert sorted(a.id for a in db.get_active_alerts()) == ["host1 cpu",
+                                                            "host3 cpu"]
+
+
+def test_fractional_time_stored_in_whole_seconds(client, db):
+    for alertid in ("host1 cpu", "host2 cpu"):
+        assert _post(client, payload(
+            alertid, time="2026-10-18T10:00:30.5Z")).status_code == 200
+    assert db.select("SELECT DISTINCT time FROM alert_log")[0] == 1792317630
+    assert db.select("SELECT minute FROM alert_log_rollup")[0] == 1792317600
+    res = client.get("/kap/api/v1/log?limit=1").get_json()
+    assert res['next'].startswith("1792317630:")
@@ -0,0 +1,44 @@
+# vim:set shiftwidth=4 softtabstop=4 expandtab:
+'''
+Module: test_session.py
+
+Created: 18.Oct.2026
+'''
+import pytest
+
+from app.targets.session import HTTPTarget
+
+
+@pytest.fixture
+def http(config):
+    config.update(HTTP_RETRIES=3, HTTP_BACKOFF_FACTOR=0,
+                  HTTP_CONNECT_TIMEOUT=1, HTTP_READ_TIMEOUT=0.3)
+    return config
+
+
+def test_post_not_retried_on_5xx(http, stub):
+    stub.respond(503)
+    res = HTTPTarget('slack').post(stub.url, json={})
+    assert res.status_code == 503
+    assert len(stub.requests) == 1
+
+
+def test_post_not_retried_on_read_timeout(http, stub):
+    stub.respond(200, delay=0.6)
+    assert HTTPTarget('pagerduty').post(stub.url, json={}) is None
+    assert len(stub.requests) == 1
+
+
+def test_post_retried_on_429(http, stub):
+    stub.respond(429, headers={'Retry-After': '0'})
+    res = HTTPTarget('slack').post(stub.url, json={})
+    assert res.status_code == 200
+    assert len(stub.requests) == 2
+
+
+def test_idempotent_target_retried_on_5xx(http, stub):
+    stub.respond(503)
+    stub.respond(502)
+    res = HTTPTarget('kaos').post(stub.url, json={})
+    assert res.status_code == 200
+    assert len(stub.requests) == 3